@@ -0,0 +1,413 @@
+import datetime as dt
+import os
+import platform
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+from rest_framework.test import APIRequestFactory
+
+from heatmaps.models import ComputationResult, Scenario, TargetPoint
+from heatmaps.services import (
+    Cell,
+    GridGenerator,
+    aggregate_duration_matrix,
+    aggregate_durations,
+    compute_times,
+)
+from heatmaps.simulation import RoutingSimulator, SimulatedRoutingBackend
+from heatmaps.storage import append_results, clear_results, save_results
+from heatmaps.views import ScenarioResultsView
+
+# Every synthetic scenario is centred on Madrid, with targets spread over it.
+BENCHMARK_CENTER = (40.4168, -3.7038)
+BENCHMARK_TARGETS = 10
+BENCHMARK_SEED = 1234
+# Bumped whenever cases change in a way that makes old baselines meaningless.
+BENCHMARK_FORMAT_VERSION = 1
+
+
+@dataclass
+class Benchmark:
+    # ``prepare`` builds the fixtures (untimed) and returns the timed call;
+    # ``reset`` runs untimed before every repetition. ``items`` is the number
+    # of cells (or pairs) one call processes, for throughput.
+    name: str
+    params: dict
+    items: int
+    prepare: Callable[[], Callable[[], object]]
+    reset: Optional[Callable[[], None]] = None
+    uses_database: bool = False
+
+    @property
+    def key(self) -> str:
+        if not self.params:
+            return self.name
+        args = ",".join(f"{name}={value}" for name, value in self.params.items())
+        return f"{self.name}[{args}]"
+
+
+def square_polygon(side_m: float, center=BENCHMARK_CENTER) -> dict:
+    lat, lng = center
+    half_lat = side_m / 2 / 111_320
+    half_lng = side_m / 2 / (111_320 * np.cos(np.radians(lat)))
+    ring = [
+        [lng - half_lng, lat - half_lat],
+        [lng + half_lng, lat - half_lat],
+        [lng + half_lng, lat + half_lat],
+        [lng - half_lng, lat + half_lat],
+        [lng - half_lng, lat - half_lat],
+    ]
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def synthetic_targets(side_m: float, count: int = BENCHMARK_TARGETS) -> List[TargetPoint]:
+    rng = np.random.default_rng(BENCHMARK_SEED)
+    lat, lng = BENCHMARK_CENTER
+    offsets = rng.uniform(-0.5, 0.5, size=(count, 2)) * side_m / 111_320
+    return [
+        TargetPoint(
+            name=f"target {index}",
+            lat=lat + dlat,
+            lng=lng + dlng / np.cos(np.radians(lat)),
+            weight=float(index % 3 + 1),
+        )
+        for index, (dlat, dlng) in enumerate(offsets.tolist())
+    ]
+
+
+def synthetic_results(cells: Sequence[Cell], targets: Sequence[TargetPoint]) -> List[dict]:
+    # Durations from the simulated backend, shaped like compute_times output.
+    matrix = RoutingSimulator(latency_ms=0, latency_jitter_ms=0, element_latency_ms=0).durations(
+        cells, targets
+    )
+    keys = [f"{target.lat:.6f},{target.lng:.6f}" for target in targets]
+    return [
+        {
+            "lat": cell.lat,
+            "lng": cell.lng,
+            "time_minutes": min(row) / 60,
+            "raw": {"durations": row, "targets": keys},
+        }
+        for cell, row in zip(cells, matrix)
+    ]
+
+
+def grid_benchmarks(quick: bool) -> List[Benchmark]:
+    sides_km = (2, 10) if quick else (2, 10, 30)
+    resolutions = (250, 500) if quick else (100, 250, 500)
+    benchmarks = []
+    for shape in (Scenario.GRID_SQUARE, Scenario.GRID_HEX):
+        for side_km in sides_km:
+            for resolution in resolutions:
+                polygon = square_polygon(side_km * 1000)
+                generator = GridGenerator(shape=shape)
+
+                def prepare(generator=generator, polygon=polygon, resolution=resolution):
+                    return lambda: generator.generate_grid(polygon, resolution)
+
+                benchmarks.append(
+                    Benchmark(
+                        name="grid.generate_grid",
+                        params={"shape": shape, "side_km": side_km, "resolution_m": resolution},
+                        items=int((side_km * 1000 / resolution) ** 2),
+                        prepare=prepare,
+                    )
+                )
+    return benchmarks
+
+
+def compute_benchmarks(quick: bool) -> List[Benchmark]:
+    num_cells = 100 if quick else 400
+    side_m = 5000.0
+    cases = [
+        {"use_matrix": True, "workers": 1, "prune": False},
+        {"use_matrix": True, "workers": 8, "prune": False},
+        {"use_matrix": False, "workers": 8, "prune": False},
+        {"use_matrix": False, "workers": 8, "prune": True},
+    ]
+    benchmarks = []
+    for case in cases:
+
+        def prepare(case=case):
+            cells = GridGenerator().generate_grid(
+                square_polygon(side_m), side_m / np.sqrt(num_cells)
+            )[:num_cells]
+            targets = synthetic_targets(side_m)
+            # A fixed 2 ms per request plus 0.05 ms per element, no jitter,
+            # so timings only move with the pipeline.
+            client = SimulatedRoutingBackend(
+                simulator=RoutingSimulator(
+                    latency_ms=2, latency_jitter_ms=0, element_latency_ms=0.05, error_rate=0
+                )
+            )
+
+            def run():
+                return compute_times(
+                    cells,
+                    targets,
+                    None,
+                    Scenario.METRIC_MIN,
+                    "transit",
+                    client=client,
+                    max_workers=case["workers"],
+                    use_matrix=case["use_matrix"],
+                    use_cache=False,
+                    prune=case["prune"],
+                )
+
+            return run
+
+        benchmarks.append(
+            Benchmark(
+                name="compute.compute_times",
+                params={"cells": num_cells, "targets": BENCHMARK_TARGETS, **case},
+                items=num_cells,
+                prepare=prepare,
+            )
+        )
+    return benchmarks
+
+
+def aggregate_benchmarks(quick: bool) -> List[Benchmark]:
+    num_cells = 10_000 if quick else 100_000
+    metrics = (Scenario.METRIC_MIN, Scenario.METRIC_WEIGHTED, Scenario.METRIC_PERCENTILE)
+    benchmarks = []
+    for metric in metrics:
+
+        def prepare_matrix(metric=metric):
+            matrix, targets = _duration_fixture(num_cells)
+            weights = [target.weight for target in targets]
+            return lambda: aggregate_duration_matrix(matrix, metric, weights, 75.0)
+
+        def prepare_cells(metric=metric):
+            matrix, targets = _duration_fixture(num_cells)
+            rows = [
+                [None if np.isnan(value) else int(value) for value in row]
+                for row in matrix.tolist()
+            ]
+            return lambda: [
+                aggregate_durations(row, targets, metric, 75.0) for row in rows
+            ]
+
+        for name, prepare in (
+            ("aggregate.aggregate_duration_matrix", prepare_matrix),
+            ("aggregate.aggregate_durations", prepare_cells),
+        ):
+            benchmarks.append(
+                Benchmark(
+                    name=name,
+                    params={"cells": num_cells, "targets": BENCHMARK_TARGETS, "metric": metric},
+                    items=num_cells,
+                    prepare=prepare,
+                )
+            )
+    return benchmarks
+
+
+def _duration_fixture(num_cells: int):
+    rng = np.random.default_rng(BENCHMARK_SEED)
+    matrix = rng.integers(300, 5400, size=(num_cells, BENCHMARK_TARGETS)).astype(float)
+    matrix[rng.random(matrix.shape) < 0.05] = np.nan
+    return matrix, synthetic_targets(5000.0)
+
+
+def storage_benchmarks(quick: bool) -> List[Benchmark]:
+    sizes = (1_000, 10_000) if quick else (1_000, 10_000, 100_000)
+    benchmarks = []
+    for size in sizes:
+        # append_results as runs call it, one batch at a time; ``replace``
+        # overwrites the rows stored by the previous repetition (resumes).
+        for name, save, replace in (
+            ("storage.save_results", save_results, False),
+            ("storage.append_results", _append_batches, False),
+            ("storage.append_results_replace", _append_batches, True),
+        ):
+            state: dict = {}
+
+            def prepare(size=size, save=save, replace=replace, state=state):
+                state["scenario"], state["results"] = _scenario_fixture(size, store=False)
+                if replace:
+                    return lambda: save(state["scenario"], state["results"], replace=True)
+                return lambda: save(state["scenario"], state["results"])
+
+            def reset(replace=replace, state=state):
+                clear_results(state["scenario"])
+                if replace:
+                    _append_batches(state["scenario"], state["results"])
+
+            benchmarks.append(
+                Benchmark(
+                    name=name,
+                    params={"cells": size, "targets": BENCHMARK_TARGETS},
+                    items=size,
+                    prepare=prepare,
+                    reset=reset,
+                    uses_database=True,
+                )
+            )
+    return benchmarks
+
+
+def _append_batches(scenario: Scenario, results: List[dict], replace: bool = False) -> None:
+    batch_size = max(int(getattr(settings, "HEATMAPS_RESULTS_BATCH_SIZE", 500)), 1)
+    for start in range(0, len(results), batch_size):
+        append_results(scenario, results[start : start + batch_size], replace=replace)
+
+
+def results_view_benchmarks(quick: bool) -> List[Benchmark]:
+    sizes = (1_000, 10_000) if quick else (1_000, 10_000, 100_000)
+    view = ScenarioResultsView.as_view()
+    factory = APIRequestFactory()
+    benchmarks = []
+    for size in sizes:
+        for fmt in ("json", "bin"):
+
+            def prepare(size=size, fmt=fmt):
+                scenario, _ = _scenario_fixture(size, store=True)
+
+                def run():
+                    request = factory.get(
+                        f"/api/scenarios/{scenario.pk}/results/", {"format": fmt}
+                    )
+                    response = view(request, scenario_id=scenario.pk)
+                    response.render()
+                    return len(response.content)
+
+                return run
+
+            benchmarks.append(
+                Benchmark(
+                    name="results.ScenarioResultsView",
+                    params={"cells": size, "targets": BENCHMARK_TARGETS, "format": fmt},
+                    items=size,
+                    prepare=prepare,
+                    uses_database=True,
+                )
+            )
+    return benchmarks
+
+
+def _scenario_fixture(num_cells: int, store: bool):
+    # A uniform scenario with about ``num_cells`` cells at 100 m.
+    resolution = 100
+    side_m = resolution * np.sqrt(num_cells)
+    scenario = Scenario.objects.create(
+        name=f"benchmark {num_cells}",
+        polygon_geojson=square_polygon(side_m),
+        grid_resolution_m=resolution,
+    )
+    ComputationResult.objects.create(scenario=scenario, status=ComputationResult.STATUS_DONE)
+    targets = synthetic_targets(side_m)
+    for target in targets:
+        target.scenario = scenario
+    TargetPoint.objects.bulk_create(targets)
+    cells = GridGenerator().generate_grid(scenario.polygon_geojson, resolution)[:num_cells]
+    results = synthetic_results(cells, targets)
+    if store:
+        save_results(scenario, results)
+    return scenario, results
+
+
+SUITES: Dict[str, Callable[[bool], List[Benchmark]]] = {
+    "grid": grid_benchmarks,
+    "compute": compute_benchmarks,
+    "aggregate": aggregate_benchmarks,
+    "storage": storage_benchmarks,
+    "results": results_view_benchmarks,
+}
+
+
+def collect_benchmarks(suites: Optional[Sequence[str]] = None, quick: bool = False) -> List[Benchmark]:
+    benchmarks = []
+    for suite in suites or SUITES:
+        if suite not in SUITES:
+            raise ValueError(f"Unknown benchmark suite {suite!r}.")
+        benchmarks.extend(SUITES[suite](quick))
+    return benchmarks
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int = 3, warmup: int = 1) -> dict:
+    call = benchmark.prepare()
+    timings = []
+    for iteration in range(warmup + repeat):
+        if benchmark.reset is not None:
+            benchmark.reset()
+        started = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - started
+        if iteration >= warmup:
+            timings.append(elapsed)
+    median = statistics.median(timings)
+    return {
+        "name": benchmark.key,
+        "benchmark": benchmark.name,
+        "params": benchmark.params,
+        "items": benchmark.items,
+        "repeat": repeat,
+        "timings_s": timings,
+        "min_s": min(timings),
+        "median_s": median,
+        "items_per_s": benchmark.items / median if median else None,
+    }
+
+
+def run_benchmarks(
+    benchmarks: Sequence[Benchmark],
+    repeat: int = 3,
+    warmup: int = 1,
+    quick: bool = False,
+    progress: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    results = []
+    for benchmark in benchmarks:
+        result = run_benchmark(benchmark, repeat=repeat, warmup=warmup)
+        results.append(result)
+        if progress is not None:
+            progress(result)
+    return {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "created_at": dt.datetime.now(tz=dt.timezone.utc).isoformat(),
+        "quick": quick,
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "database": settings.DATABASES["default"]["ENGINE"],
+        },
+        "benchmarks": results,
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = 0.1) -> List[dict]:
+    # Median time ratios against a previous report: above 1 + tolerance is a
+    # regression, below 1 / (1 + tolerance) an improvement.
+    previous = {result["name"]: result for result in baseline.get("benchmarks", [])}
+    comparison = []
+    for result in report["benchmarks"]:
+        before = previous.get(result["name"])
+        if before is None or not before.get("median_s"):
+            comparison.append({"name": result["name"], "status": "new", "ratio": None})
+            continue
+        ratio = result["median_s"] / before["median_s"]
+        if ratio > 1 + tolerance:
+            status = "regression"
+        elif ratio < 1 / (1 + tolerance):
+            status = "improvement"
+        else:
+            status = "unchanged"
+        comparison.append(
+            {
+                "name": result["name"],
+                "status": status,
+                "ratio": ratio,
+                "baseline_median_s": before["median_s"],
+                "median_s": result["median_s"],
+            }
+        )
+    return comparison
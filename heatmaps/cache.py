@@ -0,0 +1,180 @@
+import datetime as dt
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from heatmaps.models import TravelTimeCacheEntry
+
+# SQLite caps the number of bound parameters per statement.
+DB_BATCH_SIZE = 500
+
+
+class TravelTimeCache:
+    def __init__(
+        self,
+        max_memory_entries: int = 100_000,
+        max_db_entries: int = 5_000_000,
+        ttl_seconds: int = 7 * 24 * 3600,
+        snap_decimals: int = 4,
+        bucket_minutes: int = 15,
+        prune_interval: int = 10_000,
+    ) -> None:
+        self.max_memory_entries = max_memory_entries
+        self.max_db_entries = max_db_entries
+        self.ttl_seconds = ttl_seconds
+        self.snap_decimals = snap_decimals
+        self.bucket_minutes = bucket_minutes
+        self.prune_interval = prune_interval
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[Optional[int], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+
+    def make_key(
+        self,
+        origin,
+        destination,
+        departure_time: Optional[dt.datetime],
+        mode: str,
+    ) -> str:
+        return "|".join(
+            (
+                mode.lower(),
+                self._time_bucket(departure_time, mode),
+                self._snap(origin.lat, origin.lng),
+                self._snap(destination.lat, destination.lng),
+            )
+        )
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Optional[int]]:
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, Optional[int]] = {}
+        now = timezone.now().timestamp()
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is None:
+                    continue
+                value, stored_at = entry
+                if now - stored_at > self.ttl_seconds:
+                    del self._memory[key]
+                    continue
+                self._memory.move_to_end(key)
+                found[key] = value
+            self.memory_hits += len(found)
+
+        remaining = [key for key in keys if key not in found]
+        from_db: Dict[str, Tuple[Optional[int], float]] = {}
+        cutoff = timezone.now() - dt.timedelta(seconds=self.ttl_seconds)
+        for start in range(0, len(remaining), DB_BATCH_SIZE):
+            rows = TravelTimeCacheEntry.objects.filter(
+                key__in=remaining[start : start + DB_BATCH_SIZE],
+                created_at__gte=cutoff,
+            ).values_list("key", "duration_seconds", "created_at")
+            for key, duration, created_at in rows:
+                from_db[key] = (duration, created_at.timestamp())
+
+        with self._lock:
+            for key, (value, stored_at) in from_db.items():
+                self._remember(key, value, stored_at)
+                found[key] = value
+            self.db_hits += len(from_db)
+            self.misses += len(remaining) - len(from_db)
+        return found
+
+    def set_many(self, values: Dict[str, Optional[int]]) -> None:
+        if not values:
+            return
+        now = timezone.now()
+        with self._lock:
+            for key, value in values.items():
+                self._remember(key, value, now.timestamp())
+        entries = [
+            TravelTimeCacheEntry(key=key, duration_seconds=value, created_at=now)
+            for key, value in values.items()
+        ]
+        with transaction.atomic():
+            TravelTimeCacheEntry.objects.bulk_create(
+                entries,
+                batch_size=DB_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=["key"],
+                update_fields=["duration_seconds", "created_at"],
+            )
+        self._writes_since_prune += len(entries)
+        if self._writes_since_prune >= self.prune_interval:
+            self.prune()
+
+    def prune(self) -> int:
+        self._writes_since_prune = 0
+        cutoff = timezone.now() - dt.timedelta(seconds=self.ttl_seconds)
+        deleted, _ = TravelTimeCacheEntry.objects.filter(created_at__lt=cutoff).delete()
+        overflow = list(
+            TravelTimeCacheEntry.objects.order_by("-created_at").values_list(
+                "created_at", flat=True
+            )[self.max_db_entries : self.max_db_entries + 1]
+        )
+        if overflow:
+            evicted, _ = TravelTimeCacheEntry.objects.filter(
+                created_at__lte=overflow[0]
+            ).delete()
+            deleted += evicted
+        return deleted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        TravelTimeCacheEntry.objects.all().delete()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+            }
+
+    def _remember(self, key: str, value: Optional[int], stored_at: float) -> None:
+        self._memory[key] = (value, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _snap(self, lat: float, lng: float) -> str:
+        return f"{lat:.{self.snap_decimals}f},{lng:.{self.snap_decimals}f}"
+
+    def _time_bucket(self, departure_time: Optional[dt.datetime], mode: str) -> str:
+        if departure_time is None:
+            if mode != "transit":
+                return "any"
+            # The client departs "now" for transit, so bucket the current time.
+            departure_time = timezone.now()
+        bucket_seconds = self.bucket_minutes * 60
+        return str(int(departure_time.timestamp() // bucket_seconds))
+
+
+_default_cache: Optional[TravelTimeCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_travel_time_cache() -> TravelTimeCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TravelTimeCache(
+                max_memory_entries=getattr(
+                    settings, "HEATMAPS_CACHE_MAX_MEMORY_ENTRIES", 100_000
+                ),
+                max_db_entries=getattr(settings, "HEATMAPS_CACHE_MAX_DB_ENTRIES", 5_000_000),
+                ttl_seconds=getattr(settings, "HEATMAPS_CACHE_TTL_SECONDS", 7 * 24 * 3600),
+                snap_decimals=getattr(settings, "HEATMAPS_CACHE_SNAP_DECIMALS", 4),
+                bucket_minutes=getattr(settings, "HEATMAPS_CACHE_BUCKET_MINUTES", 15),
+            )
+        return _default_cache
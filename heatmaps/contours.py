@@ -0,0 +1,208 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.geometry import mapping
+from shapely.ops import transform as shapely_transform
+
+from heatmaps.models import IsochroneSet, Scenario
+from heatmaps.storage import lattice_frame, load_result_columns
+
+DEFAULT_THRESHOLDS_MINUTES = (15.0, 30.0, 45.0, 60.0)
+COORDINATE_DECIMALS = 6
+
+# Marching squares cases, indexed by the bit mask of corners that are inside
+# the isochrone (1 = bottom-left, 2 = bottom-right, 4 = top-right, 8 = top-left),
+# as pairs of crossed edges (0 = bottom, 1 = right, 2 = top, 3 = left).
+MARCHING_SQUARES_SEGMENTS = {
+    1: [(3, 0)],
+    2: [(0, 1)],
+    3: [(3, 1)],
+    4: [(1, 2)],
+    5: [(3, 0), (1, 2)],
+    6: [(0, 2)],
+    7: [(3, 2)],
+    8: [(2, 3)],
+    9: [(2, 0)],
+    10: [(0, 1), (2, 3)],
+    11: [(2, 1)],
+    12: [(1, 3)],
+    13: [(1, 0)],
+    14: [(0, 3)],
+}
+
+_to_mercator = Transformer.from_crs(4326, 3857, always_xy=True)
+_to_wgs = Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+def get_isochrones(scenario: Scenario, thresholds: Sequence[float]) -> dict:
+    thresholds = sorted(set(float(value) for value in thresholds))
+    key = ",".join(f"{value:g}" for value in thresholds)
+    finished_at = scenario.computation.finished_at
+    cached = IsochroneSet.objects.filter(scenario=scenario, thresholds=key).first()
+    if cached is not None and cached.finished_at == finished_at:
+        return cached.geojson
+    geojson = compute_isochrones(scenario, thresholds)
+    IsochroneSet.objects.update_or_create(
+        scenario=scenario,
+        thresholds=key,
+        defaults={"finished_at": finished_at, "geojson": geojson},
+    )
+    return geojson
+
+
+def compute_isochrones(scenario: Scenario, thresholds: Sequence[float]) -> dict:
+    columns = load_result_columns(scenario)
+    features = []
+    if len(columns["lat"]):
+        mx, my = _to_mercator.transform(columns["lng"], columns["lat"])
+        if scenario.grid_shape == Scenario.GRID_HEX:
+            raster, x0, y0, step = _rasterize_hex(
+                scenario, columns, np.asarray(mx), np.asarray(my)
+            )
+        else:
+            raster, x0, y0, step = _rasterize(
+                np.asarray(mx), np.asarray(my), columns["cell_size_m"], columns["time_minutes"]
+            )
+        for threshold in thresholds:
+            geometry = _contour_polygons(raster, x0, y0, step, threshold)
+            if geometry.is_empty:
+                continue
+            geometry = shapely_transform(_to_wgs.transform, geometry)
+            geometry = shapely.set_precision(geometry, 10**-COORDINATE_DECIMALS)
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": mapping(geometry),
+                    "properties": {"max_minutes": threshold},
+                }
+            )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def _rasterize(
+    mx: np.ndarray, my: np.ndarray, sizes: np.ndarray, minutes: np.ndarray
+) -> Tuple[np.ndarray, float, float, float]:
+    # One raster sample per smallest cell. The origin is aligned on the centre
+    # of a smallest cell, so every larger (quadtree) cell covers whole samples.
+    step = sizes.min()
+    reference = int(np.argmin(sizes))
+    margin = sizes.max() + step
+    x0 = mx[reference] - np.ceil((mx[reference] - mx.min() + margin) / step) * step
+    y0 = my[reference] - np.ceil((my[reference] - my.min() + margin) / step) * step
+    nx = int(np.ceil((mx.max() + margin - x0) / step)) + 1
+    ny = int(np.ceil((my.max() + margin - y0) / step)) + 1
+    raster = np.full((nx, ny), np.inf)
+
+    # Larger cells first so refined cells overwrite the area they cover.
+    order = np.argsort(-sizes, kind="stable")
+    mx, my, sizes, minutes = mx[order], my[order], sizes[order], minutes[order]
+    span = np.maximum(np.rint(sizes / step).astype(np.int64), 1)
+    ix0 = np.rint((mx - x0) / step - (span - 1) / 2).astype(np.int64)
+    iy0 = np.rint((my - y0) / step - (span - 1) / 2).astype(np.int64)
+    counts = span * span
+    cell = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ix = ix0[cell] + within % span[cell]
+    iy = iy0[cell] + within // span[cell]
+    raster[ix, iy] = np.where(np.isnan(minutes), np.inf, minutes)[cell]
+    return raster, x0, y0, step
+
+
+def _rasterize_hex(
+    scenario: Scenario, columns: dict, mx: np.ndarray, my: np.ndarray
+) -> Tuple[np.ndarray, float, float, float]:
+    # Hexagons do not cover whole raster samples, so sample a raster of half
+    # the smallest spacing and look up the cell under every node.
+    generator, origin = lattice_frame(scenario)
+    sizes = columns["cell_size_m"]
+    step = sizes.min() / 2
+    margin = sizes.max() + step
+    x0 = mx.min() - margin
+    y0 = my.min() - margin
+    nx = int(np.ceil((mx.max() + margin - x0) / step)) + 1
+    ny = int(np.ceil((my.max() + margin - y0) / step)) + 1
+    grid_x, grid_y = np.meshgrid(
+        x0 + np.arange(nx) * step, y0 + np.arange(ny) * step, indexing="ij"
+    )
+    cell_ids = generator.cell_ids(
+        columns["lat"], columns["lng"], origin, scenario.grid_resolution_m, sizes
+    )
+    index = generator.cell_index(cell_ids, grid_x, grid_y, origin, scenario.grid_resolution_m)
+    minutes = np.where(np.isnan(columns["time_minutes"]), np.inf, columns["time_minutes"])
+    return np.where(index >= 0, minutes[index], np.inf), x0, y0, step
+
+
+def _edge_fraction(start: np.ndarray, end: np.ndarray, threshold: float) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = (threshold - start) / (end - start)
+    # Cells without a time are +inf; cut those edges half way. Keep crossings
+    # off the nodes themselves so no node ends up on a contour.
+    fraction = np.where(np.isfinite(start) & np.isfinite(end), fraction, 0.5)
+    return np.clip(fraction, 1e-6, 1 - 1e-6)
+
+
+def _contour_polygons(
+    raster: np.ndarray, x0: float, y0: float, step: float, threshold: float
+):
+    inside = raster <= threshold
+    if not inside.any():
+        return shapely.Polygon()
+    xs = x0 + np.arange(raster.shape[0]) * step
+    ys = y0 + np.arange(raster.shape[1]) * step
+
+    # Crossing points are computed once per lattice edge so that neighbouring
+    # squares share bit-identical endpoints, which polygonize relies on.
+    horizontal_t = _edge_fraction(raster[:-1, :], raster[1:, :], threshold)
+    horizontal = np.stack(
+        [xs[:-1, None] + horizontal_t * step, np.broadcast_to(ys[None, :], horizontal_t.shape)],
+        axis=-1,
+    )
+    vertical_t = _edge_fraction(raster[:, :-1], raster[:, 1:], threshold)
+    vertical = np.stack(
+        [np.broadcast_to(xs[:, None], vertical_t.shape), ys[None, :-1] + vertical_t * step],
+        axis=-1,
+    )
+    edges = [
+        horizontal[:, :-1],  # bottom
+        vertical[1:, :],  # right
+        horizontal[:, 1:],  # top
+        vertical[:-1, :],  # left
+    ]
+    case = (
+        inside[:-1, :-1] * 1
+        + inside[1:, :-1] * 2
+        + inside[1:, 1:] * 4
+        + inside[:-1, 1:] * 8
+    )
+    segments: List[np.ndarray] = []
+    for mask_value, pairs in MARCHING_SQUARES_SEGMENTS.items():
+        selected = case == mask_value
+        if not selected.any():
+            continue
+        for start_edge, end_edge in pairs:
+            segments.append(
+                np.stack([edges[start_edge][selected], edges[end_edge][selected]], axis=1)
+            )
+    if not segments:
+        return shapely.Polygon()
+    lines = shapely.linestrings(np.concatenate(segments))
+    faces = shapely.get_parts(shapely.polygonize(lines))
+    if not len(faces):
+        return shapely.Polygon()
+
+    # polygonize returns every face, including holes; every face contains at
+    # least one lattice node, so keep the faces holding an inside node.
+    node_x, node_y = np.nonzero(inside)
+    tree = shapely.STRtree(faces)
+    _, face_index = tree.query(
+        shapely.points(xs[node_x], ys[node_y]), predicate="within"
+    )
+    kept = faces[np.unique(face_index)]
+    if not len(kept):
+        return shapely.Polygon()
+    merged = shapely.union_all(kept)
+    # Within an eighth of a cell: only nodes that close to the threshold
+    # crossing can end up on the other side of the contour.
+    return merged.simplify(step / 8, preserve_topology=True)
@@ -0,0 +1,522 @@
+import csv
+import datetime as dt
+import io
+import threading
+import zipfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import shapely
+from django.conf import settings
+
+from heatmaps.models import TargetPoint
+from heatmaps.routing import AsyncRoutingMixin
+
+EARTH_RADIUS_M = 6_371_008.8
+SECONDS_PER_DAY = 24 * 3600
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+# Parsed timetables kept in memory (one per feed file and service date).
+MAX_CACHED_TIMETABLES = 4
+
+
+@dataclass
+class Pattern:
+    # Trips serving the same stop sequence, sorted so that no trip overtakes
+    # another: every column of ``departures`` is non-decreasing, which lets
+    # RAPTOR find the earliest catchable trip with a binary search.
+    stops: np.ndarray
+    departures: np.ndarray
+    arrivals: np.ndarray
+
+
+@dataclass
+class Timetable:
+    # Times are seconds since midnight of the service date; trips of the
+    # previous service date still running after midnight are included.
+    timezone: ZoneInfo
+    stop_x: np.ndarray
+    stop_y: np.ndarray
+    patterns: List[Pattern]
+    # CSR adjacency: the (pattern, position) pairs serving each stop and the
+    # walking transfers leaving it.
+    stop_pattern_ptr: np.ndarray
+    stop_pattern_ids: np.ndarray
+    stop_pattern_positions: np.ndarray
+    transfer_ptr: np.ndarray
+    transfer_to: np.ndarray
+    transfer_seconds: np.ndarray
+    reference_lat: float
+
+    @property
+    def num_stops(self) -> int:
+        return len(self.stop_x)
+
+    def project(self, lats: np.ndarray, lngs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return _local_xy(lats, lngs, self.reference_lat)
+
+
+class GtfsTransitRouter(AsyncRoutingMixin):
+    # Offline transit routing on a GTFS feed (directory or zip) with a
+    # vectorised RAPTOR: every origin of a matrix is its own source, so one
+    # pass over the timetable fills the whole origins x destinations block.
+    is_local = True
+
+    def __init__(
+        self,
+        feed_path: Optional[str] = None,
+        max_walk_m: Optional[float] = None,
+        max_transfer_walk_m: Optional[float] = None,
+        walk_speed_mps: Optional[float] = None,
+        max_rounds: Optional[int] = None,
+        max_duration_minutes: Optional[float] = None,
+        matrix_batch_size: Optional[int] = None,
+        pool_size: Optional[int] = None,
+    ) -> None:
+        # pool_size is accepted for get_routing_backend; routing is in-process.
+        self.feed_path = feed_path or getattr(settings, "HEATMAPS_GTFS_FEED_PATH", "")
+        if not self.feed_path:
+            raise RuntimeError("Missing HEATMAPS_GTFS_FEED_PATH for the GTFS router.")
+        self.max_walk_m = float(
+            max_walk_m or getattr(settings, "HEATMAPS_GTFS_MAX_WALK_M", 800)
+        )
+        self.max_transfer_walk_m = float(
+            max_transfer_walk_m or getattr(settings, "HEATMAPS_GTFS_MAX_TRANSFER_WALK_M", 400)
+        )
+        self.walk_speed_mps = float(
+            walk_speed_mps or getattr(settings, "HEATMAPS_GTFS_WALK_SPEED_MPS", 1.25)
+        )
+        self.max_rounds = int(max_rounds or getattr(settings, "HEATMAPS_GTFS_MAX_ROUNDS", 6))
+        self.max_duration_seconds = 60 * float(
+            max_duration_minutes or getattr(settings, "HEATMAPS_GTFS_MAX_DURATION_MINUTES", 180)
+        )
+        # Origins per get_duration_matrix call made by compute_times.
+        self.matrix_batch_size = int(
+            matrix_batch_size or getattr(settings, "HEATMAPS_GTFS_ORIGIN_BATCH_SIZE", 512)
+        )
+
+    def get_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]:
+        return self.get_duration_matrix([origin], [destination], departure_time, mode)[0][0]
+
+    def get_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]:
+        if mode != "transit":
+            raise RuntimeError(f"The GTFS router does not support mode {mode!r}.")
+        if not origins or not destinations:
+            return [[None] * len(destinations) for _ in origins]
+        timezone = feed_timezone(self.feed_path)
+        if departure_time is None:
+            departure_time = dt.datetime.now(tz=timezone)
+        elif departure_time.tzinfo is None:
+            departure_time = departure_time.replace(tzinfo=timezone)
+        local = departure_time.astimezone(timezone)
+        timetable = get_timetable(
+            self.feed_path, local.date(), self.max_transfer_walk_m, self.walk_speed_mps
+        )
+        start = local.hour * 3600 + local.minute * 60 + local.second
+        arrivals = self._earliest_arrivals(timetable, origins, destinations, start)
+        durations = arrivals - start
+        return [
+            [
+                int(round(value)) if value <= self.max_duration_seconds else None
+                for value in row
+            ]
+            for row in durations.tolist()
+        ]
+
+    def _earliest_arrivals(
+        self, timetable: Timetable, origins: Sequence, destinations: Sequence, start: int
+    ) -> np.ndarray:
+        origin_x, origin_y = timetable.project(
+            np.array([origin.lat for origin in origins], dtype=float),
+            np.array([origin.lng for origin in origins], dtype=float),
+        )
+        target_x, target_y = timetable.project(
+            np.array([target.lat for target in destinations], dtype=float),
+            np.array([target.lng for target in destinations], dtype=float),
+        )
+        horizon = start + self.max_duration_seconds
+        stop_index, origin_index, distance = _pairs_within(
+            timetable.stop_x, timetable.stop_y, origin_x, origin_y, self.max_walk_m
+        )
+        labels = raptor(
+            timetable,
+            len(origins),
+            origin_index,
+            stop_index,
+            start + distance / self.walk_speed_mps,
+            self.max_rounds,
+            horizon,
+        )
+
+        # Walk straight to the destination, or ride and walk from a stop
+        # near it, whichever arrives first.
+        direct = np.hypot(
+            origin_x[:, None] - target_x[None, :], origin_y[:, None] - target_y[None, :]
+        )
+        arrivals = start + direct / self.walk_speed_mps
+        stop_index, target_index, distance = _pairs_within(
+            timetable.stop_x, timetable.stop_y, target_x, target_y, self.max_walk_m
+        )
+        egress = labels[stop_index] + (distance / self.walk_speed_mps)[:, None]
+        for column in range(len(destinations)):
+            selected = target_index == column
+            if selected.any():
+                arrivals[:, column] = np.minimum(
+                    arrivals[:, column], egress[selected].min(axis=0)
+                )
+        return arrivals
+
+
+def raptor(
+    timetable: Timetable,
+    num_origins: int,
+    access_origins: np.ndarray,
+    access_stops: np.ndarray,
+    access_arrivals: np.ndarray,
+    max_rounds: int,
+    horizon: float,
+) -> np.ndarray:
+    # Earliest arrival at every stop (stops x origins, +inf when unreached)
+    # with at most ``max_rounds`` trips. Each round scans the patterns
+    # through the stops improved by the previous one, with all origins
+    # carried side by side in the columns, then relaxes walking transfers.
+    best = np.full((timetable.num_stops, num_origins), np.inf)
+    np.minimum.at(best, (access_stops, access_origins), access_arrivals)
+    marked = np.zeros(timetable.num_stops, dtype=bool)
+    marked[access_stops] = True
+    for _ in range(max_rounds):
+        if not marked.any():
+            break
+        boarding = best.copy()
+        ridden = np.full_like(best, np.inf)
+        queue: Dict[int, int] = {}
+        for stop in np.flatnonzero(marked).tolist():
+            lo, hi = timetable.stop_pattern_ptr[stop], timetable.stop_pattern_ptr[stop + 1]
+            for pattern, position in zip(
+                timetable.stop_pattern_ids[lo:hi].tolist(),
+                timetable.stop_pattern_positions[lo:hi].tolist(),
+            ):
+                if position < queue.get(pattern, position + 1):
+                    queue[pattern] = position
+        marked[:] = False
+        for pattern, first in queue.items():
+            _scan_pattern(
+                timetable.patterns[pattern], first, boarding, best, ridden, marked, horizon
+            )
+        # Walk on from the vehicle arrivals of this round only: a label that
+        # was itself reached on foot never starts another transfer.
+        for stop in np.flatnonzero(marked).tolist():
+            lo, hi = timetable.transfer_ptr[stop], timetable.transfer_ptr[stop + 1]
+            if lo == hi:
+                continue
+            to = timetable.transfer_to[lo:hi]
+            walked = ridden[stop][None, :] + timetable.transfer_seconds[lo:hi, None]
+            better = walked < best[to]
+            if better.any():
+                best[to] = np.where(better, walked, best[to])
+                marked[to[better.any(axis=1)]] = True
+    return best
+
+
+def _scan_pattern(
+    pattern: Pattern,
+    first: int,
+    boarding: np.ndarray,
+    best: np.ndarray,
+    ridden: np.ndarray,
+    marked: np.ndarray,
+    horizon: float,
+) -> None:
+    num_trips = len(pattern.departures)
+    trip: Optional[np.ndarray] = None
+    for position in range(first, len(pattern.stops)):
+        stop = pattern.stops[position]
+        if trip is not None:
+            riding = trip >= 0
+            arrival = np.where(
+                riding, pattern.arrivals[np.maximum(trip, 0), position], np.inf
+            )
+            better = (arrival < best[stop]) & (arrival <= horizon)
+            if better.any():
+                best[stop] = np.where(better, arrival, best[stop])
+                ridden[stop] = np.where(better, arrival, ridden[stop])
+                marked[stop] = True
+        if position == len(pattern.stops) - 1:
+            break
+        ready = boarding[stop]
+        if not (ready < horizon).any():
+            continue
+        # Earliest trip leaving this stop once the origin is there; origins
+        # already on an earlier trip stay on it.
+        catchable = np.searchsorted(pattern.departures[:, position], ready)
+        catchable = np.where(catchable < num_trips, catchable, -1)
+        if trip is None:
+            trip = catchable
+        else:
+            trip = np.where(
+                (catchable >= 0) & ((trip < 0) | (catchable < trip)), catchable, trip
+            )
+
+
+def get_timetable(
+    feed_path: str, service_date: dt.date, max_transfer_walk_m: float, walk_speed_mps: float
+) -> Timetable:
+    path = Path(feed_path)
+    key = (str(path.resolve()), path.stat().st_mtime, service_date, max_transfer_walk_m, walk_speed_mps)
+    with _timetables_lock:
+        timetable = _timetables.get(key)
+        if timetable is None:
+            timetable = build_timetable(path, service_date, max_transfer_walk_m, walk_speed_mps)
+            _timetables[key] = timetable
+            while len(_timetables) > MAX_CACHED_TIMETABLES:
+                _timetables.popitem(last=False)
+        else:
+            _timetables.move_to_end(key)
+        return timetable
+
+
+_timetables: "OrderedDict[tuple, Timetable]" = OrderedDict()
+_timetables_lock = threading.Lock()
+
+
+def feed_timezone(feed_path: str) -> ZoneInfo:
+    for row in _read_table(Path(feed_path), "agency.txt", required=False):
+        if row.get("agency_timezone"):
+            return ZoneInfo(row["agency_timezone"].strip())
+    return ZoneInfo(settings.TIME_ZONE)
+
+
+def build_timetable(
+    path: Path, service_date: dt.date, max_transfer_walk_m: float, walk_speed_mps: float
+) -> Timetable:
+    stop_ids: Dict[str, int] = {}
+    lats: List[float] = []
+    lngs: List[float] = []
+    for row in _read_table(path, "stops.txt"):
+        if not row.get("stop_lat") or not row.get("stop_lon"):
+            continue
+        stop_ids[row["stop_id"]] = len(lats)
+        lats.append(float(row["stop_lat"]))
+        lngs.append(float(row["stop_lon"]))
+    reference_lat = float(np.mean(lats)) if lats else 0.0
+    stop_x, stop_y = _local_xy(np.array(lats), np.array(lngs), reference_lat)
+
+    # Day offsets of every trip: its own service date, or the previous one
+    # for trips still running after midnight.
+    offsets = {
+        0: _active_services(path, service_date),
+        -SECONDS_PER_DAY: _active_services(path, service_date - dt.timedelta(days=1)),
+    }
+    trip_offsets: Dict[str, List[int]] = {}
+    for row in _read_table(path, "trips.txt"):
+        active = [offset for offset, services in offsets.items() if row["service_id"] in services]
+        if active:
+            trip_offsets[row["trip_id"]] = active
+
+    groups: Dict[Tuple[int, ...], List[Tuple[np.ndarray, np.ndarray]]] = {}
+    for trip_id, stops, arrivals, departures in _trip_stop_times(path, stop_ids, trip_offsets):
+        for offset in trip_offsets[trip_id]:
+            if arrivals[-1] + offset < 0:
+                continue
+            groups.setdefault(tuple(stops), []).append(
+                (departures + offset, arrivals + offset)
+            )
+
+    patterns: List[Pattern] = []
+    for stops, trips in groups.items():
+        trips.sort(key=lambda trip: trip[0][0])
+        # Split overtaking trips into separate patterns (first fit).
+        lanes: List[List[Tuple[np.ndarray, np.ndarray]]] = []
+        for trip in trips:
+            for lane in lanes:
+                if (lane[-1][0] <= trip[0]).all() and (lane[-1][1] <= trip[1]).all():
+                    lane.append(trip)
+                    break
+            else:
+                lanes.append([trip])
+        for lane in lanes:
+            patterns.append(
+                Pattern(
+                    stops=np.array(stops, dtype=np.int64),
+                    departures=np.array([trip[0] for trip in lane], dtype=np.int64),
+                    arrivals=np.array([trip[1] for trip in lane], dtype=np.int64),
+                )
+            )
+
+    stop_pattern_ptr, (stop_pattern_ids, stop_pattern_positions) = _csr(
+        len(lats),
+        np.concatenate([pattern.stops for pattern in patterns]) if patterns else np.empty(0, int),
+        np.concatenate(
+            [np.full(len(pattern.stops), index) for index, pattern in enumerate(patterns)]
+        )
+        if patterns
+        else np.empty(0, int),
+        np.concatenate([np.arange(len(pattern.stops)) for pattern in patterns])
+        if patterns
+        else np.empty(0, int),
+    )
+    source, target, distance = _pairs_within(
+        stop_x, stop_y, stop_x, stop_y, max_transfer_walk_m
+    )
+    keep = source != target
+    transfer_ptr, (transfer_to, transfer_seconds) = _csr(
+        len(lats), target[keep], source[keep], distance[keep] / walk_speed_mps
+    )
+    return Timetable(
+        timezone=feed_timezone(str(path)),
+        stop_x=stop_x,
+        stop_y=stop_y,
+        patterns=patterns,
+        stop_pattern_ptr=stop_pattern_ptr,
+        stop_pattern_ids=stop_pattern_ids,
+        stop_pattern_positions=stop_pattern_positions,
+        transfer_ptr=transfer_ptr,
+        transfer_to=transfer_to,
+        transfer_seconds=transfer_seconds,
+        reference_lat=reference_lat,
+    )
+
+
+def _trip_stop_times(
+    path: Path, stop_ids: Dict[str, int], trip_offsets: Dict[str, List[int]]
+) -> Iterator[Tuple[str, List[int], np.ndarray, np.ndarray]]:
+    rows: Dict[str, List[Tuple[int, int, Optional[int], Optional[int]]]] = {}
+    with _open_table(path, "stop_times.txt") as handle:
+        reader = csv.reader(handle)
+        header = [name.strip() for name in next(reader)]
+        trip_col = header.index("trip_id")
+        stop_col = header.index("stop_id")
+        sequence_col = header.index("stop_sequence")
+        arrival_col = header.index("arrival_time")
+        departure_col = header.index("departure_time")
+        for record in reader:
+            trip_id = record[trip_col]
+            if trip_id not in trip_offsets or record[stop_col] not in stop_ids:
+                continue
+            rows.setdefault(trip_id, []).append(
+                (
+                    int(record[sequence_col]),
+                    stop_ids[record[stop_col]],
+                    _parse_time(record[arrival_col]),
+                    _parse_time(record[departure_col]),
+                )
+            )
+    for trip_id, stop_times in rows.items():
+        stop_times.sort()
+        if len(stop_times) < 2:
+            continue
+        arrivals = _fill_times([row[2] if row[2] is not None else row[3] for row in stop_times])
+        departures = _fill_times([row[3] if row[3] is not None else row[2] for row in stop_times])
+        if arrivals is None or departures is None:
+            continue
+        yield trip_id, [row[1] for row in stop_times], arrivals, departures
+
+
+def _fill_times(values: List[Optional[int]]) -> Optional[np.ndarray]:
+    # Stops without a time (non-timepoints) are interpolated by position.
+    times = np.array([np.nan if value is None else value for value in values], dtype=float)
+    known = ~np.isnan(times)
+    if not known[0] or not known[-1]:
+        return None
+    positions = np.arange(len(times))
+    return np.rint(np.interp(positions, positions[known], times[known])).astype(np.int64)
+
+
+def _active_services(path: Path, day: dt.date) -> set:
+    services = set()
+    stamp = day.strftime("%Y%m%d")
+    weekday = WEEKDAYS[day.weekday()]
+    for row in _read_table(path, "calendar.txt", required=False):
+        if row["start_date"] <= stamp <= row["end_date"] and row[weekday].strip() == "1":
+            services.add(row["service_id"])
+    for row in _read_table(path, "calendar_dates.txt", required=False):
+        if row["date"] != stamp:
+            continue
+        if row["exception_type"].strip() == "1":
+            services.add(row["service_id"])
+        else:
+            services.discard(row["service_id"])
+    return services
+
+
+def _parse_time(value: str) -> Optional[int]:
+    # GTFS times may exceed 24:00:00 for trips running past midnight.
+    value = value.strip()
+    if not value:
+        return None
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _local_xy(
+    lats: np.ndarray, lngs: np.ndarray, reference_lat: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Equirectangular metres around the feed: accurate to well under 1% over
+    # a city, which is plenty for walking legs.
+    scale = np.pi / 180 * EARTH_RADIUS_M
+    return (
+        np.asarray(lngs, dtype=float) * scale * np.cos(np.radians(reference_lat)),
+        np.asarray(lats, dtype=float) * scale,
+    )
+
+
+def _pairs_within(
+    xs: np.ndarray, ys: np.ndarray, query_x: np.ndarray, query_y: np.ndarray, distance: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (point index, query index, distance) of every point within ``distance``
+    # of a query point.
+    if not len(xs) or not len(query_x):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+    tree = shapely.STRtree(shapely.points(xs, ys))
+    query_index, point_index = tree.query(
+        shapely.points(query_x, query_y), predicate="dwithin", distance=distance
+    )
+    gaps = np.hypot(xs[point_index] - query_x[query_index], ys[point_index] - query_y[query_index])
+    return point_index, query_index, gaps
+
+
+def _csr(size: int, keys: np.ndarray, *columns: np.ndarray) -> Tuple[np.ndarray, tuple]:
+    order = np.argsort(keys, kind="stable")
+    pointers = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(pointers, np.asarray(keys, dtype=np.int64) + 1, 1)
+    return np.cumsum(pointers), tuple(np.asarray(column)[order] for column in columns)
+
+
+def _read_table(path: Path, name: str, required: bool = True) -> List[Dict[str, str]]:
+    try:
+        with _open_table(path, name) as handle:
+            return [
+                {key.strip(): value for key, value in row.items() if key is not None}
+                for row in csv.DictReader(handle)
+            ]
+    except FileNotFoundError:
+        if required:
+            raise
+        return []
+
+
+def _open_table(path: Path, name: str):
+    if path.is_dir():
+        return open(path / name, encoding="utf-8-sig", newline="")
+    with zipfile.ZipFile(path) as archive:
+        try:
+            data = archive.read(name)
+        except KeyError:
+            raise FileNotFoundError(f"{name} not found in {path}") from None
+    return io.StringIO(data.decode("utf-8-sig"), newline="")
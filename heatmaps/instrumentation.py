@@ -0,0 +1,317 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from django.db.models import Count
+
+from heatmaps.models import ComputationResult
+from heatmaps.routing import RoutingBackendError
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+ROUTING_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+# Stages timed by the run pipeline, in pipeline order.
+STAGES = ("grid", "routing", "aggregation", "persistence")
+# Per-run counters, stored on ComputationResult under the same names.
+RUN_COUNTERS = (
+    "api_calls",
+    "api_elements",
+    "api_errors",
+    "api_retries",
+    "cache_hits",
+    "cache_misses",
+)
+
+
+class Metric:
+    # A labelled Prometheus metric (counter or histogram) kept in memory;
+    # the registry renders every metric in the text exposition format.
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [0.0]
+            self._values[key][0] += amount
+
+    def observe(self, value: float, **labels: str) -> None:
+        # Histogram layout: per-bucket counts (the last is +Inf), then sum.
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series = self._values[key]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, series in values:
+            labels = list(zip(self.labels, key))
+            if self.kind == "counter":
+                lines.append(f"{self.name}{_labels(labels)} {_number(series[0])}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(labels)} {cumulative}")
+        return lines
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Metric:
+        return self._register(Metric(name, documentation, "counter", labels))
+
+    def histogram(
+        self, name: str, documentation: str, labels: Sequence[str], buckets: Sequence[float]
+    ) -> Metric:
+        return self._register(Metric(name, documentation, "histogram", labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.histogram(
+    "heatmaps_stage_duration_seconds",
+    "Time spent per pipeline stage.",
+    ["stage"],
+    STAGE_DURATION_BUCKETS,
+)
+ROUTING_CALL_SECONDS = registry.histogram(
+    "heatmaps_routing_call_duration_seconds",
+    "Latency of routing backend calls.",
+    ["backend", "call"],
+    ROUTING_LATENCY_BUCKETS,
+)
+ROUTING_CALLS = registry.counter(
+    "heatmaps_routing_calls_total", "Routing backend calls.", ["backend", "call", "outcome"]
+)
+ROUTING_ELEMENTS = registry.counter(
+    "heatmaps_routing_elements_total", "Origin x destination pairs requested.", ["backend"]
+)
+ROUTING_ERRORS = registry.counter(
+    "heatmaps_routing_errors_total", "Failed routing calls by status code.", ["backend", "status"]
+)
+ROUTING_RETRIES = registry.counter(
+    "heatmaps_routing_retries_total", "Routing calls retried after a failure.", ["backend"]
+)
+CACHE_LOOKUPS = registry.counter(
+    "heatmaps_cache_lookups_total", "Travel-time cache lookups.", ["result"]
+)
+RUNS = registry.counter("heatmaps_runs_total", "Finished heatmap runs.", ["status"])
+CELLS = registry.counter("heatmaps_cells_computed_total", "Cells computed by heatmap runs.")
+
+
+class RunMetrics:
+    # Counters and stage timings of one run, shared by the worker threads of
+    # compute_times; jobs stores them on the ComputationResult.
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = {name: 0 for name in RUN_COUNTERS}
+        self.stage_seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def merge(self, fields: dict) -> None:
+        # Adds counters saved with as_fields (another chunk or attempt).
+        with self._lock:
+            for name in RUN_COUNTERS:
+                self.counters[name] += int(fields.get(name) or 0)
+            for name, seconds in (fields.get("stage_seconds") or {}).items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    def as_fields(self) -> dict:
+        with self._lock:
+            return {
+                **self.counters,
+                "stage_seconds": {
+                    stage: round(seconds, 6) for stage, seconds in self.stage_seconds.items()
+                },
+            }
+
+
+@contextmanager
+def stage(name: str, metrics: Optional[RunMetrics] = None, **fields) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if metrics is not None:
+            metrics.add_stage(name, elapsed)
+        logger.debug(
+            "stage=%s duration_ms=%.1f%s",
+            name,
+            elapsed * 1000,
+            "".join(f" {key}={value}" for key, value in fields.items()),
+            extra={"stage": name, "duration_s": elapsed, **fields},
+        )
+
+
+def record_cache_lookups(hits: int, misses: int, metrics: Optional[RunMetrics] = None) -> None:
+    CACHE_LOOKUPS.inc(hits, result="hit")
+    CACHE_LOOKUPS.inc(misses, result="miss")
+    if metrics is not None:
+        metrics.add("cache_hits", hits)
+        metrics.add("cache_misses", misses)
+
+
+class InstrumentedBackend:
+    # Wraps a routing backend to time every call and count calls, requested
+    # elements and errors, globally and for the run. Other attributes
+    # (is_local, matrix_batch_size, ...) pass through.
+    def __init__(self, backend, metrics: Optional[RunMetrics] = None) -> None:
+        self.backend = backend
+        self.metrics = metrics
+        self.backend_name = type(backend).__name__
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_transit_duration_seconds(self, origin, destination, departure_time=None, mode="transit"):
+        return self._call(
+            "pair",
+            1,
+            self.backend.get_transit_duration_seconds,
+            origin,
+            destination,
+            departure_time,
+            mode,
+        )
+
+    def get_duration_matrix(self, origins, destinations, departure_time=None, mode="transit"):
+        return self._call(
+            "matrix",
+            len(origins) * len(destinations),
+            self.backend.get_duration_matrix,
+            origins,
+            destinations,
+            departure_time,
+            mode,
+        )
+
+    def record_retry(self) -> None:
+        ROUTING_RETRIES.inc(backend=self.backend_name)
+        if self.metrics is not None:
+            self.metrics.add("api_retries")
+
+    def _call(self, call: str, elements: int, method, *args):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return method(*args)
+        except Exception as exc:
+            outcome = "error"
+            status = getattr(exc, "status_code", None) if isinstance(exc, RoutingBackendError) else None
+            ROUTING_ERRORS.inc(backend=self.backend_name, status=status or "none")
+            if self.metrics is not None:
+                self.metrics.add("api_errors")
+            raise
+        finally:
+            ROUTING_CALL_SECONDS.observe(
+                time.perf_counter() - started, backend=self.backend_name, call=call
+            )
+            ROUTING_CALLS.inc(backend=self.backend_name, call=call, outcome=outcome)
+            ROUTING_ELEMENTS.inc(elements, backend=self.backend_name)
+            if self.metrics is not None:
+                self.metrics.add("api_calls")
+                self.metrics.add("api_elements", elements)
+
+
+def render_metrics() -> str:
+    # Process-local metrics, plus the computation queue as seen in the
+    # database (shared by the web and worker processes).
+    lines = [
+        "# HELP heatmaps_computations Heatmap computations by status.",
+        "# TYPE heatmaps_computations gauge",
+    ]
+    counts = dict(
+        ComputationResult.objects.values_list("status").annotate(count=Count("pk"))
+    )
+    for status, _ in ComputationResult.STATUS_CHOICES:
+        lines.append(f"heatmaps_computations{_labels([('status', status)])} {counts.get(status, 0)}")
+    return registry.render() + "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    # Serves /metrics from a background thread, for processes without the
+    # web app (heatmap workers).
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,705 @@
+import datetime as dt
+import logging
+import os
+import socket
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from heatmaps.instrumentation import CELLS, RUN_COUNTERS, RUNS, RunMetrics, stage
+from heatmaps.models import ComputationChunk, ComputationResult, Scenario
+from heatmaps.resilience import CallBudget, RoutingBudgetExceeded
+from heatmaps.sampling import compute_adaptive_times, compute_budgeted_times
+from heatmaps.services import Cell, GridGenerator, estimate_api_calls, iter_compute_times
+from heatmaps.storage import (
+    append_results,
+    clear_results,
+    delete_stale_cells,
+    load_stored_durations,
+    pack_cell_rows,
+    prepare_incremental_results,
+    save_results,
+    scenario_cell_ids,
+    uses_array_storage,
+)
+from heatmaps.tiles import invalidate_tile_cache
+
+# Minimum time between two progress writes while a run is in flight.
+PROGRESS_SAVE_INTERVAL_SECONDS = 2.0
+# ComputationResult fields holding the RunMetrics of the last run.
+RUN_METRIC_FIELDS = (*RUN_COUNTERS, "stage_seconds")
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class ProgressReporter:
+    def __init__(
+        self, computation: ComputationResult, metrics: Optional[RunMetrics] = None
+    ) -> None:
+        self.computation = computation
+        self.metrics = metrics
+        self._started = time.monotonic()
+        self._last_saved = 0.0
+
+    def __call__(self, cells_done: int, cells_total: int) -> None:
+        now = time.monotonic()
+        if cells_done < cells_total and now - self._last_saved < PROGRESS_SAVE_INTERVAL_SECONDS:
+            return
+        self._last_saved = now
+        computation = self.computation
+        computation.cells_done = cells_done
+        computation.cells_total = cells_total
+        if cells_done:
+            elapsed = now - self._started
+            remaining = elapsed / cells_done * (cells_total - cells_done)
+            computation.estimated_finished_at = timezone.now() + dt.timedelta(
+                seconds=remaining
+            )
+        computation.save(
+            update_fields=[
+                "cells_done",
+                "cells_total",
+                "estimated_finished_at",
+                *_apply_run_metrics(computation, self.metrics),
+            ]
+        )
+
+
+class ChunkLease:
+    # Progress callback of a chunk run. A heartbeat thread renews the lease
+    # and saves the chunk's progress and counters; once the lease is lost
+    # (it expired and another worker took the chunk, or the run failed) the
+    # next progress report raises LeaseLost.
+    def __init__(self, chunk: ComputationChunk, owner: str, metrics: RunMetrics) -> None:
+        self.chunk = chunk
+        self.owner = owner
+        self.metrics = metrics
+        self.cells_done = 0
+        self.cells_saved = 0
+        self.lost = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def __enter__(self) -> "ChunkLease":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def __call__(self, cells_done: int, cells_total: int) -> None:
+        self.cells_done = cells_done
+        self.check()
+
+    def saved(self, cells: int) -> None:
+        self.cells_saved += cells
+        self.check()
+
+    def check(self) -> None:
+        if self.lost:
+            raise LeaseLost(f"Lost the lease on chunk {self.chunk.index}.")
+
+    def renew(self, **fields) -> None:
+        with self._lock:
+            updated = ComputationChunk.objects.filter(
+                pk=self.chunk.pk,
+                status=ComputationChunk.STATUS_LEASED,
+                lease_owner=self.owner,
+                computation__status=ComputationResult.STATUS_RUNNING,
+            ).update(
+                **{
+                    "lease_expires_at": timezone.now() + dt.timedelta(seconds=_lease_seconds()),
+                    "cells_done": self.cells_done,
+                    "cells_saved": self.cells_saved,
+                    "metrics": self.metrics.as_fields(),
+                    **fields,
+                }
+            )
+            if not updated:
+                self.lost = True
+        self.check()
+        sync_computation_progress(self.chunk.computation_id)
+
+    def _heartbeat(self) -> None:
+        interval = min(PROGRESS_SAVE_INTERVAL_SECONDS, _lease_seconds() / 3)
+        try:
+            while not self._stopped.wait(interval):
+                try:
+                    self.renew()
+                except LeaseLost:
+                    return
+                except Exception:  # noqa: BLE001
+                    # A failed renewal (e.g. the database is locked or went
+                    # away) is retried on the next beat; once the lease has
+                    # expired and another worker took the chunk, renew()
+                    # reports it as lost.
+                    logger.exception(
+                        "Could not renew the lease on chunk %s", self.chunk.index
+                    )
+                    connection.close()
+        finally:
+            connection.close()
+
+
+def _lease_seconds() -> float:
+    return float(getattr(settings, "HEATMAPS_CHUNK_LEASE_SECONDS", 60))
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _apply_run_metrics(computation: ComputationResult, metrics: Optional[RunMetrics]) -> list:
+    # Copies the run's counters onto the computation; returns the fields to save.
+    if metrics is None:
+        return []
+    for name, value in metrics.as_fields().items():
+        setattr(computation, name, value)
+    return list(RUN_METRIC_FIELDS)
+
+
+def enqueue_computation(scenario: Scenario, resume: bool = False) -> ComputationResult:
+    computation = scenario.computation
+    computation.status = ComputationResult.STATUS_QUEUED
+    computation.resume = resume
+    computation.cells_saved = 0
+    computation.cells_reused = 0
+    computation.queued_at = timezone.now()
+    computation.started_at = None
+    computation.finished_at = None
+    computation.cells_done = 0
+    computation.cells_total = 0
+    computation.estimated_finished_at = None
+    computation.error_message = ""
+    for name in RUN_COUNTERS:
+        setattr(computation, name, 0)
+    computation.stage_seconds = {}
+    with transaction.atomic():
+        computation.chunks.all().delete()
+        computation.save(
+            update_fields=[
+                "status",
+                "queued_at",
+                "started_at",
+                "finished_at",
+                "cells_done",
+                "cells_total",
+                "estimated_finished_at",
+                "error_message",
+                "resume",
+                "cells_saved",
+                "cells_reused",
+                *RUN_METRIC_FIELDS,
+            ]
+        )
+    return computation
+
+
+def claim_next_computation() -> Optional[ComputationResult]:
+    # Compare-and-set on the status column so that concurrent workers never
+    # pick up the same job, without relying on SELECT ... FOR UPDATE. Uniform
+    # runs still without chunks a lease after they started lost the worker
+    # planning them and are claimed again.
+    while True:
+        stalled_before = timezone.now() - dt.timedelta(seconds=_lease_seconds())
+        candidate = (
+            ComputationResult.objects.filter(
+                Q(status=ComputationResult.STATUS_QUEUED)
+                | Q(
+                    status=ComputationResult.STATUS_RUNNING,
+                    scenario__sampling_mode=Scenario.SAMPLING_UNIFORM,
+                    started_at__lt=stalled_before,
+                    finished_at__isnull=True,
+                    chunks__isnull=True,
+                )
+            )
+            .order_by("queued_at", "pk")
+            .values_list("pk", "status", "started_at")
+            .first()
+        )
+        if candidate is None:
+            return None
+        pk, status, started_at = candidate
+        claimed = ComputationResult.objects.filter(
+            pk=pk, status=status, started_at=started_at
+        ).update(status=ComputationResult.STATUS_RUNNING, started_at=timezone.now())
+        if claimed:
+            return ComputationResult.objects.select_related("scenario").get(pk=pk)
+
+
+def run_computation(computation: ComputationResult) -> None:
+    scenario = computation.scenario
+    logger.info("Starting heatmap computation for scenario %s", scenario.id)
+    if computation.status != ComputationResult.STATUS_RUNNING:
+        computation.status = ComputationResult.STATUS_RUNNING
+        computation.started_at = timezone.now()
+        computation.error_message = ""
+        computation.save(update_fields=["status", "started_at", "error_message"])
+
+    if scenario.sampling_mode == Scenario.SAMPLING_UNIFORM:
+        # Uniform runs are split into chunks that any worker may lease; this
+        # one plans the run, then works on its chunks next to the others.
+        if plan_computation(computation):
+            run_chunks(worker_id(), computation)
+        return
+
+    # Only uniform runs save cells on the lattice as they go and can resume;
+    # the others start over (the travel-time cache still spares known pairs).
+    grid_generator = GridGenerator.for_scenario(scenario)
+    metrics = RunMetrics()
+    progress = ProgressReporter(computation, metrics)
+    budget = CallBudget(scenario.max_api_calls) if scenario.max_api_calls else None
+    try:
+        # Drop the previous run's cells up front so partial results never mix
+        # two runs.
+        clear_results(scenario)
+        if scenario.sampling_mode == Scenario.SAMPLING_ADAPTIVE:
+            results = compute_adaptive_times(
+                scenario.polygon_geojson,
+                scenario.grid_resolution_m,
+                scenario.min_cell_size_m,
+                scenario.refine_threshold_minutes,
+                scenario.targets.all(),
+                scenario.departure_time,
+                scenario.metric,
+                scenario.mode,
+                progress_callback=progress,
+                grid_generator=grid_generator,
+                percentile=scenario.metric_percentile,
+                metrics=metrics,
+                budget=budget,
+            )
+        else:
+            results = compute_budgeted_times(
+                scenario.polygon_geojson,
+                scenario.grid_resolution_m,
+                scenario.call_budget,
+                scenario.targets.all(),
+                scenario.departure_time,
+                scenario.metric,
+                scenario.mode,
+                progress_callback=progress,
+                grid_generator=grid_generator,
+                percentile=scenario.metric_percentile,
+                metrics=metrics,
+                budget=budget,
+            )
+        with stage("persistence", metrics, cells=len(results)):
+            save_results(scenario, results)
+        logger.info(
+            "Computed %s results for scenario %s in %s routing calls",
+            len(results),
+            scenario.id,
+            metrics.counters["api_calls"],
+        )
+        RUNS.inc(status=ComputationResult.STATUS_DONE)
+        CELLS.inc(len(results))
+        invalidate_tile_cache(scenario.id)
+        computation.status = ComputationResult.STATUS_DONE
+        computation.finished_at = timezone.now()
+        computation.num_cells = len(results)
+        computation.cells_done = len(results)
+        computation.cells_total = len(results)
+        computation.estimated_finished_at = None
+        computation.save(
+            update_fields=[
+                "status",
+                "finished_at",
+                "num_cells",
+                "cells_done",
+                "cells_total",
+                "estimated_finished_at",
+                *_apply_run_metrics(computation, metrics),
+            ]
+        )
+    except Exception as exc:  # noqa: BLE001
+        computation.status = ComputationResult.STATUS_ERROR
+        computation.finished_at = timezone.now()
+        computation.estimated_finished_at = None
+        computation.error_message = str(exc)
+        computation.save(
+            update_fields=[
+                "status",
+                "finished_at",
+                "estimated_finished_at",
+                "error_message",
+                *_apply_run_metrics(computation, metrics),
+            ]
+        )
+        RUNS.inc(status=ComputationResult.STATUS_ERROR)
+        raise
+
+
+def plan_computation(computation: ComputationResult) -> bool:
+    # Splits a uniform run into chunks of HEATMAPS_RUN_CHUNK_SIZE cells.
+    # Returns False when another worker took over the planning meanwhile.
+    scenario = computation.scenario
+    metrics = RunMetrics()
+    try:
+        with stage("grid", metrics, scenario=scenario.id):
+            grid = GridGenerator.for_scenario(scenario).generate_grid(
+                scenario.polygon_geojson, scenario.grid_resolution_m
+            )
+        logger.info(
+            "Generated %s grid cells for scenario %s with resolution %sm",
+            len(grid),
+            scenario.id,
+            scenario.grid_resolution_m,
+        )
+        targets = list(scenario.targets.all())
+        known_durations = None
+        if computation.resume:
+            # Diff the stored cells against the current grid and targets: only
+            # pairs without a stored duration (new cells, new or moved targets,
+            # failed pairs) are fetched, cells that left the grid are dropped
+            # and every cell is re-aggregated.
+            cell_ids = scenario_cell_ids(
+                scenario,
+                np.array([cell.lat for cell in grid], dtype=float),
+                np.array([cell.lng for cell in grid], dtype=float),
+            )
+            known_durations = load_stored_durations(scenario, targets, grid, cell_ids)
+            delete_stale_cells(scenario, grid, cell_ids)
+            computation.cells_reused = sum(
+                1
+                for durations in known_durations
+                if durations is not None
+                and len(durations) == len(targets)
+                and all(value is not None for value in durations)
+            )
+            logger.info(
+                "Resuming scenario %s: reusing %s complete cells",
+                scenario.id,
+                computation.cells_reused,
+            )
+        chunk_size = int(getattr(settings, "HEATMAPS_RUN_CHUNK_SIZE", 1000)) or len(grid)
+        chunk_size = max(chunk_size, 1)
+        starts = range(0, len(grid), chunk_size)
+
+        def known(start: int) -> Optional[list]:
+            if known_durations is None:
+                return None
+            return known_durations[start : start + chunk_size]
+
+        shares: List[Optional[int]] = [None] * len(starts)
+        if scenario.max_api_calls is not None:
+            # Refuse runs that cannot fit the budget before spending any of
+            # it. Each chunk may spend its estimate plus a share of the spare
+            # calls (retries, estimate misses) in proportion to its size, so
+            # the chunks never exceed the budget between them.
+            estimates = [
+                estimate_api_calls(
+                    grid[start : start + chunk_size],
+                    targets,
+                    scenario.departure_time,
+                    scenario.mode,
+                    known_durations=known(start),
+                )
+                for start in starts
+            ]
+            if sum(estimates) > scenario.max_api_calls:
+                raise RoutingBudgetExceeded(
+                    f"Run needs about {sum(estimates)} routing calls, over the "
+                    f"scenario's limit of {scenario.max_api_calls}."
+                )
+            spare = scenario.max_api_calls - sum(estimates)
+            shares = [
+                estimate + spare * len(grid[start : start + chunk_size]) // len(grid)
+                for estimate, start in zip(estimates, starts)
+            ]
+        prepare_incremental_results(scenario, computation.resume)
+        chunks = [
+            ComputationChunk(
+                computation=computation,
+                index=index,
+                cells=[[cell.lat, cell.lng] for cell in grid[start : start + chunk_size]],
+                known_durations=known(start),
+                max_api_calls=share,
+                cells_total=len(grid[start : start + chunk_size]),
+                # The planning stage is accounted to the first chunk.
+                metrics=metrics.as_fields() if index == 0 else {},
+            )
+            for index, (start, share) in enumerate(zip(starts, shares))
+        ]
+        with transaction.atomic():
+            planned = ComputationResult.objects.filter(
+                pk=computation.pk,
+                status=ComputationResult.STATUS_RUNNING,
+                started_at=computation.started_at,
+            ).update(cells_total=len(grid), cells_reused=computation.cells_reused)
+            if not planned:
+                return False
+            ComputationChunk.objects.filter(computation=computation).delete()
+            ComputationChunk.objects.bulk_create(chunks)
+    except Exception as exc:  # noqa: BLE001
+        ComputationResult.objects.filter(pk=computation.pk).update(**metrics.as_fields())
+        fail_computation(computation.pk, str(exc))
+        raise
+    logger.info("Split scenario %s into %s chunk(s)", scenario.id, len(chunks))
+    if not chunks:
+        finish_computation(computation.pk)
+    return True
+
+
+def claim_next_chunk(
+    owner: str, computation: Optional[ComputationResult] = None
+) -> Optional[ComputationChunk]:
+    # Leases the next chunk of the oldest running run: a pending one, or one
+    # whose lease expired because its worker died or stalled. Compare-and-set
+    # on status and lease_expires_at, like claim_next_computation.
+    max_attempts = max(int(getattr(settings, "HEATMAPS_CHUNK_MAX_ATTEMPTS", 3)), 1)
+    while True:
+        now = timezone.now()
+        chunks = ComputationChunk.objects.filter(
+            Q(status=ComputationChunk.STATUS_PENDING)
+            | Q(status=ComputationChunk.STATUS_LEASED, lease_expires_at__lt=now),
+            computation__status=ComputationResult.STATUS_RUNNING,
+        )
+        if computation is not None:
+            chunks = chunks.filter(computation=computation)
+        candidate = (
+            chunks.order_by("computation__queued_at", "computation_id", "index")
+            .values_list("pk", "status", "lease_expires_at")
+            .first()
+        )
+        if candidate is None:
+            return None
+        pk, status, lease_expires_at = candidate
+        claimed = ComputationChunk.objects.filter(
+            pk=pk, status=status, lease_expires_at=lease_expires_at
+        ).update(
+            status=ComputationChunk.STATUS_LEASED,
+            lease_owner=owner,
+            lease_expires_at=now + dt.timedelta(seconds=_lease_seconds()),
+            attempts=F("attempts") + 1,
+        )
+        if not claimed:
+            continue
+        chunk = ComputationChunk.objects.select_related("computation__scenario").get(pk=pk)
+        if chunk.attempts > max_attempts:
+            # Every worker that leased it died: do not let it take down more.
+            ComputationChunk.objects.filter(pk=pk).update(status=ComputationChunk.STATUS_ERROR)
+            fail_computation(
+                chunk.computation_id,
+                f"Chunk {chunk.index} was abandoned by {max_attempts} workers.",
+            )
+            continue
+        if chunk.attempts > 1:
+            logger.warning(
+                "Reclaimed chunk %s of scenario %s after its lease expired",
+                chunk.index,
+                chunk.computation.scenario_id,
+            )
+        return chunk
+
+
+def run_chunk(chunk: ComputationChunk, owner: str) -> None:
+    computation = chunk.computation
+    scenario = computation.scenario
+    metrics = RunMetrics()
+    # Calls spent by earlier attempts on the chunk still count.
+    metrics.merge(chunk.metrics)
+    budget = None
+    if chunk.max_api_calls is not None:
+        budget = CallBudget(max(chunk.max_api_calls - metrics.counters["api_calls"], 0))
+    batch_size = max(int(getattr(settings, "HEATMAPS_RESULTS_BATCH_SIZE", 500)), 1)
+    logger.info(
+        "Computing chunk %s of scenario %s (%s cells)",
+        chunk.index,
+        scenario.id,
+        chunk.cells_total,
+    )
+    with ChunkLease(chunk, owner, metrics) as lease:
+        try:
+            results = iter_compute_times(
+                [Cell(lat, lng) for lat, lng in chunk.cells],
+                list(scenario.targets.all()),
+                scenario.departure_time,
+                scenario.metric,
+                scenario.mode,
+                progress_callback=lease,
+                batch_size=batch_size,
+                known_durations=chunk.known_durations,
+                percentile=scenario.metric_percentile,
+                metrics=metrics,
+                budget=budget,
+            )
+            # One transaction per batch, upserted: a chunk computed twice
+            # (lease taken over) overwrites its own rows.
+            batch: List[dict] = []
+            for result in results:
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    with stage("persistence", metrics, cells=len(batch)):
+                        append_results(scenario, batch, replace=True)
+                    lease.saved(len(batch))
+                    batch = []
+            if batch:
+                with stage("persistence", metrics, cells=len(batch)):
+                    append_results(scenario, batch, replace=True)
+                lease.saved(len(batch))
+            lease.renew(
+                status=ComputationChunk.STATUS_DONE,
+                cells_done=chunk.cells_total,
+                lease_owner="",
+                lease_expires_at=None,
+            )
+        except LeaseLost:
+            logger.warning(
+                "Stopped chunk %s of scenario %s: its lease was lost", chunk.index, scenario.id
+            )
+            return
+        except Exception as exc:  # noqa: BLE001
+            try:
+                lease.renew(status=ComputationChunk.STATUS_ERROR)
+            except LeaseLost:
+                pass
+            fail_computation(computation.pk, str(exc))
+            raise
+    finish_computation(computation.pk)
+
+
+def run_chunks(owner: str, computation: Optional[ComputationResult] = None) -> int:
+    # Works on chunks (of ``computation`` only, if given) until none is left
+    # to lease; returns how many were run.
+    processed = 0
+    while True:
+        chunk = claim_next_chunk(owner, computation)
+        if chunk is None:
+            return processed
+        run_chunk(chunk, owner)
+        processed += 1
+
+
+def _chunk_totals(computation_id: int) -> Tuple[int, int, RunMetrics]:
+    metrics = RunMetrics()
+    cells_done = cells_saved = 0
+    for done, saved, fields in ComputationChunk.objects.filter(
+        computation_id=computation_id
+    ).values_list("cells_done", "cells_saved", "metrics"):
+        cells_done += done
+        cells_saved += saved
+        metrics.merge(fields)
+    return cells_done, cells_saved, metrics
+
+
+def sync_computation_progress(computation_id: int) -> None:
+    # The progress and counters of a chunked run are sums over its chunks,
+    # recomputed by whichever worker saves progress, never accumulated.
+    cells_done, cells_saved, metrics = _chunk_totals(computation_id)
+    fields = {"cells_done": cells_done, "cells_saved": cells_saved, **metrics.as_fields()}
+    computation = ComputationResult.objects.only("started_at", "cells_total").get(
+        pk=computation_id
+    )
+    if cells_done and computation.started_at:
+        elapsed = (timezone.now() - computation.started_at).total_seconds()
+        remaining = elapsed / cells_done * max(computation.cells_total - cells_done, 0)
+        fields["estimated_finished_at"] = timezone.now() + dt.timedelta(seconds=remaining)
+    ComputationResult.objects.filter(
+        pk=computation_id, status=ComputationResult.STATUS_RUNNING
+    ).update(**fields)
+
+
+def finish_computation(computation_id: int) -> None:
+    # Called by every worker that completes a chunk; the one that sees all of
+    # them done wins the compare-and-set on finished_at and closes the run.
+    if (
+        ComputationChunk.objects.filter(computation_id=computation_id)
+        .exclude(status=ComputationChunk.STATUS_DONE)
+        .exists()
+    ):
+        return
+    claimed = ComputationResult.objects.filter(
+        pk=computation_id,
+        status=ComputationResult.STATUS_RUNNING,
+        finished_at__isnull=True,
+    ).update(finished_at=timezone.now())
+    if not claimed:
+        return
+    computation = ComputationResult.objects.select_related("scenario").get(pk=computation_id)
+    scenario = computation.scenario
+    _, _, metrics = _chunk_totals(computation_id)
+    # Rows served partial results during the run; pack them once it is over.
+    if uses_array_storage(scenario):
+        with stage("persistence", metrics, cells=computation.cells_total):
+            pack_cell_rows(scenario, delete_rows=True)
+    logger.info(
+        "Computed %s results for scenario %s in %s routing calls",
+        computation.cells_total,
+        scenario.id,
+        metrics.counters["api_calls"],
+    )
+    RUNS.inc(status=ComputationResult.STATUS_DONE)
+    CELLS.inc(computation.cells_total)
+    invalidate_tile_cache(scenario.id)
+    computation.status = ComputationResult.STATUS_DONE
+    computation.num_cells = computation.cells_total
+    computation.cells_done = computation.cells_total
+    computation.cells_saved = computation.cells_total
+    computation.estimated_finished_at = None
+    with transaction.atomic():
+        computation.save(
+            update_fields=[
+                "status",
+                "num_cells",
+                "cells_done",
+                "cells_saved",
+                "estimated_finished_at",
+                *_apply_run_metrics(computation, metrics),
+            ]
+        )
+        computation.chunks.all().delete()
+
+
+def fail_computation(computation_id: int, message: str) -> None:
+    # Stops the run for every worker: their next lease renewal fails.
+    if ComputationChunk.objects.filter(computation_id=computation_id).exists():
+        sync_computation_progress(computation_id)
+    failed = ComputationResult.objects.filter(
+        pk=computation_id, status=ComputationResult.STATUS_RUNNING
+    ).update(
+        status=ComputationResult.STATUS_ERROR,
+        finished_at=timezone.now(),
+        estimated_finished_at=None,
+        error_message=message,
+    )
+    if failed:
+        RUNS.inc(status=ComputationResult.STATUS_ERROR)
+
+
+def run_worker(poll_interval: float = 2.0, once: bool = False) -> int:
+    owner = worker_id()
+    processed = 0
+    while True:
+        # Help with the chunks of runs in flight before planning a new one.
+        try:
+            if run_chunks(owner):
+                continue
+        except Exception as exc:  # noqa: BLE001
+            logger.exception("Heatmap chunk failed: %s", exc)
+            continue
+        computation = claim_next_computation()
+        if computation is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_computation(computation)
+        except Exception as exc:  # noqa: BLE001
+            logger.exception(
+                "Heatmap computation for scenario %s failed: %s", computation.scenario_id, exc
+            )
+        processed += 1
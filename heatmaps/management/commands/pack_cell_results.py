@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from heatmaps.models import Scenario
+from heatmaps.storage import pack_cell_rows
+
+
+class Command(BaseCommand):
+    help = "Convert stored CellResult rows into array-backed GridResult records."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario",
+            type=int,
+            action="append",
+            dest="scenario_ids",
+            help="Only convert this scenario (can be repeated).",
+        )
+        parser.add_argument(
+            "--delete-rows",
+            action="store_true",
+            help="Delete the CellResult rows once the scenario has been packed.",
+        )
+
+    def handle(self, *args, **options):
+        scenarios = Scenario.objects.filter(cell_results__isnull=False).distinct()
+        if options["scenario_ids"]:
+            scenarios = scenarios.filter(pk__in=options["scenario_ids"])
+        for scenario in scenarios:
+            grid_result = pack_cell_rows(scenario, delete_rows=options["delete_rows"])
+            if grid_result is None:
+                self.stdout.write(
+                    f"Skipped scenario {scenario.id}: its cells do not match the lattice."
+                )
+                continue
+            self.stdout.write(
+                f"Packed scenario {scenario.id}: {grid_result.num_cells} cells, "
+                f"{grid_result.num_targets} targets."
+            )
@@ -0,0 +1,98 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from heatmaps.benchmarks import SUITES, collect_benchmarks, compare_to_baseline, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the heatmap pipeline (grid generation, compute_times, aggregation, "
+        "result storage and the results view) and write a JSON report, optionally "
+        "compared against a baseline report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--suite",
+            action="append",
+            dest="suites",
+            choices=sorted(SUITES),
+            help="Only run this suite (can be repeated).",
+        )
+        parser.add_argument(
+            "--filter", default="", help="Only run benchmarks whose name contains this."
+        )
+        parser.add_argument(
+            "--quick", action="store_true", help="Smaller sizes, for a fast smoke run."
+        )
+        parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark.")
+        parser.add_argument("--warmup", type=int, default=1, help="Untimed runs first.")
+        parser.add_argument("--output", help="Write the JSON report here ('-' for stdout).")
+        parser.add_argument("--baseline", help="JSON report to compare against.")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.1,
+            help="Relative slowdown of the median tolerated before flagging a regression.",
+        )
+        parser.add_argument(
+            "--fail-on-regression",
+            action="store_true",
+            help="Exit with an error when a benchmark regressed against the baseline.",
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as handle:
+                baseline = json.load(handle)
+        benchmarks = [
+            benchmark
+            for benchmark in collect_benchmarks(options["suites"], quick=options["quick"])
+            if options["filter"] in benchmark.key
+        ]
+        # Benchmarks that write results get a throwaway test database.
+        old_config = None
+        if any(benchmark.uses_database for benchmark in benchmarks):
+            old_config = setup_databases(verbosity=0, interactive=False)
+        log = self.stderr if options["output"] == "-" else self.stdout
+        try:
+            report = run_benchmarks(
+                benchmarks,
+                repeat=max(options["repeat"], 1),
+                warmup=max(options["warmup"], 0),
+                quick=options["quick"],
+                progress=lambda result: log.write(
+                    f"{result['name']}: median {result['median_s'] * 1000:.2f} ms, "
+                    f"min {result['min_s'] * 1000:.2f} ms"
+                ),
+            )
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+
+        regressions = []
+        if baseline is not None:
+            report["baseline"] = {
+                "created_at": baseline.get("created_at"),
+                "tolerance": options["tolerance"],
+            }
+            report["comparison"] = compare_to_baseline(report, baseline, options["tolerance"])
+            for entry in report["comparison"]:
+                ratio = "" if entry["ratio"] is None else f" x{entry['ratio']:.2f}"
+                log.write(f"{entry['status']:>11} {entry['name']}{ratio}")
+            regressions = [
+                entry for entry in report["comparison"] if entry["status"] == "regression"
+            ]
+        if options["output"] == "-":
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        elif options["output"]:
+            with open(options["output"], "w") as handle:
+                json.dump(report, handle, indent=2)
+            log.write(f"Wrote {len(report['benchmarks'])} benchmark(s) to {options['output']}.")
+        if regressions and options["fail_on_regression"]:
+            raise CommandError(f"{len(regressions)} benchmark(s) regressed.")
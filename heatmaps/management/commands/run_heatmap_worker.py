@@ -0,0 +1,88 @@
+import signal
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+from heatmaps.instrumentation import start_metrics_server
+from heatmaps.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Process queued heatmap computations from the database-backed queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait between polls when the queue is empty.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the queue and exit instead of polling forever.",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help=(
+                "Serve this worker's Prometheus metrics on this port (worker N of "
+                "--processes uses port + N)."
+            ),
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help=(
+                "Start this many worker processes, e.g. one per core. Workers on "
+                "other machines sharing the database split the same runs."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if options["processes"] > 1:
+            self._run_processes(options)
+            return
+        if options["metrics_port"]:
+            start_metrics_server(options["metrics_port"])
+            self.stdout.write(f"Serving metrics on port {options['metrics_port']}.")
+        self.stdout.write("Heatmap worker started.")
+        processed = run_worker(poll_interval=options["poll_interval"], once=options["once"])
+        self.stdout.write(f"Heatmap worker processed {processed} computation(s).")
+
+    def _run_processes(self, options):
+        # Each worker is a separate `manage.py run_heatmap_worker`; stopping
+        # this command stops them all (their chunks are leased again later).
+        command = [
+            sys.executable,
+            sys.argv[0],
+            "run_heatmap_worker",
+            "--poll-interval",
+            str(options["poll_interval"]),
+        ]
+        if options["once"]:
+            command.append("--once")
+        workers = []
+        for index in range(options["processes"]):
+            arguments = list(command)
+            if options["metrics_port"]:
+                arguments += ["--metrics-port", str(options["metrics_port"] + index)]
+            workers.append(subprocess.Popen(arguments))
+        self.stdout.write(f"Started {len(workers)} heatmap workers.")
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for worker in workers:
+                worker.wait()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+        failed = sum(1 for worker in workers if worker.returncode)
+        self.stdout.write(f"{len(workers)} heatmap worker(s) stopped, {failed} with errors.")
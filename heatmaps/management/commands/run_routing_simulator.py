@@ -0,0 +1,132 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from heatmaps.routing import RoutingBackendError
+from heatmaps.simulation import RoutingSimulator
+
+
+def _waypoints(items, key):
+    points = []
+    for item in items:
+        lat_lng = item.get(key, item)["location"]["latLng"]
+        points.append(SimpleNamespace(lat=lat_lng["latitude"], lng=lat_lng["longitude"]))
+    return points
+
+
+def make_handler(simulator: RoutingSimulator):
+    class RoutesHandler(BaseHTTPRequestHandler):
+        # Answers computeRoutes and computeRouteMatrix like the Google Routes
+        # API, so GoogleDirectionsClient can run against it unchanged.
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            mode = payload.get("travelMode", "TRANSIT").lower()
+            if self.path.endswith("/directions/v2:computeRoutes"):
+                origins = _waypoints([payload["origin"]], "waypoint")
+                destinations = _waypoints([payload["destination"]], "waypoint")
+            elif self.path.endswith("/distanceMatrix/v2:computeRouteMatrix"):
+                origins = _waypoints(payload["origins"], "waypoint")
+                destinations = _waypoints(payload["destinations"], "waypoint")
+            else:
+                self._reply(404, {"error": {"code": 404, "message": "Not found."}})
+                return
+            try:
+                latency, error = simulator.admit(len(origins) * len(destinations))
+                time.sleep(latency)
+                if error is not None:
+                    raise error
+            except RoutingBackendError as exc:
+                headers = {}
+                if exc.retry_after is not None:
+                    headers["Retry-After"] = str(max(int(exc.retry_after + 0.999), 1))
+                self._reply(
+                    exc.status_code or 500,
+                    {"error": {"code": exc.status_code, "message": str(exc)}},
+                    headers,
+                )
+                return
+            durations = simulator.durations(origins, destinations, mode)
+            if self.path.endswith("computeRoutes"):
+                self._reply(200, {"routes": [{"duration": f"{durations[0][0]}s"}]})
+                return
+            self._reply(
+                200,
+                [
+                    {
+                        "originIndex": i,
+                        "destinationIndex": j,
+                        "duration": f"{value}s",
+                        "condition": "ROUTE_EXISTS",
+                    }
+                    for i, row in enumerate(durations)
+                    for j, value in enumerate(row)
+                ],
+            )
+
+        def _reply(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RoutesHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local stand-in for the Google Routes API with simulated latency, "
+        "errors and quota. Point GOOGLE_ROUTES_BASE_URL at it to load-test runs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency-ms", type=float, help="Mean latency per request.")
+        parser.add_argument("--latency-jitter-ms", type=float, help="Uniform latency jitter.")
+        parser.add_argument(
+            "--element-latency-ms", type=float, help="Extra latency per matrix element."
+        )
+        parser.add_argument(
+            "--error-rate", type=float, help="Fraction of requests failing with a 503."
+        )
+        parser.add_argument(
+            "--quota-elements-per-minute",
+            type=int,
+            help="Elements accepted per minute before answering 429 (0 = unlimited).",
+        )
+        parser.add_argument("--seed", type=int, help="Seed for latency and errors.")
+
+    def handle(self, *args, **options):
+        simulator = RoutingSimulator(
+            latency_ms=options["latency_ms"],
+            latency_jitter_ms=options["latency_jitter_ms"],
+            element_latency_ms=options["element_latency_ms"],
+            error_rate=options["error_rate"],
+            quota_elements_per_minute=options["quota_elements_per_minute"],
+            seed=options["seed"],
+        )
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(simulator))
+        self.stdout.write(
+            f"Routing simulator listening on http://{options['host']}:{options['port']}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(
+                f"Served {simulator.requests} request(s): {simulator.rejected} over quota, "
+                f"{simulator.failed} failed."
+            )
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TravelTimeCacheEntry",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("key", models.CharField(max_length=128, unique=True)),
+                ("duration_seconds", models.IntegerField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
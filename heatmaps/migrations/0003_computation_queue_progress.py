@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0002_travel_time_cache"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="computationresult",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("PENDING", "Pending"),
+                    ("QUEUED", "Queued"),
+                    ("RUNNING", "Running"),
+                    ("DONE", "Done"),
+                    ("ERROR", "Error"),
+                ],
+                db_index=True,
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="queued_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="cells_done",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="cells_total",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="estimated_finished_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
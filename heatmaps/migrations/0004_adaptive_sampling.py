@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0003_computation_queue_progress"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="sampling_mode",
+            field=models.CharField(
+                choices=[("UNIFORM", "Uniform grid"), ("ADAPTIVE", "Adaptive refinement")],
+                default="UNIFORM",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="scenario",
+            name="refine_threshold_minutes",
+            field=models.FloatField(default=5),
+        ),
+        migrations.AddField(
+            model_name="scenario",
+            name="min_cell_size_m",
+            field=models.PositiveIntegerField(default=125),
+        ),
+        migrations.AddField(
+            model_name="cellresult",
+            name="cell_size_m",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0004_adaptive_sampling"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="call_budget",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="scenario",
+            name="sampling_mode",
+            field=models.CharField(choices=[("UNIFORM", "Uniform grid"), ("ADAPTIVE", "Adaptive refinement"), ("BUDGETED", "Budgeted sample with interpolation")], default="UNIFORM", max_length=20),
+        ),
+    ]
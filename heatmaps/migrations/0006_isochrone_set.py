@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0005_budgeted_sampling"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IsochroneSet",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("thresholds", models.CharField(max_length=255)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("geojson", models.JSONField()),
+                ("scenario", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="isochrone_sets", to="heatmaps.scenario")),
+            ],
+            options={
+                "unique_together": {("scenario", "thresholds")},
+            },
+        ),
+    ]
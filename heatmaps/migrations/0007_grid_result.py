@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0006_isochrone_set"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GridResult",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now=True)),
+                ("origin_x", models.FloatField()),
+                ("origin_y", models.FloatField()),
+                ("resolution_m", models.FloatField()),
+                ("width", models.PositiveIntegerField()),
+                ("height", models.PositiveIntegerField()),
+                ("num_targets", models.PositiveIntegerField(default=0)),
+                ("mask", models.BinaryField()),
+                ("time_minutes", models.BinaryField()),
+                ("durations", models.BinaryField()),
+                ("interpolated", models.BinaryField(blank=True, default=b"")),
+                ("scenario", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name="grid_result", to="heatmaps.scenario")),
+            ],
+        ),
+    ]
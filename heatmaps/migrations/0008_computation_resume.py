@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0007_grid_result"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="computationresult",
+            name="cells_reused",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="cells_saved",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="resume",
+            field=models.BooleanField(default=False),
+        ),
+    ]
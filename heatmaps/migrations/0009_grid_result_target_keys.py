@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0008_computation_resume"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gridresult",
+            name="target_keys",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,21 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0009_grid_result_target_keys"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="metric_percentile",
+            field=models.FloatField(default=50, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AlterField(
+            model_name="scenario",
+            name="metric",
+            field=models.CharField(choices=[("MIN", "Min"), ("AVG", "Average"), ("WEIGHTED_AVG", "Weighted average"), ("MAX", "Max"), ("PERCENTILE", "Percentile")], default="MIN", max_length=20),
+        ),
+    ]
@@ -0,0 +1,79 @@
+import numpy as np
+from django.db import migrations, models
+from pyproj import Transformer
+from shapely.geometry import shape
+from shapely.ops import transform
+
+# Frozen copy of the cell IDs of GridGenerator as of this migration: square
+# cells on the lattice anchored on the polygon's lower-left corner, with
+# depth | x index | y index packed like encode_cell_ids.
+CELL_ID_AXIS_BITS = 26
+
+
+def square_cell_ids(lats, lngs, polygon_geojson, resolution, sizes):
+    to_mercator = Transformer.from_crs(4326, 3857, always_xy=True)
+    minx, miny, _, _ = transform(to_mercator.transform, shape(polygon_geojson)).bounds
+    xs, ys = to_mercator.transform(lngs, lats)
+    depth = np.maximum(np.rint(np.log2(resolution / sizes)), 0).astype(np.int64)
+    size = resolution / 2.0**depth
+    # Refined squares tile the depth-0 cells, whose lower-left corner sits
+    # half a cell below the lattice point.
+    ix = np.floor((np.asarray(xs) - minx + resolution / 2) / size).astype(np.int64)
+    iy = np.floor((np.asarray(ys) - miny + resolution / 2) / size).astype(np.int64)
+    limit = 1 << (CELL_ID_AXIS_BITS - 1)
+    return (
+        (depth << (2 * CELL_ID_AXIS_BITS))
+        | ((ix + limit) << CELL_ID_AXIS_BITS)
+        | (iy + limit)
+    )
+
+
+def backfill_cell_ids(apps, schema_editor):
+    CellResult = apps.get_model("heatmaps", "CellResult")
+    Scenario = apps.get_model("heatmaps", "Scenario")
+    # Existing scenarios all use the polygon-anchored square lattice.
+    for scenario in Scenario.objects.filter(cell_results__isnull=False).distinct():
+        rows = list(scenario.cell_results.order_by("pk"))
+        resolution = float(scenario.grid_resolution_m)
+        ids = square_cell_ids(
+            np.array([row.lat for row in rows], dtype=float),
+            np.array([row.lng for row in rows], dtype=float),
+            scenario.polygon_geojson,
+            resolution,
+            np.array(
+                [resolution if row.cell_size_m is None else row.cell_size_m for row in rows],
+                dtype=float,
+            ),
+        )
+        for row, cell_id in zip(rows, ids.tolist()):
+            row.cell_id = cell_id
+        CellResult.objects.bulk_update(rows, ["cell_id"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0010_metric_percentile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="grid_alignment",
+            field=models.CharField(choices=[("LOCAL", "Anchored on the polygon"), ("GLOBAL", "Global Mercator lattice")], default="LOCAL", max_length=20),
+        ),
+        migrations.AddField(
+            model_name="cellresult",
+            name="cell_id",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_cell_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name="cellresult",
+            unique_together={("scenario", "cell_id")},
+        ),
+        migrations.AlterField(
+            model_name="cellresult",
+            name="cell_id",
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0011_cell_ids"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="grid_shape",
+            field=models.CharField(choices=[("SQUARE", "Square cells"), ("HEX", "Hexagonal cells")], default="SQUARE", max_length=20),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0012_grid_shape"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="computationresult",
+            name="api_calls",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="api_elements",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="api_errors",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="api_retries",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="cache_hits",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="cache_misses",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="computationresult",
+            name="stage_seconds",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0013_computation_metrics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="max_api_calls",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0014_scenario_max_api_calls"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ComputationChunk",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("index", models.PositiveIntegerField()),
+                ("status", models.CharField(choices=[("PENDING", "Pending"), ("LEASED", "Leased"), ("DONE", "Done"), ("ERROR", "Error")], db_index=True, default="PENDING", max_length=20)),
+                ("cells", models.JSONField()),
+                ("known_durations", models.JSONField(blank=True, null=True)),
+                ("max_api_calls", models.PositiveIntegerField(blank=True, null=True)),
+                ("lease_owner", models.CharField(blank=True, max_length=255)),
+                ("lease_expires_at", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("cells_total", models.PositiveIntegerField(default=0)),
+                ("cells_done", models.PositiveIntegerField(default=0)),
+                ("cells_saved", models.PositiveIntegerField(default=0)),
+                ("metrics", models.JSONField(blank=True, default=dict)),
+                ("computation", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="chunks", to="heatmaps.computationresult")),
+            ],
+            options={
+                "unique_together": {("computation", "index")},
+            },
+        ),
+    ]
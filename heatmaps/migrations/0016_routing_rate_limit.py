@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("heatmaps", "0015_computation_chunks"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RoutingRateLimit",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("backend", models.CharField(max_length=100, unique=True)),
+                ("tokens", models.FloatField()),
+                ("rate", models.FloatField()),
+                ("updated_at", models.FloatField()),
+                ("throttled_at", models.FloatField(default=0)),
+                ("version", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,15 +1,44 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
 from django.conf import settings
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from pyproj import Transformer
 
 
 class Scenario(models.Model):
     METRIC_MIN = "MIN"
     METRIC_AVG = "AVG"
     METRIC_WEIGHTED = "WEIGHTED_AVG"
+    METRIC_MAX = "MAX"
+    METRIC_PERCENTILE = "PERCENTILE"
     METRIC_CHOICES = [
         (METRIC_MIN, "Min"),
         (METRIC_AVG, "Average"),
         (METRIC_WEIGHTED, "Weighted average"),
+        (METRIC_MAX, "Max"),
+        (METRIC_PERCENTILE, "Percentile"),
+    ]
+    SAMPLING_UNIFORM = "UNIFORM"
+    SAMPLING_ADAPTIVE = "ADAPTIVE"
+    SAMPLING_BUDGETED = "BUDGETED"
+    SAMPLING_CHOICES = [
+        (SAMPLING_UNIFORM, "Uniform grid"),
+        (SAMPLING_ADAPTIVE, "Adaptive refinement"),
+        (SAMPLING_BUDGETED, "Budgeted sample with interpolation"),
+    ]
+    GRID_LOCAL = "LOCAL"
+    GRID_GLOBAL = "GLOBAL"
+    GRID_ALIGNMENT_CHOICES = [
+        (GRID_LOCAL, "Anchored on the polygon"),
+        (GRID_GLOBAL, "Global Mercator lattice"),
+    ]
+    GRID_SQUARE = "SQUARE"
+    GRID_HEX = "HEX"
+    GRID_SHAPE_CHOICES = [
+        (GRID_SQUARE, "Square cells"),
+        (GRID_HEX, "Hexagonal cells"),
     ]
 
     name = models.CharField(max_length=255)
@@ -23,9 +52,28 @@ class Scenario(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     polygon_geojson = models.JSONField()
     metric = models.CharField(max_length=20, choices=METRIC_CHOICES, default=METRIC_MIN)
+    # Percentile of the per-target durations used by METRIC_PERCENTILE.
+    metric_percentile = models.FloatField(
+        default=50, validators=[MinValueValidator(0), MaxValueValidator(100)]
+    )
     mode = models.CharField(max_length=20, default="transit")
     departure_time = models.DateTimeField(null=True, blank=True)
     grid_resolution_m = models.PositiveIntegerField(default=500)
+    # GLOBAL snaps the cells of every scenario with the same resolution onto
+    # one shared lattice, so their coordinates and cell IDs match.
+    grid_alignment = models.CharField(
+        max_length=20, choices=GRID_ALIGNMENT_CHOICES, default=GRID_LOCAL
+    )
+    grid_shape = models.CharField(max_length=20, choices=GRID_SHAPE_CHOICES, default=GRID_SQUARE)
+    sampling_mode = models.CharField(
+        max_length=20, choices=SAMPLING_CHOICES, default=SAMPLING_UNIFORM
+    )
+    refine_threshold_minutes = models.FloatField(default=5)
+    min_cell_size_m = models.PositiveIntegerField(default=125)
+    call_budget = models.PositiveIntegerField(null=True, blank=True)
+    # Hard cap on routing API calls (retries included) per run; runs whose
+    # estimate exceeds it fail before the first call. Null means no cap.
+    max_api_calls = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self) -> str:
         return self.name
@@ -46,11 +94,13 @@ class TargetPoint(models.Model):
 
 class ComputationResult(models.Model):
     STATUS_PENDING = "PENDING"
+    STATUS_QUEUED = "QUEUED"
     STATUS_RUNNING = "RUNNING"
     STATUS_DONE = "DONE"
     STATUS_ERROR = "ERROR"
     STATUS_CHOICES = [
         (STATUS_PENDING, "Pending"),
+        (STATUS_QUEUED, "Queued"),
         (STATUS_RUNNING, "Running"),
         (STATUS_DONE, "Done"),
         (STATUS_ERROR, "Error"),
@@ -59,27 +109,228 @@ class ComputationResult(models.Model):
     scenario = models.OneToOneField(
         Scenario, on_delete=models.CASCADE, related_name="computation"
     )
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, db_index=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
     num_cells = models.PositiveIntegerField(default=0)
+    cells_done = models.PositiveIntegerField(default=0)
+    cells_total = models.PositiveIntegerField(default=0)
+    estimated_finished_at = models.DateTimeField(null=True, blank=True)
     error_message = models.TextField(blank=True)
+    # Resume runs keep the cells saved by the previous attempt and only fetch
+    # the pairs those are missing; cells_saved is the checkpoint, updated in
+    # the same transaction as every saved batch of cells.
+    resume = models.BooleanField(default=False)
+    cells_saved = models.PositiveIntegerField(default=0)
+    cells_reused = models.PositiveIntegerField(default=0)
+    # Counters of the last run (see heatmaps.instrumentation): routing calls
+    # and the origin x destination pairs they asked for, failed and retried
+    # calls, travel-time cache lookups, and seconds spent per stage.
+    api_calls = models.PositiveIntegerField(default=0)
+    api_elements = models.PositiveIntegerField(default=0)
+    api_errors = models.PositiveIntegerField(default=0)
+    api_retries = models.PositiveIntegerField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    cache_misses = models.PositiveIntegerField(default=0)
+    stage_seconds = models.JSONField(default=dict, blank=True)
 
     def __str__(self) -> str:
         return f"{self.scenario.name} ({self.status})"
 
 
+# A slice of the cells of a uniform run. Workers lease chunks (compare-and-set
+# on status and lease_expires_at) and renew the lease while they work, so the
+# chunks of a worker that died are leased again once it expires.
+class ComputationChunk(models.Model):
+    STATUS_PENDING = "PENDING"
+    STATUS_LEASED = "LEASED"
+    STATUS_DONE = "DONE"
+    STATUS_ERROR = "ERROR"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_LEASED, "Leased"),
+        (STATUS_DONE, "Done"),
+        (STATUS_ERROR, "Error"),
+    ]
+
+    computation = models.ForeignKey(
+        ComputationResult, on_delete=models.CASCADE, related_name="chunks"
+    )
+    index = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True
+    )
+    # [lat, lng] of every cell, and the durations already known for them
+    # (resumed runs; aligned with the scenario targets) if any.
+    cells = models.JSONField()
+    known_durations = models.JSONField(null=True, blank=True)
+    # Share of Scenario.max_api_calls this chunk may spend, retries included.
+    max_api_calls = models.PositiveIntegerField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    cells_total = models.PositiveIntegerField(default=0)
+    cells_done = models.PositiveIntegerField(default=0)
+    cells_saved = models.PositiveIntegerField(default=0)
+    # RunMetrics.as_fields() of the work done on the chunk so far.
+    metrics = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        unique_together = ("computation", "index")
+
+    def __str__(self) -> str:
+        return f"{self.computation} chunk {self.index} ({self.status})"
+
+
 class CellResult(models.Model):
     scenario = models.ForeignKey(
         Scenario, on_delete=models.CASCADE, related_name="cell_results"
     )
+    # Lattice position of the cell (GridGenerator.cell_ids).
+    cell_id = models.BigIntegerField()
     lat = models.FloatField()
     lng = models.FloatField()
     time_minutes = models.FloatField(null=True, blank=True)
+    cell_size_m = models.FloatField(null=True, blank=True)
     raw = models.JSONField(null=True, blank=True)
 
     class Meta:
-        unique_together = ("scenario", "lat", "lng")
+        unique_together = ("scenario", "cell_id")
 
     def __str__(self) -> str:
         return f"{self.scenario.name} ({self.lat}, {self.lng})"
+
+
+# Results of a lattice run packed into arrays, one row per scenario. ``mask``
+# flags the lattice points inside the polygon (width x height, x-major like
+# GridGenerator); the other arrays only hold those points, in the same order.
+class GridResult(models.Model):
+    scenario = models.OneToOneField(
+        Scenario, on_delete=models.CASCADE, related_name="grid_result"
+    )
+    created_at = models.DateTimeField(auto_now=True)
+    origin_x = models.FloatField()
+    origin_y = models.FloatField()
+    resolution_m = models.FloatField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    num_targets = models.PositiveIntegerField(default=0)
+    mask = models.BinaryField()
+    time_minutes = models.BinaryField()
+    durations = models.BinaryField()
+    interpolated = models.BinaryField(blank=True, default=b"")
+    # Identity of the target behind each durations column (services.target_key).
+    target_keys = models.JSONField(default=list, blank=True)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        scenario: Scenario,
+        origin_x: float,
+        origin_y: float,
+        resolution_m: float,
+        mask: np.ndarray,
+        time_minutes: np.ndarray,
+        durations: np.ndarray,
+        interpolated: Optional[np.ndarray] = None,
+        target_keys: Optional[List[str]] = None,
+    ) -> "GridResult":
+        width, height = mask.shape
+        durations = np.asarray(durations, dtype="<f4").reshape(int(mask.sum()), -1)
+        return cls(
+            scenario=scenario,
+            origin_x=origin_x,
+            origin_y=origin_y,
+            resolution_m=resolution_m,
+            width=width,
+            height=height,
+            num_targets=durations.shape[1],
+            mask=np.packbits(mask.ravel()).tobytes(),
+            time_minutes=np.asarray(time_minutes, dtype="<f4").tobytes(),
+            durations=durations.tobytes(),
+            interpolated=(
+                b"" if interpolated is None else np.packbits(interpolated).tobytes()
+            ),
+            target_keys=list(target_keys or []),
+        )
+
+    @property
+    def num_cells(self) -> int:
+        return len(self.cell_times())
+
+    def mask_array(self) -> np.ndarray:
+        bits = np.unpackbits(np.frombuffer(bytes(self.mask), dtype=np.uint8))
+        return bits[: self.width * self.height].astype(bool).reshape(self.width, self.height)
+
+    def cell_times(self) -> np.ndarray:
+        return np.frombuffer(bytes(self.time_minutes), dtype="<f4")
+
+    def cell_durations(self) -> np.ndarray:
+        return np.frombuffer(bytes(self.durations), dtype="<f4").reshape(
+            -1, self.num_targets
+        )
+
+    def cell_interpolated(self) -> np.ndarray:
+        count = len(self.cell_times())
+        if not self.interpolated:
+            return np.zeros(count, dtype=bool)
+        bits = np.unpackbits(np.frombuffer(bytes(self.interpolated), dtype=np.uint8))
+        return bits[:count].astype(bool)
+
+    def cell_mercator(self) -> Tuple[np.ndarray, np.ndarray]:
+        ix, iy = np.nonzero(self.mask_array())
+        return (
+            self.origin_x + ix * self.resolution_m,
+            self.origin_y + iy * self.resolution_m,
+        )
+
+    def cell_coordinates(self) -> Tuple[np.ndarray, np.ndarray]:
+        xs, ys = self.cell_mercator()
+        lngs, lats = _TO_WGS.transform(xs, ys)
+        return np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float)
+
+    def __str__(self) -> str:
+        return f"{self.scenario.name} ({self.width}x{self.height} @ {self.resolution_m}m)"
+
+
+_TO_WGS = Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+class TravelTimeCacheEntry(models.Model):
+    key = models.CharField(max_length=128, unique=True)
+    duration_seconds = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self) -> str:
+        return f"{self.key} ({self.duration_seconds}s)"
+
+
+class IsochroneSet(models.Model):
+    scenario = models.ForeignKey(
+        Scenario, on_delete=models.CASCADE, related_name="isochrone_sets"
+    )
+    thresholds = models.CharField(max_length=255)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    geojson = models.JSONField()
+
+    class Meta:
+        unique_together = ("scenario", "thresholds")
+
+    def __str__(self) -> str:
+        return f"{self.scenario.name} ({self.thresholds} min)"
+
+
+# Client-side rate limit of a routing backend (heatmaps.resilience.TokenBucket),
+# shared by every process calling it. Writes compare-and-set on ``version``;
+# ``updated_at`` and ``throttled_at`` are Unix times.
+class RoutingRateLimit(models.Model):
+    backend = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField()
+    rate = models.FloatField()
+    updated_at = models.FloatField()
+    throttled_at = models.FloatField(default=0)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"{self.backend} ({self.rate}/s)"
@@ -0,0 +1,51 @@
+import json
+import struct
+
+import numpy as np
+from rest_framework.renderers import BaseRenderer
+
+# Binary results layout (little-endian):
+#   header: magic "HMAP", uint16 version, uint16 reserved, uint32 cell count,
+#           uint32 target count (0 when durations are omitted)
+#   body:   float32 lat[count], lng[count], time_minutes[count],
+#           cell_size_m[count], durations_s[count * targets] (row-major)
+# Missing values are encoded as NaN. The header is 16 bytes so every array
+# starts 4-byte aligned and can be wrapped in a Float32Array without copying.
+BINARY_MAGIC = b"HMAP"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHII")
+
+
+class HeatmapBinaryRenderer(BaseRenderer):
+    media_type = "application/vnd.heatmap+octet-stream"
+    format = "bin"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (bytes, bytearray)):
+            return data
+        # Errors (404s, validation) still come through as dicts: send them as
+        # JSON, labelled as such.
+        response = (renderer_context or {}).get("response")
+        if response is not None:
+            response["Content-Type"] = "application/json"
+        return json.dumps(data).encode()
+
+
+def pack_result_columns(columns: dict) -> bytes:
+    count = len(columns["lat"])
+    durations = columns.get("durations", np.empty((count, 0)))
+    header = BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, 0, count, durations.shape[1]
+    )
+    body = np.concatenate(
+        [
+            columns["lat"],
+            columns["lng"],
+            columns["time_minutes"],
+            columns["cell_size_m"],
+            durations.ravel(),
+        ]
+    )
+    return header + body.astype("<f4").tobytes()
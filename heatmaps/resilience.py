@@ -0,0 +1,345 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import requests
+from django.conf import settings
+from django.db.models import F
+
+from heatmaps.models import RoutingRateLimit
+from heatmaps.routing import RoutingBackendError, RoutingQuotaError
+
+
+class RoutingBudgetExceeded(RoutingBackendError):
+    pass
+
+
+class CircuitOpenError(RoutingBackendError):
+    pass
+
+
+# Threads of one process take turns on the database bucket; processes
+# compare-and-set.
+_bucket_lock = threading.Lock()
+
+
+class TokenBucket:
+    # Client-side rate limit in matrix elements (origin x destination pairs)
+    # per second. The bucket lives in the database (RoutingRateLimit), so
+    # every thread and worker process calling the same backend shares it and
+    # N workers still add up to the configured rate. Adaptive: a 429 halves
+    # the rate (down to ``min_fraction`` of the configured one) and every
+    # second without one wins back ``recovery`` of it.
+    def __init__(
+        self,
+        backend_name: str,
+        rate_per_second: float,
+        burst: Optional[float] = None,
+        min_fraction: float = 0.05,
+        recovery: float = 0.05,
+    ) -> None:
+        self.backend_name = backend_name
+        self.max_rate = float(rate_per_second)
+        self.capacity = float(burst or max(self.max_rate, 1.0))
+        self.min_rate = self.max_rate * min_fraction
+        self.recovery = recovery
+
+    def acquire(self, tokens: float = 1) -> float:
+        # Blocks until ``tokens`` may be spent; returns the seconds waited.
+        # Requests larger than the bucket wait for a full bucket and leave it
+        # in debt, so big matrix calls are not starved.
+        waited = 0.0
+        needed = min(tokens, self.capacity)
+        while True:
+            with _bucket_lock:
+                state = self._state()
+                now = time.time()
+                available = self._available(state, now)
+                if available >= needed:
+                    if self._update(state, tokens=available - tokens, updated_at=now):
+                        return waited
+                    # Another process took tokens in between; look again.
+                    continue
+                delay = (needed - available) / state.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self) -> None:
+        # Only writes while the rate recovers from a 429; losing the race
+        # means another call already recovered it.
+        with _bucket_lock:
+            state = self._state()
+            if state.rate >= self.max_rate:
+                return
+            now = time.time()
+            self._update(
+                state,
+                rate=min(
+                    self.max_rate,
+                    state.rate + self.max_rate * self.recovery * (now - state.throttled_at),
+                ),
+                throttled_at=now,
+            )
+
+    def on_throttle(self) -> None:
+        with _bucket_lock:
+            while True:
+                state = self._state()
+                now = time.time()
+                if self._update(
+                    state,
+                    rate=max(state.rate / 2, self.min_rate),
+                    tokens=min(self._available(state, now), 0.0),
+                    updated_at=now,
+                    throttled_at=now,
+                ):
+                    return
+
+    def _state(self) -> RoutingRateLimit:
+        state, _ = RoutingRateLimit.objects.get_or_create(
+            backend=self.backend_name,
+            defaults={
+                "tokens": self.capacity,
+                "rate": self.max_rate,
+                "updated_at": time.time(),
+            },
+        )
+        # The configured rate may have been lowered since the row was saved.
+        state.rate = min(state.rate, self.max_rate)
+        return state
+
+    def _available(self, state: RoutingRateLimit, now: float) -> float:
+        return min(
+            self.capacity, state.tokens + max(now - state.updated_at, 0.0) * state.rate
+        )
+
+    def _update(self, state: RoutingRateLimit, **fields) -> bool:
+        return bool(
+            RoutingRateLimit.objects.filter(pk=state.pk, version=state.version).update(
+                version=F("version") + 1, **fields
+            )
+        )
+
+
+class CircuitBreaker:
+    # Opens after ``threshold`` consecutive upstream failures: callers then
+    # wait out ``cooldown`` seconds instead of hammering the backend, after
+    # which a single probe call decides between closing and another cooldown.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = max(int(threshold), 1)
+        self.cooldown = float(cooldown)
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self, timeout: float) -> None:
+        # Waits (at most ``timeout`` seconds) until a call may go through.
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self.state == self.CLOSED:
+                    return
+                now = time.monotonic()
+                if self.state == self.OPEN and now - self._opened_at >= self.cooldown:
+                    self.state = self.HALF_OPEN
+                    return
+                if self.state == self.OPEN:
+                    delay = self.cooldown - (now - self._opened_at)
+                else:
+                    # Another thread is probing.
+                    delay = min(self.cooldown, 0.1)
+            if time.monotonic() + delay > deadline:
+                raise CircuitOpenError("Routing backend circuit is open.", status_code=503)
+            time.sleep(delay)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        # Gives the probe slot back without a verdict (the call never reached
+        # the backend): the next caller probes instead.
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+class CallBudget:
+    # Hard cap on routing calls (retries included) for one run.
+    def __init__(self, max_calls: int) -> None:
+        self.max_calls = int(max_calls)
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def consume(self, calls: int = 1) -> None:
+        with self._lock:
+            if self.used + calls > self.max_calls:
+                raise RoutingBudgetExceeded(
+                    f"Routing call budget of {self.max_calls} calls exhausted."
+                )
+            self.used += calls
+
+
+class ResilientBackend:
+    # Wraps a routing backend with the shared rate limiter and the circuit
+    # breaker of its class, retries failed calls with jittered exponential
+    # backoff (or the delay the backend asked for in Retry-After) and
+    # enforces the run's call budget. Every attempt the breaker lets through
+    # is a routing call and counts against the budget, retries included.
+    # Other attributes pass through.
+    def __init__(
+        self,
+        backend,
+        backend_name: Optional[str] = None,
+        budget: Optional[CallBudget] = None,
+        on_retry: Optional[Callable[[], None]] = None,
+        max_attempts: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+    ) -> None:
+        self.backend = backend
+        self.backend_name = backend_name or type(backend).__name__
+        self.budget = budget
+        self.on_retry = on_retry
+        self.max_attempts = max(
+            int(max_attempts or getattr(settings, "HEATMAPS_ROUTING_RETRY_ATTEMPTS", 5)), 1
+        )
+        self.base_delay = float(
+            base_delay or getattr(settings, "HEATMAPS_ROUTING_RETRY_BASE_DELAY_SECONDS", 0.5)
+        )
+        self.max_delay = float(
+            max_delay or getattr(settings, "HEATMAPS_ROUTING_RETRY_MAX_DELAY_SECONDS", 60)
+        )
+        self.limiter = get_rate_limiter(self.backend_name)
+        self.breaker = get_circuit_breaker(self.backend_name)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_transit_duration_seconds(self, origin, destination, departure_time=None, mode="transit"):
+        return self._call(
+            1,
+            self.backend.get_transit_duration_seconds,
+            origin,
+            destination,
+            departure_time,
+            mode,
+        )
+
+    def get_duration_matrix(self, origins, destinations, departure_time=None, mode="transit"):
+        return self._call(
+            len(origins) * len(destinations),
+            self.backend.get_duration_matrix,
+            origins,
+            destinations,
+            departure_time,
+            mode,
+        )
+
+    def _call(self, elements: int, method, *args):
+        for attempt in range(self.max_attempts):
+            # Sit out one cooldown and its probe; a backend still failing
+            # after that fails the run rather than stalling it.
+            self.breaker.before_call(timeout=self.breaker.cooldown * 2)
+            try:
+                if self.budget is not None:
+                    self.budget.consume()
+                if self.limiter is not None:
+                    self.limiter.acquire(elements)
+                result = method(*args)
+            except Exception as exc:
+                # Every outcome settles the breaker, or a failed probe would
+                # hold it half open for good.
+                retryable = _is_retryable(exc)
+                if _backend_answered(exc):
+                    # Quota and client errors: the backend is up.
+                    self.breaker.record_success()
+                    if isinstance(exc, RoutingQuotaError) and self.limiter is not None:
+                        # Quota is not an outage: slow down instead.
+                        self.limiter.on_throttle()
+                elif retryable:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.release()
+                if not retryable or attempt == self.max_attempts - 1:
+                    raise
+                if self.on_retry is not None:
+                    self.on_retry()
+                time.sleep(self._delay(attempt, getattr(exc, "retry_after", None)))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            if self.limiter is not None:
+                self.limiter.on_success()
+            return result
+
+    def _delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        # Full jitter, so that threads throttled together do not retry
+        # together; Retry-After is a floor.
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None:
+            delay = min(max(delay, float(retry_after)), self.max_delay)
+        return delay
+
+
+def _backend_answered(exc: Exception) -> bool:
+    if isinstance(exc, (RoutingBudgetExceeded, CircuitOpenError)):
+        return False
+    if isinstance(exc, RoutingQuotaError):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    return (
+        isinstance(exc, RoutingBackendError)
+        and status_code is not None
+        and 400 <= status_code < 500
+        and status_code != 408
+    )
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (RoutingBudgetExceeded, CircuitOpenError)):
+        return False
+    if isinstance(exc, RoutingBackendError):
+        status_code = exc.status_code
+        return status_code is None or status_code in (408, 429) or status_code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+_breakers: Dict[tuple, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_rate_limiter(backend_name: str) -> Optional[TokenBucket]:
+    rate = float(getattr(settings, "HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND", 0))
+    if rate <= 0:
+        return None
+    return TokenBucket(
+        backend_name, rate, getattr(settings, "HEATMAPS_ROUTING_RATE_LIMIT_BURST", None)
+    )
+
+
+def get_circuit_breaker(backend_name: str) -> CircuitBreaker:
+    # One breaker per backend and process, replaced when its settings change.
+    threshold = getattr(settings, "HEATMAPS_ROUTING_BREAKER_THRESHOLD", 5)
+    cooldown = getattr(settings, "HEATMAPS_ROUTING_BREAKER_COOLDOWN_SECONDS", 30)
+    key = (backend_name, threshold, cooldown)
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(threshold, cooldown)
+        return _breakers[key]
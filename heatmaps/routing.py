@@ -0,0 +1,109 @@
+import asyncio
+import datetime as dt
+from typing import List, Optional, Protocol, Sequence, runtime_checkable
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from heatmaps.models import TargetPoint
+
+
+class RoutingBackendError(RuntimeError):
+    # A failed routing request. ``status_code`` follows HTTP semantics (429
+    # for quota, 5xx for server errors) and ``retry_after`` is the delay in
+    # seconds the backend asked for, if any.
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RoutingQuotaError(RoutingBackendError):
+    pass
+
+
+@runtime_checkable
+class RoutingBackend(Protocol):
+    # What compute_times needs from a routing backend. Durations are in
+    # seconds, None when there is no route; failures raise
+    # RoutingBackendError. Backends are built by get_routing_backend with a
+    # ``pool_size`` keyword (the number of concurrent calls of the run) and
+    # may set ``is_local = True`` (answers from memory: no travel-time cache
+    # or pruning) and ``matrix_batch_size`` (origins per matrix call).
+    def get_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]: ...
+
+    def get_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]: ...
+
+    async def aget_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]: ...
+
+    async def aget_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]: ...
+
+
+class AsyncRoutingMixin:
+    # Async calls for backends that block: the sync call runs in a thread.
+    async def aget_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]:
+        return await asyncio.to_thread(
+            self.get_transit_duration_seconds, origin, destination, departure_time, mode
+        )
+
+    async def aget_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]:
+        return await asyncio.to_thread(
+            self.get_duration_matrix, origins, destinations, departure_time, mode
+        )
+
+
+def get_routing_backend(
+    mode: str = "transit", pool_size: int = 10, name: Optional[str] = None
+) -> RoutingBackend:
+    # ``name`` defaults to the backend configured for the mode, then to
+    # HEATMAPS_ROUTING_BACKEND.
+    if name is None:
+        name = getattr(settings, "HEATMAPS_ROUTING_MODE_BACKENDS", {}).get(mode) or getattr(
+            settings, "HEATMAPS_ROUTING_BACKEND", "google"
+        )
+    backends = getattr(settings, "HEATMAPS_ROUTING_BACKENDS", {})
+    if name not in backends:
+        raise ImproperlyConfigured(f"Unknown routing backend {name!r}.")
+    return import_string(backends[name])(pool_size=pool_size)
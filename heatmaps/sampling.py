@@ -0,0 +1,291 @@
+import datetime as dt
+import sys
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+import shapely
+from django.conf import settings
+
+from heatmaps.models import TargetPoint
+from heatmaps.routing import get_routing_backend
+from heatmaps.services import (
+    Cell,
+    GridGenerator,
+    aggregate_durations,
+    compute_times,
+    target_key,
+)
+
+# Inverse-distance weighting parameters for budgeted runs.
+IDW_NEIGHBOURS = 8
+IDW_POWER = 2.0
+IDW_CHUNK_SIZE = 2048
+
+
+def compute_adaptive_times(
+    polygon_geojson: dict,
+    resolution_m: float,
+    min_cell_size_m: float,
+    threshold_minutes: float,
+    targets: Iterable[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    metric: str,
+    mode: str = "transit",
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    grid_generator: Optional[GridGenerator] = None,
+    **compute_kwargs,
+) -> List[dict]:
+    generator = grid_generator or GridGenerator()
+    projected = generator.project_polygon(polygon_geojson)
+    xs, ys = generator.generate_projected_grid(projected, resolution_m)
+    targets_list = list(targets)
+    size = generator.cell_size(resolution_m)
+    final: List[dict] = []
+    cells_done = 0
+
+    while len(xs):
+        lngs, lats = generator.to_wgs(xs, ys)
+        cells = [Cell(lat=lat, lng=lng) for lat, lng in zip(lats.tolist(), lngs.tolist())]
+        level_callback = (
+            None
+            if progress_callback is None
+            else _offset_callback(progress_callback, cells_done)
+        )
+        results = compute_times(
+            cells,
+            targets_list,
+            departure_time,
+            metric,
+            mode,
+            progress_callback=level_callback,
+            **compute_kwargs,
+        )
+        cells_done += len(results)
+        for result in results:
+            result["cell_size_m"] = size
+
+        child_size = size / 2
+        if child_size < min_cell_size_m:
+            final.extend(results)
+            break
+
+        times = np.array(
+            [np.nan if r["time_minutes"] is None else r["time_minutes"] for r in results],
+            dtype=float,
+        )
+        split = _cells_to_refine(generator, xs, ys, times, size, threshold_minutes)
+
+        # Each split cell is replaced by its children (GridGenerator.child_points)
+        # that fall inside the polygon; a cell with none inside is kept as is.
+        child_x, child_y = generator.child_points(xs[split], ys[split], size)
+        inside = shapely.contains_xy(projected, child_x, child_y)
+        refined = np.flatnonzero(split)[inside.any(axis=0)]
+        keep = np.ones(len(results), dtype=bool)
+        keep[refined] = False
+        final.extend(result for result, kept in zip(results, keep) if kept)
+
+        xs = child_x[inside]
+        ys = child_y[inside]
+        size = child_size
+    return final
+
+
+def _offset_callback(
+    progress_callback: Callable[[int, int], None], offset: int
+) -> Callable[[int, int], None]:
+    # Progress of one level, counted after the cells of the levels before it.
+    def callback(done: int, total: int) -> None:
+        progress_callback(offset + done, offset + total)
+
+    return callback
+
+
+def _cells_to_refine(
+    generator: GridGenerator,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    times: np.ndarray,
+    size: float,
+    threshold_minutes: float,
+) -> np.ndarray:
+    # Cells of one level sit on a regular lattice with spacing ``size``; mark
+    # every cell with an edge neighbour whose time differs by more than the
+    # threshold, or where only one of the two has a time.
+    neighbours = generator.neighbours(xs, ys, size)
+    has_neighbour = neighbours >= 0
+    neighbour_times = np.where(has_neighbour, times[neighbours], np.nan)
+    differs = has_neighbour & (
+        (np.abs(times[:, None] - neighbour_times) > threshold_minutes)
+        | (np.isnan(times)[:, None] != np.isnan(neighbour_times))
+    )
+    return differs.any(axis=1)
+
+
+def compute_budgeted_times(
+    polygon_geojson: dict,
+    resolution_m: float,
+    call_budget: int,
+    targets: Iterable[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    metric: str,
+    mode: str = "transit",
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    grid_generator: Optional[GridGenerator] = None,
+    **compute_kwargs,
+) -> List[dict]:
+    generator = grid_generator or GridGenerator()
+    projected = generator.project_polygon(polygon_geojson)
+    xs, ys = generator.generate_projected_grid(projected, resolution_m)
+    lngs, lats = generator.to_wgs(xs, ys)
+    cells = [Cell(lat=lat, lng=lng) for lat, lng in zip(lats.tolist(), lngs.tolist())]
+    targets_list = list(targets)
+    sample_size = _sample_size(call_budget, len(targets_list), mode, compute_kwargs)
+    if sample_size >= len(cells):
+        return compute_times(
+            cells,
+            targets_list,
+            departure_time,
+            metric,
+            mode,
+            progress_callback=progress_callback,
+            **compute_kwargs,
+        )
+
+    sampled = _spread_sample(generator, xs, ys, resolution_m, sample_size)
+    # Durations are interpolated target by target, so every sample needs all
+    # of them: a pruned pair would leave the target to its nearby samples only.
+    compute_kwargs["prune"] = False
+    sampled_results = compute_times(
+        [cells[index] for index in sampled],
+        targets_list,
+        departure_time,
+        metric,
+        mode,
+        progress_callback=progress_callback,
+        **compute_kwargs,
+    )
+
+    is_sampled = np.zeros(len(cells), dtype=bool)
+    is_sampled[sampled] = True
+    missing = np.flatnonzero(~is_sampled)
+    durations = np.full((len(missing), len(targets_list)), np.nan)
+    sample_durations = np.array(
+        [
+            [np.nan if value is None else value for value in result["raw"]["durations"]]
+            for result in sampled_results
+        ],
+        dtype=float,
+    ).reshape(len(sampled), len(targets_list))
+    sample_xy = np.column_stack([xs[sampled], ys[sampled]])
+    query_xy = np.column_stack([xs[missing], ys[missing]])
+    for column in range(len(targets_list)):
+        known = ~np.isnan(sample_durations[:, column])
+        if known.any():
+            durations[:, column] = _idw(
+                sample_xy[known], sample_durations[known, column], query_xy
+            )
+
+    keys = [target_key(target) for target in targets_list]
+    results: List[Optional[dict]] = [None] * len(cells)
+    for index, result in zip(sampled, sampled_results):
+        results[index] = result
+    for row, index in enumerate(missing):
+        cell_durations = [
+            None if np.isnan(value) else int(round(value)) for value in durations[row]
+        ]
+        results[index] = {
+            "lat": cells[index].lat,
+            "lng": cells[index].lng,
+            "time_minutes": aggregate_durations(
+                cell_durations,
+                targets_list,
+                metric,
+                compute_kwargs.get("percentile", 50.0),
+            ),
+            "raw": {"durations": cell_durations, "targets": keys, "interpolated": True},
+        }
+    return results
+
+
+def _sample_size(call_budget: int, num_targets: int, mode: str, compute_kwargs: dict) -> int:
+    # Cells the budget buys on the path compute_times will take: matrix runs
+    # send one call per batch of cells with every target, pairwise runs one
+    # per pair. Cache hits are free, so the budget is an upper bound.
+    client = compute_kwargs.get("client") or get_routing_backend(mode, pool_size=1)
+    if getattr(client, "is_local", False):
+        return sys.maxsize
+    use_matrix = compute_kwargs.get("use_matrix")
+    if use_matrix is None:
+        use_matrix = getattr(settings, "HEATMAPS_ROUTING_USE_MATRIX", True)
+    if use_matrix and hasattr(client, "get_duration_matrix"):
+        matrix_batch_size = getattr(client, "matrix_batch_size", None) or getattr(
+            settings, "HEATMAPS_ROUTING_MATRIX_BATCH_SIZE", 25
+        )
+        return max(call_budget * max(int(matrix_batch_size), 1), 1)
+    return max(call_budget // max(num_targets, 1), 1)
+
+
+def _spread_sample(
+    generator: GridGenerator,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    resolution_m: float,
+    sample_size: int,
+) -> np.ndarray:
+    # Snap a 2-D Halton sequence over the bounding box onto the lattice, so the
+    # chosen cells are well spread and the selection is deterministic.
+    ix, iy = generator.lattice_indices(xs, ys, generator.cell_size(resolution_m))
+    position = np.full((ix.max() + 1, iy.max() + 1), -1, dtype=int)
+    position[ix, iy] = np.arange(len(xs))
+    chosen = np.zeros(len(xs), dtype=bool)
+    selected: List[int] = []
+    start = 1
+    batch = max(sample_size, 64)
+    while len(selected) < sample_size and start <= 64 * len(xs):
+        indices = np.arange(start, start + batch)
+        start += batch
+        hx = np.rint(_radical_inverse(indices, 2) * ix.max()).astype(int)
+        hy = np.rint(_radical_inverse(indices, 3) * iy.max()).astype(int)
+        for candidate in position[hx, hy].tolist():
+            if candidate >= 0 and not chosen[candidate]:
+                chosen[candidate] = True
+                selected.append(candidate)
+                if len(selected) == sample_size:
+                    break
+    if len(selected) < sample_size:
+        # Very thin polygons: top up with evenly strided remaining cells.
+        remaining = np.flatnonzero(~chosen)
+        stride = np.linspace(0, len(remaining) - 1, sample_size - len(selected))
+        selected.extend(remaining[np.rint(stride).astype(int)].tolist())
+    return np.array(sorted(set(selected)), dtype=int)
+
+
+def _radical_inverse(indices: np.ndarray, base: int) -> np.ndarray:
+    result = np.zeros(len(indices), dtype=float)
+    fraction = 1.0 / base
+    remaining = indices.copy()
+    while remaining.any():
+        result += (remaining % base) * fraction
+        remaining //= base
+        fraction /= base
+    return result
+
+
+def _idw(
+    sample_xy: np.ndarray, sample_values: np.ndarray, query_xy: np.ndarray
+) -> np.ndarray:
+    neighbours = min(IDW_NEIGHBOURS, len(sample_values))
+    values = np.empty(len(query_xy), dtype=float)
+    for start in range(0, len(query_xy), IDW_CHUNK_SIZE):
+        chunk = query_xy[start : start + IDW_CHUNK_SIZE]
+        distances = np.hypot(
+            chunk[:, 0, None] - sample_xy[None, :, 0],
+            chunk[:, 1, None] - sample_xy[None, :, 1],
+        )
+        nearest = np.argpartition(distances, neighbours - 1, axis=1)[:, :neighbours]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        weights = 1.0 / np.maximum(nearest_distances, 1e-9) ** IDW_POWER
+        values[start : start + len(chunk)] = (
+            weights * sample_values[nearest]
+        ).sum(axis=1) / weights.sum(axis=1)
+    return values
@@ -1,6 +1,15 @@
 from rest_framework import serializers
 
-from heatmaps.models import CellResult, ComputationResult, Scenario, TargetPoint
+from heatmaps.models import CellResult, ComputationResult, IsochroneSet, Scenario, TargetPoint
+from heatmaps.services import target_key
+from heatmaps.storage import (
+    clear_result_times,
+    clear_results,
+    has_pruned_durations,
+    mark_results_stale,
+    reaggregate_results,
+)
+from heatmaps.tiles import invalidate_tile_cache
 
 
 class TargetPointSerializer(serializers.ModelSerializer):
@@ -9,9 +18,35 @@ class TargetPointSerializer(serializers.ModelSerializer):
         fields = ("id", "name", "lat", "lng", "weight")
 
 
+ROUTING_FIELDS = {"mode", "departure_time"}
+GRID_FIELDS = {
+    "polygon_geojson",
+    "grid_resolution_m",
+    "grid_alignment",
+    "grid_shape",
+    "sampling_mode",
+    "refine_threshold_minutes",
+    "min_cell_size_m",
+    "call_budget",
+}
+
+
 class ScenarioSerializer(serializers.ModelSerializer):
     targets = TargetPointSerializer(many=True)
 
+    def validate(self, attrs):
+        sampling_mode = attrs.get(
+            "sampling_mode", self.instance.sampling_mode if self.instance else None
+        )
+        call_budget = attrs.get(
+            "call_budget", self.instance.call_budget if self.instance else None
+        )
+        if sampling_mode == Scenario.SAMPLING_BUDGETED and not call_budget:
+            raise serializers.ValidationError(
+                {"call_budget": "A call budget is required for budgeted sampling."}
+            )
+        return attrs
+
     class Meta:
         model = Scenario
         fields = (
@@ -21,9 +56,17 @@ class ScenarioSerializer(serializers.ModelSerializer):
             "created_at",
             "polygon_geojson",
             "metric",
+            "metric_percentile",
             "mode",
             "departure_time",
             "grid_resolution_m",
+            "grid_alignment",
+            "grid_shape",
+            "sampling_mode",
+            "refine_threshold_minutes",
+            "min_cell_size_m",
+            "call_budget",
+            "max_api_calls",
             "targets",
         )
         read_only_fields = ("creator", "created_at")
@@ -38,16 +81,76 @@ class ScenarioSerializer(serializers.ModelSerializer):
         )
         return scenario
 
+    def update(self, instance, validated_data):
+        targets_data = validated_data.pop("targets", None)
+        # Stored durations are only valid for the routing parameters they
+        # were fetched with; grid and target changes are diffed by the run.
+        # Any of them leaves the stored times, tiles and isochrones stale.
+        changed = {
+            field
+            for field, value in validated_data.items()
+            if value != getattr(instance, field)
+        }
+        target_keys = {target_key(target) for target in instance.targets.all()}
+        instance = super().update(instance, validated_data)
+        if targets_data is not None:
+            instance.targets.all().delete()
+            for target in targets_data:
+                TargetPoint.objects.create(scenario=instance, **target)
+        targets_moved = targets_data is not None and target_keys != {
+            target_key(target) for target in instance.targets.all()
+        }
+        if changed & ROUTING_FIELDS:
+            clear_results(instance)
+            mark_results_stale(instance)
+        elif changed & GRID_FIELDS:
+            # Cells still on the new grid keep their durations for the rerun;
+            # the others are dropped by it. Until then no time is current.
+            clear_result_times(instance)
+            mark_results_stale(instance)
+        elif targets_moved:
+            # Added or moved targets have no stored durations: drop the times
+            # until the rerun, which only fetches the new pairs.
+            clear_result_times(instance)
+            mark_results_stale(instance)
+        elif changed & {"metric", "metric_percentile"} or targets_data is not None:
+            # Switching the metric or the weights is a NumPy pass over the
+            # stored durations; no routing calls. Pruned pairs were never
+            # fetched, so only MIN does without a rerun once a run pruned.
+            reaggregate_results(instance)
+            if instance.metric != Scenario.METRIC_MIN and has_pruned_durations(instance):
+                mark_results_stale(instance)
+        else:
+            return instance
+        invalidate_tile_cache(instance.id)
+        IsochroneSet.objects.filter(scenario=instance).delete()
+        instance.computation.refresh_from_db(fields=["status"])
+        return instance
+
 
 class ComputationResultSerializer(serializers.ModelSerializer):
     class Meta:
         model = ComputationResult
         fields = (
             "status",
+            "queued_at",
             "started_at",
             "finished_at",
             "num_cells",
+            "cells_done",
+            "cells_total",
+            "estimated_finished_at",
             "error_message",
+            "resume",
+            "cells_saved",
+            "cells_reused",
+            "api_calls",
+            "api_elements",
+            "api_errors",
+            "api_retries",
+            "cache_hits",
+            "cache_misses",
+            "stage_seconds",
         )
 
 
@@ -64,9 +167,17 @@ class ScenarioDetailSerializer(serializers.ModelSerializer):
             "created_at",
             "polygon_geojson",
             "metric",
+            "metric_percentile",
             "mode",
             "departure_time",
             "grid_resolution_m",
+            "grid_alignment",
+            "grid_shape",
+            "sampling_mode",
+            "refine_threshold_minutes",
+            "min_cell_size_m",
+            "call_budget",
+            "max_api_calls",
             "targets",
             "computation",
         )
@@ -75,4 +186,4 @@ class ScenarioDetailSerializer(serializers.ModelSerializer):
 class CellResultSerializer(serializers.ModelSerializer):
     class Meta:
         model = CellResult
-        fields = ("lat", "lng", "time_minutes", "raw")
+        fields = ("lat", "lng", "time_minutes", "cell_size_m", "raw")
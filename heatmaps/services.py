@@ -1,13 +1,37 @@
 import datetime as dt
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Iterable, List, Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
 import requests
+import shapely
+from django.conf import settings
 from pyproj import Transformer
-from shapely.geometry import Point, shape
+from requests.adapters import HTTPAdapter
+from shapely.geometry import shape
+from shapely.ops import transform as shapely_transform
 
+from heatmaps.cache import TravelTimeCache, get_travel_time_cache
+from heatmaps.instrumentation import (
+    InstrumentedBackend,
+    RunMetrics,
+    record_cache_lookups,
+    stage,
+)
 from heatmaps.models import Scenario, TargetPoint
+from heatmaps.resilience import CallBudget, ResilientBackend
+from heatmaps.routing import (
+    AsyncRoutingMixin,
+    RoutingBackend,
+    RoutingBackendError,
+    RoutingQuotaError,
+    get_routing_backend,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -16,9 +40,44 @@ class Cell:
     lng: float
 
 
-class GoogleDirectionsClient:
-    def __init__(self, api_key: Optional[str] = None) -> None:
+ROUTES_API_BASE_URL = "https://routes.googleapis.com"
+# Element limits of computeRouteMatrix (origins x destinations per request).
+ROUTE_MATRIX_MAX_ELEMENTS = 625
+ROUTE_MATRIX_MAX_TRANSIT_ELEMENTS = 100
+# Smallest radius of curvature of the WGS84 ellipsoid (meridian, at the
+# equator): great-circle distances on this sphere never exceed the geodesic.
+LOWER_BOUND_EARTH_RADIUS_M = 6_335_439.0
+# Bits per lattice axis in a cell ID; enough for a 1 m global lattice.
+CELL_ID_AXIS_BITS = 26
+# Hexagon centre spacing per unit of grid resolution (see cell_size).
+HEX_SPACING_FACTOR = float(np.sqrt(1.5))
+
+
+def _build_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class GoogleDirectionsClient(AsyncRoutingMixin):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        session: Optional[requests.Session] = None,
+        pool_size: int = 10,
+        timeout: float = 20,
+    ) -> None:
         self.api_key = api_key or os.getenv("GOOGLE_MAPS_API_KEY")
+        self.base_url = (
+            base_url or os.getenv("GOOGLE_ROUTES_BASE_URL") or ROUTES_API_BASE_URL
+        ).rstrip("/")
+        # A shared session keeps TLS connections alive between calls and is
+        # safe to use from the worker threads of compute_times.
+        self.session = session or _build_session(pool_size)
+        self.timeout = timeout
 
     def get_transit_duration_seconds(
         self,
@@ -42,33 +101,38 @@ class GoogleDirectionsClient:
         }
         if departure_time:
             payload["departureTime"] = departure_time.isoformat()
-        response = requests.post(
-            "https://routes.googleapis.com/directions/v2:computeRoutes",
+        response = self.session.post(
+            f"{self.base_url}/directions/v2:computeRoutes",
             headers={
                 "X-Goog-Api-Key": self.api_key,
                 "X-Goog-FieldMask": "routes.duration",
                 "Content-Type": "application/json",
             },
             json=payload,
-            timeout=20,
+            timeout=self.timeout,
         )
         try:
             response.raise_for_status()
         except requests.HTTPError as exc:
-            print(
-                "Google Routes HTTP error for "
-                f"({origin.lat}, {origin.lng}) -> ({destination.lat}, {destination.lng}): "
-                f"{response.status_code} - {response.text}"
+            logger.warning(
+                "Google Routes HTTP error for (%s, %s) -> (%s, %s): %s - %s",
+                origin.lat,
+                origin.lng,
+                destination.lat,
+                destination.lng,
+                response.status_code,
+                response.text,
             )
-            raise RuntimeError(
-                f"Google Routes HTTP error {response.status_code}: {response.text}"
-            ) from exc
+            raise _http_error(response) from exc
         data = response.json()
         if "routes" not in data or not data["routes"]:
-            print(
-                "Google Routes error for "
-                f"({origin.lat}, {origin.lng}) -> ({destination.lat}, {destination.lng}): "
-                f"{data.get('error', {}).get('message', 'No routes returned')}"
+            logger.info(
+                "Google Routes error for (%s, %s) -> (%s, %s): %s",
+                origin.lat,
+                origin.lng,
+                destination.lat,
+                destination.lng,
+                data.get("error", {}).get("message", "No routes returned"),
             )
             return None
         try:
@@ -76,6 +140,107 @@ class GoogleDirectionsClient:
         except (KeyError, IndexError, TypeError):
             return None
 
+    def get_duration_matrix(
+        self,
+        origins: Sequence[Cell],
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]:
+        if not self.api_key:
+            raise RuntimeError("Missing GOOGLE_MAPS_API_KEY for Google Routes API.")
+        if mode == "transit" and not departure_time:
+            departure_time = dt.datetime.now(tz=dt.timezone.utc)
+        matrix: List[List[Optional[int]]] = [[None] * len(destinations) for _ in origins]
+        if not origins or not destinations:
+            return matrix
+        max_elements = (
+            ROUTE_MATRIX_MAX_TRANSIT_ELEMENTS
+            if mode == "transit"
+            else ROUTE_MATRIX_MAX_ELEMENTS
+        )
+        destinations_per_request = min(len(destinations), max_elements)
+        origins_per_request = max(max_elements // destinations_per_request, 1)
+        for dest_start in range(0, len(destinations), destinations_per_request):
+            dest_block = destinations[dest_start : dest_start + destinations_per_request]
+            for origin_start in range(0, len(origins), origins_per_request):
+                origin_block = origins[origin_start : origin_start + origins_per_request]
+                block = self._compute_route_matrix(
+                    origin_block, dest_block, departure_time, mode
+                )
+                for i, row in enumerate(block):
+                    matrix[origin_start + i][dest_start : dest_start + len(row)] = row
+        return matrix
+
+    def _compute_route_matrix(
+        self,
+        origins: Sequence[Cell],
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime],
+        mode: str,
+    ) -> List[List[Optional[int]]]:
+        payload = {
+            "origins": [
+                {"waypoint": {"location": {"latLng": {"latitude": o.lat, "longitude": o.lng}}}}
+                for o in origins
+            ],
+            "destinations": [
+                {"waypoint": {"location": {"latLng": {"latitude": d.lat, "longitude": d.lng}}}}
+                for d in destinations
+            ],
+            "travelMode": mode.upper(),
+        }
+        if departure_time:
+            payload["departureTime"] = departure_time.isoformat()
+        response = self.session.post(
+            f"{self.base_url}/distanceMatrix/v2:computeRouteMatrix",
+            headers={
+                "X-Goog-Api-Key": self.api_key,
+                "X-Goog-FieldMask": "originIndex,destinationIndex,duration,condition",
+                "Content-Type": "application/json",
+            },
+            json=payload,
+            timeout=self.timeout,
+        )
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as exc:
+            logger.warning(
+                "Google Route Matrix HTTP error for %sx%s block: %s - %s",
+                len(origins),
+                len(destinations),
+                response.status_code,
+                response.text,
+            )
+            raise _http_error(response) from exc
+        block: List[List[Optional[int]]] = [[None] * len(destinations) for _ in origins]
+        for element in response.json():
+            # Zero indexes are omitted from the proto3 JSON encoding.
+            origin_index = element.get("originIndex", 0)
+            destination_index = element.get("destinationIndex", 0)
+            if element.get("condition") != "ROUTE_EXISTS":
+                continue
+            try:
+                block[origin_index][destination_index] = _parse_duration_seconds(
+                    element.get("duration")
+                )
+            except (IndexError, TypeError, ValueError):
+                continue
+        return block
+
+
+def _http_error(response: requests.Response) -> RoutingBackendError:
+    error_class = RoutingQuotaError if response.status_code == 429 else RoutingBackendError
+    try:
+        retry_after = float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        retry_after = None
+    return error_class(
+        f"Google Routes HTTP error {response.status_code}: {response.text}",
+        status_code=response.status_code,
+        retry_after=retry_after,
+    )
+
 
 def _parse_duration_seconds(duration_value: str) -> Optional[int]:
     if not duration_value:
@@ -88,36 +253,331 @@ def _parse_duration_seconds(duration_value: str) -> Optional[int]:
 
 
 class GridGenerator:
-    def __init__(self) -> None:
+    # ``aligned`` anchors the lattice on the global Mercator lattice of the
+    # resolution (points at integer multiples of it) instead of the polygon's
+    # own bounds, so overlapping scenarios share their cells and cell IDs.
+    # ``shape`` picks square cells or pointy-top hexagons; see cell_size.
+    def __init__(self, aligned: bool = False, shape: str = Scenario.GRID_SQUARE) -> None:
+        self.aligned = aligned
+        self.shape = shape
         self._to_mercator = Transformer.from_crs(4326, 3857, always_xy=True)
         self._to_wgs = Transformer.from_crs(3857, 4326, always_xy=True)
 
+    @classmethod
+    def for_scenario(cls, scenario: Scenario) -> "GridGenerator":
+        return cls(
+            aligned=scenario.grid_alignment == Scenario.GRID_GLOBAL,
+            shape=scenario.grid_shape,
+        )
+
+    @property
+    def is_hex(self) -> bool:
+        return self.shape == Scenario.GRID_HEX
+
+    def cell_size(self, resolution_m: float) -> float:
+        # Distance between neighbouring cell centres. Hexagons get the same
+        # covering radius as squares of the resolution (no point is further
+        # than resolution / sqrt(2) from a sample), which takes ~23% fewer
+        # cells for the same area.
+        return float(resolution_m) * (HEX_SPACING_FACTOR if self.is_hex else 1.0)
+
     def generate_grid(self, polygon_geojson: dict, resolution_m: int) -> List[Cell]:
-        polygon = shape(polygon_geojson)
-        projected = self._project_geometry(polygon)
+        lngs, lats = self.generate_grid_arrays(polygon_geojson, resolution_m)
+        return [Cell(lat=lat, lng=lng) for lat, lng in zip(lats.tolist(), lngs.tolist())]
+
+    def generate_grid_arrays(
+        self, polygon_geojson: dict, resolution_m: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        xs, ys = self.generate_projected_grid(
+            self.project_polygon(polygon_geojson), resolution_m
+        )
+        return self.to_wgs(xs, ys)
+
+    def project_polygon(self, polygon_geojson: dict):
+        projected = self._project_geometry(shape(polygon_geojson))
+        shapely.prepare(projected)
+        return projected
+
+    def generate_projected_grid(
+        self, projected, resolution_m: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if self.is_hex:
+            return self._generate_hex_grid(projected, resolution_m)
+        xs, ys, inside = self.generate_lattice(projected, resolution_m)
+        # Column-major like the scalar walk: x in the outer loop, y in the inner.
+        grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+        return grid_x[inside], grid_y[inside]
+
+    def generate_lattice(
+        self, projected, resolution_m: float
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Square lattices only: axes and an x-major inside mask.
+        minx, miny, maxx, maxy = projected.bounds
+        if self.aligned:
+            xs = _aligned_lattice_axis(minx, maxx, resolution_m)
+            ys = _aligned_lattice_axis(miny, maxy, resolution_m)
+        else:
+            xs = _lattice_axis(minx, maxx, resolution_m)
+            ys = _lattice_axis(miny, maxy, resolution_m)
+        grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+        inside = shapely.contains_xy(projected, grid_x, grid_y)
+        return xs, ys, inside
+
+    def _generate_hex_grid(self, projected, resolution_m: float) -> Tuple[np.ndarray, np.ndarray]:
         minx, miny, maxx, maxy = projected.bounds
-        cells: List[Cell] = []
-        x = minx
-        while x <= maxx:
-            y = miny
-            while y <= maxy:
-                point = Point(x, y)
-                if projected.contains(point):
-                    lng, lat = self._to_wgs.transform(x, y)
-                    cells.append(Cell(lat=lat, lng=lng))
-                y += resolution_m
-            x += resolution_m
-        return cells
+        origin_x, origin_y = self.lattice_origin(projected)
+        size = self.cell_size(resolution_m)
+        row_height = size * np.sqrt(3) / 2
+        r = np.arange(
+            np.ceil((miny - origin_y) / row_height), np.floor((maxy - origin_y) / row_height) + 1
+        )
+        if not len(r):
+            return np.empty(0), np.empty(0)
+        q = np.arange(
+            np.ceil((minx - origin_x) / size - r.max() / 2),
+            np.floor((maxx - origin_x) / size - r.min() / 2) + 1,
+        )
+        # q-major, r inner, like the square walk.
+        grid_q, grid_r = np.meshgrid(q, r, indexing="ij")
+        xs = origin_x + size * (grid_q + grid_r / 2)
+        ys = origin_y + row_height * grid_r
+        in_box = (xs >= minx) & (xs <= maxx)
+        xs, ys = xs[in_box], ys[in_box]
+        inside = shapely.contains_xy(projected, xs, ys)
+        return xs[inside], ys[inside]
+
+    def to_wgs(self, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        lngs, lats = self._to_wgs.transform(xs, ys)
+        return np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float)
+
+    def to_mercator(self, lngs: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        xs, ys = self._to_mercator.transform(
+            np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float)
+        )
+        return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+
+    def lattice_origin(self, projected) -> Tuple[float, float]:
+        if self.aligned:
+            return 0.0, 0.0
+        minx, miny, _, _ = projected.bounds
+        return minx, miny
+
+    def cell_ids(
+        self,
+        lats: np.ndarray,
+        lngs: np.ndarray,
+        origin: Tuple[float, float],
+        resolution_m: float,
+        sizes: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        # Cells are identified by their lattice indices: ``sizes`` (the cell
+        # size of the resolution when omitted) give the depth of refined
+        # cells, whose indices count cells of their own size. See
+        # encode_cell_ids and parent_cell_ids.
+        xs, ys = self.to_mercator(lngs, lats)
+        base = self.cell_size(resolution_m)
+        if sizes is None:
+            depth = np.zeros(len(xs), dtype=np.int64)
+        else:
+            depth = np.rint(np.log2(base / np.asarray(sizes, dtype=float)))
+            depth = np.maximum(depth, 0).astype(np.int64)
+        return self.locate(xs, ys, origin, resolution_m, depth)
+
+    def locate(
+        self,
+        xs: np.ndarray,
+        ys: np.ndarray,
+        origin: Tuple[float, float],
+        resolution_m: float,
+        depth: np.ndarray,
+    ) -> np.ndarray:
+        # ID of the depth-``depth`` cell containing each Mercator point.
+        ix, iy = self._lattice_indices(
+            np.asarray(xs, dtype=float) - origin[0],
+            np.asarray(ys, dtype=float) - origin[1],
+            self.cell_size(resolution_m),
+            np.broadcast_to(np.asarray(depth, dtype=np.int64), np.shape(xs)),
+        )
+        return encode_cell_ids(
+            ix.ravel(), iy.ravel(), np.broadcast_to(depth, np.shape(xs)).ravel()
+        ).reshape(np.shape(xs))
+
+    def cell_index(
+        self,
+        cell_ids: np.ndarray,
+        xs: np.ndarray,
+        ys: np.ndarray,
+        origin: Tuple[float, float],
+        resolution_m: float,
+    ) -> np.ndarray:
+        # Index in ``cell_ids`` of the cell covering each Mercator point, -1
+        # where none does. A refined cell covers the finest cells descending
+        # from it (parent_cell_ids), which for hexagons is not quite the
+        # parent hexagon, so walk up from the finest level present.
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        found = np.full(np.shape(xs), -1, dtype=np.int64)
+        if not len(cell_ids):
+            return found
+        order = np.argsort(cell_ids)
+        sorted_ids = cell_ids[order]
+        finest = int(decode_cell_ids(cell_ids)[2].max())
+        ids = self.locate(xs, ys, origin, resolution_m, np.full(np.shape(xs), finest))
+        for _ in range(finest + 1):
+            position = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            hit = (found < 0) & (sorted_ids[position] == ids)
+            found = np.where(hit, order[position], found)
+            ids = parent_cell_ids(ids, self.shape)
+        return found
+
+    def neighbours(self, xs: np.ndarray, ys: np.ndarray, size: float) -> np.ndarray:
+        # Index of the 4 (square) or 6 (hex) edge neighbours of every cell of
+        # one level (cells of size ``size`` on a common lattice), -1 where
+        # there is none.
+        if not len(xs):
+            return np.empty((0, len(self._neighbour_offsets())), dtype=int)
+        ix, iy = self.lattice_indices(xs, ys, size)
+        ix, iy = ix + 1, iy + 1
+        position = np.full((ix.max() + 2, iy.max() + 2), -1, dtype=int)
+        position[ix, iy] = np.arange(len(xs))
+        return np.stack(
+            [position[ix + dx, iy + dy] for dx, dy in self._neighbour_offsets()], axis=1
+        )
+
+    def lattice_indices(
+        self, xs: np.ndarray, ys: np.ndarray, size: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Non-negative integer lattice coordinates (x/y for squares, axial
+        # q/r for hexagons) of cells of one level, for dense lookup arrays.
+        # Relative to a cell centre, so every centre maps to whole indices.
+        ix, iy = self._lattice_indices(
+            xs - xs[0], ys - ys[0], size, np.zeros(len(xs), dtype=np.int64)
+        )
+        return ix - ix.min(), iy - iy.min()
+
+    def child_points(
+        self, xs: np.ndarray, ys: np.ndarray, size: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Centres of the cells one level down (size / 2), as (children, cells)
+        # arrays. Squares split into their four quadrants; a hexagon keeps
+        # its centre plus three alternate neighbours of the finer lattice
+        # (aperture 4), so every finer cell has exactly one parent.
+        if self.is_hex:
+            half = size / 2
+            dx = half * np.array([0.0, 1.0, 0.5, -0.5])
+            dy = half * np.sqrt(3) / 2 * np.array([0.0, 0.0, 1.0, 1.0])
+        else:
+            quarter = size / 4
+            dx = quarter * np.array([-1.0, 1.0, -1.0, 1.0])
+            dy = quarter * np.array([-1.0, 1.0, 1.0, -1.0])
+        return xs[None, :] + dx[:, None], ys[None, :] + dy[:, None]
+
+    def _neighbour_offsets(self) -> Tuple[Tuple[int, int], ...]:
+        if self.is_hex:
+            return ((1, 0), (0, 1), (-1, 1), (-1, 0), (0, -1), (1, -1))
+        return ((1, 0), (0, 1), (-1, 0), (0, -1))
+
+    def _lattice_indices(
+        self, dx: np.ndarray, dy: np.ndarray, base_size: float, depth: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        size = base_size / 2.0**depth
+        if self.is_hex:
+            # Axial coordinates of the nearest centre (cube rounding); the
+            # lattice of every depth contains the one above it.
+            r = dy / (size * np.sqrt(3) / 2)
+            q = dx / size - r / 2
+            s = -q - r
+            rq, rr, rs = np.rint(q), np.rint(r), np.rint(s)
+            q_error, r_error, s_error = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+            fix_q = (q_error > r_error) & (q_error > s_error)
+            fix_r = ~fix_q & (r_error > s_error)
+            rq = np.where(fix_q, -rr - rs, rq)
+            rr = np.where(fix_r, -rq - rs, rr)
+            return rq.astype(np.int64), rr.astype(np.int64)
+        # Depth-d squares tile the depth-0 cells, whose lower-left corner sits
+        # half a cell below the lattice point.
+        return (
+            np.floor((dx + base_size / 2) / size).astype(np.int64),
+            np.floor((dy + base_size / 2) / size).astype(np.int64),
+        )
 
     def _project_geometry(self, polygon):
-        coords = [self._to_mercator.transform(*coord) for coord in polygon.exterior.coords]
-        return type(polygon)(coords)
+        # Transforms every ring, so holes and MultiPolygon parts are kept.
+        return shapely_transform(self._to_mercator.transform, polygon)
+
+
+def _lattice_axis(start: float, stop: float, step: float) -> np.ndarray:
+    # Accumulate the steps one by one (cumsum is sequential) so the values are
+    # bit-for-bit the same as repeatedly doing ``x += step``.
+    count = int(np.floor((stop - start) / step)) + 2
+    increments = np.full(count, float(step))
+    increments[0] = start
+    axis = np.cumsum(increments)
+    return axis[axis <= stop]
+
+
+def _aligned_lattice_axis(start: float, stop: float, step: float) -> np.ndarray:
+    # Index times step (not an accumulated sum) so every scenario gets the
+    # exact same coordinates for the same lattice point.
+    first = int(np.ceil(start / step))
+    last = int(np.floor(stop / step))
+    return np.arange(first, last + 1, dtype=np.int64) * float(step)
+
+
+def encode_cell_ids(ix: np.ndarray, iy: np.ndarray, depth: np.ndarray) -> np.ndarray:
+    # depth | x index | y index, the indices offset to be non-negative. Depth
+    # 0 (unrefined) IDs stay below 2**53, so they survive JSON and JavaScript.
+    limit = 1 << (CELL_ID_AXIS_BITS - 1)
+    if len(ix) and (
+        np.abs(ix).max() >= limit or np.abs(iy).max() >= limit or depth.max() >= 1 << 10
+    ):
+        raise ValueError("Grid too fine for cell IDs.")
+    return (
+        (depth.astype(np.int64) << (2 * CELL_ID_AXIS_BITS))
+        | ((ix + limit) << CELL_ID_AXIS_BITS)
+        | (iy + limit)
+    )
+
+
+def decode_cell_ids(cell_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    limit = 1 << (CELL_ID_AXIS_BITS - 1)
+    mask = (1 << CELL_ID_AXIS_BITS) - 1
+    return (
+        ((cell_ids >> CELL_ID_AXIS_BITS) & mask) - limit,
+        (cell_ids & mask) - limit,
+        cell_ids >> (2 * CELL_ID_AXIS_BITS),
+    )
+
+
+def parent_cell_ids(cell_ids: np.ndarray, shape: str = Scenario.GRID_SQUARE) -> np.ndarray:
+    # ID of the cell one level up (depth 0 cells are their own parent).
+    ix, iy, depth = decode_cell_ids(cell_ids)
+    refined = depth > 0
+    if shape == Scenario.GRID_HEX:
+        # Inverse of GridGenerator.child_points: the odd/odd child is the
+        # (-1, +1) neighbour of its parent's centre.
+        parent_x = (ix + (ix & iy & 1)) >> 1
+    else:
+        parent_x = ix >> 1
+    parent_y = iy >> 1
+    return np.where(
+        refined,
+        encode_cell_ids(parent_x, parent_y, np.maximum(depth - 1, 0)),
+        cell_ids,
+    )
+
+
+def target_key(target) -> str:
+    # Durations only depend on where a target is, so its location is its
+    # identity: renaming or reweighting a target keeps its stored durations.
+    return f"{target.lat:.6f},{target.lng:.6f}"
 
 
 def aggregate_durations(
     durations: Iterable[Optional[int]],
     targets: Iterable[TargetPoint],
     metric: str,
+    percentile: float = 50.0,
 ) -> Optional[float]:
     valid: List[int] = [value for value in durations if value is not None]
     if not valid:
@@ -138,35 +598,569 @@ def aggregate_durations(
         if total_weight == 0:
             return None
         return weighted_sum / total_weight / 60
+    if metric == Scenario.METRIC_MAX:
+        return max(valid) / 60
+    if metric == Scenario.METRIC_PERCENTILE:
+        return float(np.percentile(valid, percentile)) / 60
     return min(valid) / 60
 
 
+def aggregate_duration_matrix(
+    durations: np.ndarray,
+    metric: str,
+    weights: Optional[Sequence[Optional[float]]] = None,
+    percentile: float = 50.0,
+) -> np.ndarray:
+    # Vectorised aggregate_durations over a cells x targets matrix of seconds
+    # (NaN = no duration, +inf = pruned, i.e. never queried but known to be
+    # slower than the cell's fastest target): minutes per cell, NaN where a
+    # cell has none or where the metric depends on a pruned duration.
+    durations = np.asarray(durations, dtype=float).reshape(len(durations), -1)
+    valid = ~np.isnan(durations)
+    result = np.full(len(durations), np.nan)
+    has_value = valid.any(axis=1)
+    if not has_value.any():
+        return result
+    durations, valid = durations[has_value], valid[has_value]
+    filled = np.where(valid, durations, 0.0)
+    if metric == Scenario.METRIC_AVG:
+        values = filled.sum(axis=1) / valid.sum(axis=1)
+    elif metric == Scenario.METRIC_WEIGHTED:
+        if weights is None:
+            weights = [None] * durations.shape[1]
+        weight_row = np.array([weight or 1.0 for weight in weights], dtype=float)
+        cell_weights = np.where(valid, weight_row, 0.0)
+        totals = cell_weights.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = np.where(
+                totals != 0, (filled * cell_weights).sum(axis=1) / totals, np.nan
+            )
+    elif metric == Scenario.METRIC_MAX:
+        values = np.where(valid, durations, -np.inf).max(axis=1)
+    elif metric == Scenario.METRIC_PERCENTILE:
+        # np.nanpercentile loops over rows in Python; sorting moves the NaNs
+        # to the end of each row, so interpolate linearly within the valid
+        # prefix instead (same result as np.percentile's default method).
+        ordered = np.sort(durations, axis=1)
+        position = (valid.sum(axis=1) - 1) * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low = np.take_along_axis(ordered, lower[:, None], axis=1)[:, 0]
+        high = np.take_along_axis(ordered, upper[:, None], axis=1)[:, 0]
+        with np.errstate(invalid="ignore"):
+            values = np.where(
+                position > lower, low + (high - low) * (position - lower), low
+            )
+    else:
+        values = np.where(valid, durations, np.inf).min(axis=1)
+    result[has_value] = np.where(np.isfinite(values), values / 60, np.nan)
+    return result
+
+
 def compute_times(
     cells: Iterable[Cell],
     targets: Iterable[TargetPoint],
     departure_time: Optional[dt.datetime],
     metric: str,
     mode: str = "transit",
-    client: Optional[GoogleDirectionsClient] = None,
+    client: Optional[RoutingBackend] = None,
+    max_workers: Optional[int] = None,
+    use_matrix: Optional[bool] = None,
+    use_cache: Optional[bool] = None,
+    cache: Optional[TravelTimeCache] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    known_durations: Optional[Sequence[Optional[Sequence[Optional[int]]]]] = None,
+    percentile: float = 50.0,
+    prune: Optional[bool] = None,
+    metrics: Optional[RunMetrics] = None,
+    budget: Optional[CallBudget] = None,
 ) -> List[dict]:
-    client = client or GoogleDirectionsClient()
-    results = []
+    return list(
+        iter_compute_times(
+            cells,
+            targets,
+            departure_time,
+            metric,
+            mode,
+            client=client,
+            max_workers=max_workers,
+            use_matrix=use_matrix,
+            use_cache=use_cache,
+            cache=cache,
+            progress_callback=progress_callback,
+            known_durations=known_durations,
+            percentile=percentile,
+            prune=prune,
+            metrics=metrics,
+            budget=budget,
+        )
+    )
+
+
+def iter_compute_times(
+    cells: Iterable[Cell],
+    targets: Iterable[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    metric: str,
+    mode: str = "transit",
+    client: Optional[RoutingBackend] = None,
+    max_workers: Optional[int] = None,
+    use_matrix: Optional[bool] = None,
+    use_cache: Optional[bool] = None,
+    cache: Optional[TravelTimeCache] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    batch_size: Optional[int] = None,
+    known_durations: Optional[Sequence[Optional[Sequence[Optional[int]]]]] = None,
+    percentile: float = 50.0,
+    prune: Optional[bool] = None,
+    metrics: Optional[RunMetrics] = None,
+    budget: Optional[CallBudget] = None,
+) -> Iterator[dict]:
+    # Same results as compute_times, in cell order, but yielded batch by batch
+    # as soon as the durations of ``batch_size`` cells are known.
+    # ``known_durations`` is aligned with ``cells`` (one list per cell, aligned
+    # with ``targets``); its non-None values are reused instead of fetched.
+    if max_workers is None:
+        max_workers = getattr(settings, "HEATMAPS_ROUTING_MAX_WORKERS", 1)
+    if use_matrix is None:
+        use_matrix = getattr(settings, "HEATMAPS_ROUTING_USE_MATRIX", True)
+    if use_cache is None:
+        use_cache = getattr(settings, "HEATMAPS_CACHE_ENABLED", False)
+    if use_cache and cache is None:
+        cache = get_travel_time_cache()
+    elif not use_cache:
+        cache = None
+    if batch_size is None:
+        batch_size = getattr(settings, "HEATMAPS_RESULTS_BATCH_SIZE", 500)
+    batch_size = max(int(batch_size), 1)
+    if prune is None:
+        prune = getattr(settings, "HEATMAPS_ROUTING_PRUNE_MIN", False)
+    # Pruning is only exact for MIN and needs a top speed for the mode.
+    max_speed_mps = None
+    if prune and metric == Scenario.METRIC_MIN:
+        max_speed_kmh = getattr(settings, "HEATMAPS_ROUTING_MAX_SPEED_KMH", {}).get(
+            mode.lower()
+        )
+        if max_speed_kmh:
+            max_speed_mps = max_speed_kmh / 3.6
+    max_workers = max(int(max_workers), 1)
+    client = client or get_routing_backend(mode, pool_size=max_workers)
+    if getattr(client, "is_local", False):
+        # Local backends answer whole matrices from memory: caching, pruning
+        # or pairwise requests would only add overhead.
+        cache = None
+        max_speed_mps = None
+        use_matrix = True
+    # Matrix calls need a backend that has them (the wrapper always does).
+    use_matrix = use_matrix and hasattr(client, "get_duration_matrix")
+    if not isinstance(client, (InstrumentedBackend, ResilientBackend)):
+        client = InstrumentedBackend(client, metrics)
+        if not getattr(client, "is_local", False):
+            # Remote backends throttle and fail: rate-limit and retry every
+            # attempt (each one counted by the instrumentation) within budget.
+            client = ResilientBackend(
+                client,
+                backend_name=client.backend_name,
+                budget=budget,
+                on_retry=client.record_retry,
+            )
+    cells_list = list(cells)
     targets_list = list(targets)
-    for cell in cells:
-        durations = [
-            client.get_transit_duration_seconds(cell, target, departure_time, mode)
-            for target in targets_list
+    target_keys = [target_key(target) for target in targets_list]
+
+    total_pairs = len(cells_list) * len(targets_list)
+    pairs_done = 0
+
+    def on_fetched(count: int) -> None:
+        nonlocal pairs_done
+        pairs_done += count
+        if progress_callback is not None and total_pairs:
+            progress_callback(len(cells_list) * pairs_done // total_pairs, len(cells_list))
+
+    # One pool for the whole run so batches do not pay for spawning threads.
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        for start in range(0, len(cells_list), batch_size):
+            batch = cells_list[start : start + batch_size]
+            with stage("routing", metrics, cells=len(batch)):
+                matrix, pruned = _batch_durations(
+                    client,
+                    batch,
+                    targets_list,
+                    departure_time,
+                    mode,
+                    use_matrix,
+                    cache,
+                    executor,
+                    on_fetched,
+                    known_durations[start : start + batch_size] if known_durations else None,
+                    max_speed_mps,
+                    metrics,
+                )
+            if use_matrix and max_speed_mps and not any(pruned):
+                # The bound ruled nothing out: pruning only added matrix calls,
+                # so the remaining batches are fetched whole.
+                max_speed_mps = None
+            results = []
+            with stage("aggregation", metrics, cells=len(batch)):
+                for cell, durations, cell_pruned in zip(batch, matrix, pruned):
+                    raw = {"durations": durations, "targets": target_keys}
+                    if cell_pruned:
+                        # Never queried: their lower bound could not beat the
+                        # best duration of the cell, so they cannot change MIN.
+                        raw["pruned"] = [target_keys[j] for j in sorted(cell_pruned)]
+                    results.append(
+                        {
+                            "lat": cell.lat,
+                            "lng": cell.lng,
+                            "time_minutes": aggregate_durations(
+                                durations, targets_list, metric, percentile
+                            ),
+                            "raw": raw,
+                        }
+                    )
+            yield from results
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def estimate_api_calls(
+    cells: Sequence[Cell],
+    targets: Sequence[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    mode: str = "transit",
+    client: Optional[RoutingBackend] = None,
+    use_matrix: Optional[bool] = None,
+    use_cache: Optional[bool] = None,
+    cache: Optional[TravelTimeCache] = None,
+    batch_size: Optional[int] = None,
+    known_durations: Optional[Sequence[Optional[Sequence[Optional[int]]]]] = None,
+) -> int:
+    # Routing calls iter_compute_times would issue for these cells, before
+    # retries and MIN pruning: pairs already known or cached are free, and
+    # matrix runs send one call per batch of rows missing the same targets.
+    if use_matrix is None:
+        use_matrix = getattr(settings, "HEATMAPS_ROUTING_USE_MATRIX", True)
+    if use_cache is None:
+        use_cache = getattr(settings, "HEATMAPS_CACHE_ENABLED", False)
+    if use_cache and cache is None:
+        cache = get_travel_time_cache()
+    elif not use_cache:
+        cache = None
+    if batch_size is None:
+        batch_size = getattr(settings, "HEATMAPS_RESULTS_BATCH_SIZE", 500)
+    batch_size = max(int(batch_size), 1)
+    client = client or get_routing_backend(mode, pool_size=1)
+    if getattr(client, "is_local", False):
+        return 0
+    use_matrix = use_matrix and hasattr(client, "get_duration_matrix")
+    matrix_batch_size = getattr(client, "matrix_batch_size", None) or getattr(
+        settings, "HEATMAPS_ROUTING_MATRIX_BATCH_SIZE", 25
+    )
+    matrix_batch_size = max(int(matrix_batch_size), 1)
+    calls = 0
+    for start in range(0, len(cells), batch_size):
+        batch = cells[start : start + batch_size]
+        missing = []
+        for i, cell in enumerate(batch):
+            row = (
+                known_durations[start + i]
+                if known_durations is not None and start + i < len(known_durations)
+                else None
+            )
+            for j, target in enumerate(targets):
+                if row is None or j >= len(row) or row[j] is None:
+                    missing.append((i, j, cell, target))
+        if cache is not None and missing:
+            keys = [
+                cache.make_key(cell, target, departure_time, mode)
+                for _, _, cell, target in missing
+            ]
+            hits = cache.get_many(keys)
+            missing = [pair for pair, key in zip(missing, keys) if key not in hits]
+        if use_matrix:
+            for rows, _ in _column_groups((i, j) for i, j, _, _ in missing):
+                calls += -(-len(rows) // matrix_batch_size)
+        else:
+            calls += len(missing)
+    return calls
+
+
+def _batch_durations(
+    client,
+    cells: List[Cell],
+    targets: List[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    mode: str,
+    use_matrix: bool,
+    cache: Optional[TravelTimeCache],
+    executor: Optional[ThreadPoolExecutor],
+    on_fetched: Callable[[int], None],
+    known: Optional[Sequence[Optional[Sequence[Optional[int]]]]] = None,
+    max_speed_mps: Optional[float] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> Tuple[List[List[Optional[int]]], List[List[int]]]:
+    matrix: List[List[Optional[int]]] = [[None] * len(targets) for _ in cells]
+    pruned: List[List[int]] = [[] for _ in cells]
+    missing = []
+    for i in range(len(cells)):
+        row = known[i] if known is not None and i < len(known) else None
+        for j in range(len(targets)):
+            if row is not None and j < len(row) and row[j] is not None:
+                matrix[i][j] = row[j]
+            else:
+                missing.append((i, j))
+    keys: List[List[str]] = []
+    if cache is not None and missing:
+        keys = [
+            [cache.make_key(cell, target, departure_time, mode) for target in targets]
+            for cell in cells
+        ]
+        hits = cache.get_many(keys[i][j] for i, j in missing)
+        still_missing = []
+        for i, j in missing:
+            if keys[i][j] in hits:
+                matrix[i][j] = hits[keys[i][j]]
+            else:
+                still_missing.append((i, j))
+        record_cache_lookups(len(missing) - len(still_missing), len(still_missing), metrics)
+        missing = still_missing
+    on_fetched(len(cells) * len(targets) - len(missing))
+    if not missing:
+        return matrix, pruned
+
+    if max_speed_mps:
+        fetched = _pruned_durations(
+            client,
+            cells,
+            targets,
+            matrix,
+            missing,
+            departure_time,
+            mode,
+            use_matrix,
+            executor,
+            on_fetched,
+            max_speed_mps,
+            pruned,
+        )
+    elif use_matrix:
+        fetched = _matrix_pair_durations(
+            client, cells, targets, missing, departure_time, mode, executor, on_fetched
+        )
+    else:
+        values = _pairwise_durations(
+            client,
+            [(cells[i], targets[j]) for i, j in missing],
+            departure_time,
+            mode,
+            executor,
+            on_fetched,
+        )
+        fetched = dict(zip(missing, values))
+    for (i, j), value in fetched.items():
+        matrix[i][j] = value
+    if cache is not None:
+        cache.set_many({keys[i][j]: value for (i, j), value in fetched.items()})
+    return matrix, pruned
+
+
+def _column_groups(pairs: Iterable[Tuple[int, int]]) -> List[Tuple[List[int], List[int]]]:
+    # Rows grouped by the columns they are missing, so each group is a full
+    # rows x columns block: a matrix call never asks for a known pair.
+    columns: dict = {}
+    for i, j in pairs:
+        columns.setdefault(i, []).append(j)
+    groups: dict = {}
+    for i, cols in columns.items():
+        groups.setdefault(tuple(sorted(cols)), []).append(i)
+    return [(rows, list(cols)) for cols, rows in groups.items()]
+
+
+def _matrix_pair_durations(
+    client,
+    cells: List[Cell],
+    targets: List[TargetPoint],
+    pairs: List[Tuple[int, int]],
+    departure_time: Optional[dt.datetime],
+    mode: str,
+    executor: Optional[ThreadPoolExecutor],
+    on_fetched: Callable[[int], None],
+) -> dict:
+    fetched = {}
+    for rows, cols in _column_groups(pairs):
+        block = _matrix_durations(
+            client,
+            [cells[i] for i in rows],
+            [targets[j] for j in cols],
+            departure_time,
+            mode,
+            executor,
+            on_fetched,
+        )
+        for r, i in enumerate(rows):
+            for c, j in enumerate(cols):
+                fetched[(i, j)] = block[r][c]
+    return fetched
+
+
+def _pruned_durations(
+    client,
+    cells: List[Cell],
+    targets: List[TargetPoint],
+    matrix: List[List[Optional[int]]],
+    missing: List[Tuple[int, int]],
+    departure_time: Optional[dt.datetime],
+    mode: str,
+    use_matrix: bool,
+    executor: Optional[ThreadPoolExecutor],
+    on_fetched: Callable[[int], None],
+    max_speed_mps: float,
+    pruned: List[List[int]],
+) -> dict:
+    # MIN only needs the fastest target of each cell. Query the targets of
+    # every cell nearest first and drop the targets whose lower bound
+    # (great-circle distance at the mode's top speed) is no better than the
+    # best duration found so far. Pairwise runs go one round at a time across
+    # all cells, so the requests of a round still run concurrently.
+    bounds = great_circle_m(
+        np.array([cell.lat for cell in cells])[:, None],
+        np.array([cell.lng for cell in cells])[:, None],
+        np.array([target.lat for target in targets])[None, :],
+        np.array([target.lng for target in targets])[None, :],
+    ) / max_speed_mps
+    best = [
+        min((value for value in row if value is not None), default=np.inf) for row in matrix
+    ]
+    queues: dict = {}
+    for i, j in missing:
+        queues.setdefault(i, []).append(j)
+    for i, queue in queues.items():
+        queue.sort(key=lambda j: -bounds[i, j])
+
+    fetched = {}
+    if use_matrix:
+        # A matrix call is billed per element but costs a round trip, so
+        # rounds of single-target columns would multiply the calls. Fetch the
+        # nearest target of the cells with nothing known yet, prune against
+        # it, then fetch every surviving pair at once in multi-target calls.
+        first = [
+            (i, queue.pop()) for i, queue in queues.items() if best[i] == np.inf and len(queue) > 1
         ]
-        print(
-            f"Computed durations for cell ({cell.lat}, {cell.lng}): {durations}"
-        )
-        time_minutes = aggregate_durations(durations, targets_list, metric)
-        results.append(
-            {
-                "lat": cell.lat,
-                "lng": cell.lng,
-                "time_minutes": time_minutes,
-                "raw": {"durations": durations},
-            }
-        )
-    return results
+        for (i, j), value in _matrix_pair_durations(
+            client, cells, targets, first, departure_time, mode, executor, on_fetched
+        ).items():
+            fetched[(i, j)] = value
+            if value is not None and value < best[i]:
+                best[i] = value
+        survivors = []
+        for i, queue in queues.items():
+            dropped = [j for j in queue if bounds[i, j] >= best[i]]
+            if dropped:
+                pruned[i].extend(dropped)
+                on_fetched(len(dropped))
+            survivors.extend((i, j) for j in queue if bounds[i, j] < best[i])
+        fetched.update(
+            _matrix_pair_durations(
+                client, cells, targets, survivors, departure_time, mode, executor, on_fetched
+            )
+        )
+        return fetched
+
+    while queues:
+        round_pairs = []
+        for i in list(queues):
+            queue = queues[i]
+            if bounds[i, queue[-1]] >= best[i]:
+                # Sorted by bound, so nothing left in the queue can do better.
+                pruned[i].extend(queue)
+                on_fetched(len(queue))
+                del queues[i]
+                continue
+            round_pairs.append((i, queue.pop()))
+            if not queue:
+                del queues[i]
+        if not round_pairs:
+            break
+        values = _pairwise_durations(
+            client,
+            [(cells[i], targets[j]) for i, j in round_pairs],
+            departure_time,
+            mode,
+            executor,
+            on_fetched,
+        )
+        for (i, j), value in zip(round_pairs, values):
+            fetched[(i, j)] = value
+            if value is not None and value < best[i]:
+                best[i] = value
+    return fetched
+
+
+def great_circle_m(lat1, lng1, lat2, lng2) -> np.ndarray:
+    lat1, lng1, lat2, lng2 = (np.radians(value) for value in (lat1, lng1, lat2, lng2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * LOWER_BOUND_EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _pairwise_durations(
+    client,
+    pairs: List[Tuple[Cell, TargetPoint]],
+    departure_time: Optional[dt.datetime],
+    mode: str,
+    executor: Optional[ThreadPoolExecutor],
+    on_fetched: Callable[[int], None],
+) -> List[Optional[int]]:
+    def fetch(pair: Tuple[Cell, TargetPoint]) -> Optional[int]:
+        cell, target = pair
+        return client.get_transit_duration_seconds(cell, target, departure_time, mode)
+
+    durations: List[Optional[int]] = []
+    if executor is not None and len(pairs) > 1:
+        # executor.map keeps at most max_workers requests in flight and yields
+        # the durations in submission order, so the cell/target layout holds.
+        for duration in executor.map(fetch, pairs):
+            durations.append(duration)
+            on_fetched(1)
+    else:
+        for pair in pairs:
+            durations.append(fetch(pair))
+            on_fetched(1)
+    return durations
+
+
+def _matrix_durations(
+    client,
+    cells: List[Cell],
+    targets: List[TargetPoint],
+    departure_time: Optional[dt.datetime],
+    mode: str,
+    executor: Optional[ThreadPoolExecutor],
+    on_fetched: Callable[[int], None],
+) -> List[List[Optional[int]]]:
+    if not targets:
+        return [[] for _ in cells]
+    batch_size = getattr(client, "matrix_batch_size", None) or getattr(
+        settings, "HEATMAPS_ROUTING_MATRIX_BATCH_SIZE", 25
+    )
+    batch_size = max(int(batch_size), 1)
+    batches = [cells[start : start + batch_size] for start in range(0, len(cells), batch_size)]
+
+    def fetch(batch: List[Cell]) -> List[List[Optional[int]]]:
+        return client.get_duration_matrix(batch, targets, departure_time, mode)
+
+    rows: List[List[Optional[int]]] = []
+    if executor is not None and len(batches) > 1:
+        for block in executor.map(fetch, batches):
+            rows.extend(block)
+            on_fetched(len(block) * len(targets))
+    else:
+        for batch in batches:
+            block = fetch(batch)
+            rows.extend(block)
+            on_fetched(len(block) * len(targets))
+    return rows
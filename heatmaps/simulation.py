@@ -0,0 +1,166 @@
+import asyncio
+import datetime as dt
+import random
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from heatmaps.models import TargetPoint
+from heatmaps.routing import AsyncRoutingMixin, RoutingBackendError, RoutingQuotaError
+from heatmaps.services import great_circle_m
+
+# Synthetic door-to-door speeds (m/s) and fixed overheads (s) per mode. They
+# stay below HEATMAPS_ROUTING_MAX_SPEED_KMH so MIN pruning remains exact.
+SIMULATED_SPEEDS_MPS = {
+    "transit": 6.0,
+    "drive": 11.0,
+    "two_wheeler": 10.0,
+    "bicycle": 4.5,
+    "walk": 1.3,
+}
+SIMULATED_OVERHEAD_SECONDS = {"transit": 240.0, "drive": 60.0}
+SIMULATED_DETOUR_FACTOR = 1.3
+QUOTA_WINDOW_SECONDS = 60.0
+
+
+class RoutingSimulator:
+    # Behaviour shared by the in-process backend and the HTTP stand-in:
+    # deterministic durations from the distance, plus configurable latency,
+    # error rate and an elements-per-minute quota answered with 429s.
+    def __init__(
+        self,
+        latency_ms: Optional[float] = None,
+        latency_jitter_ms: Optional[float] = None,
+        element_latency_ms: Optional[float] = None,
+        error_rate: Optional[float] = None,
+        quota_elements_per_minute: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        def option(value, name, default):
+            return getattr(settings, name, default) if value is None else value
+
+        self.latency_ms = float(option(latency_ms, "HEATMAPS_SIMULATED_LATENCY_MS", 150))
+        self.latency_jitter_ms = float(
+            option(latency_jitter_ms, "HEATMAPS_SIMULATED_LATENCY_JITTER_MS", 50)
+        )
+        self.element_latency_ms = float(
+            option(element_latency_ms, "HEATMAPS_SIMULATED_ELEMENT_LATENCY_MS", 2)
+        )
+        self.error_rate = float(option(error_rate, "HEATMAPS_SIMULATED_ERROR_RATE", 0))
+        self.quota_elements_per_minute = int(
+            option(quota_elements_per_minute, "HEATMAPS_SIMULATED_QUOTA_ELEMENTS_PER_MINUTE", 0)
+        )
+        self._random = random.Random(option(seed, "HEATMAPS_SIMULATED_SEED", None))
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_elements = 0
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def admit(self, elements: int) -> Tuple[float, Optional[RoutingBackendError]]:
+        # Account for a request of ``elements`` pairs. Quota rejections are
+        # raised at once; otherwise returns the latency in seconds and the
+        # error to raise once it has elapsed, if the request fails.
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            if now - self._window_start >= QUOTA_WINDOW_SECONDS:
+                self._window_start = now
+                self._window_elements = 0
+            if (
+                self.quota_elements_per_minute
+                and self._window_elements + elements > self.quota_elements_per_minute
+            ):
+                self.rejected += 1
+                retry_after = QUOTA_WINDOW_SECONDS - (now - self._window_start)
+                raise RoutingQuotaError(
+                    "Simulated quota exceeded.", status_code=429, retry_after=retry_after
+                )
+            self._window_elements += elements
+            latency_ms = (
+                self.latency_ms
+                + self._random.uniform(-1, 1) * self.latency_jitter_ms
+                + self.element_latency_ms * elements
+            )
+            error = None
+            if self._random.random() < self.error_rate:
+                self.failed += 1
+                error = RoutingBackendError("Simulated backend error.", status_code=503)
+        return max(latency_ms, 0) / 1000, error
+
+    def durations(
+        self, origins: Sequence, destinations: Sequence, mode: str = "transit"
+    ) -> List[List[Optional[int]]]:
+        if not origins or not destinations:
+            return [[None] * len(destinations) for _ in origins]
+        distances = great_circle_m(
+            np.array([origin.lat for origin in origins], dtype=float)[:, None],
+            np.array([origin.lng for origin in origins], dtype=float)[:, None],
+            np.array([target.lat for target in destinations], dtype=float)[None, :],
+            np.array([target.lng for target in destinations], dtype=float)[None, :],
+        )
+        mode = mode.lower()
+        seconds = SIMULATED_OVERHEAD_SECONDS.get(mode, 0.0) + (
+            distances * SIMULATED_DETOUR_FACTOR / SIMULATED_SPEEDS_MPS.get(mode, 6.0)
+        )
+        return np.rint(seconds).astype(int).tolist()
+
+
+class SimulatedRoutingBackend(AsyncRoutingMixin):
+    # Offline stand-in for the Google client: synthetic durations with the
+    # latency, failures and quota of RoutingSimulator, to load-test runs and
+    # tune HEATMAPS_ROUTING_MAX_WORKERS without spending API quota.
+    def __init__(
+        self, pool_size: Optional[int] = None, simulator: Optional[RoutingSimulator] = None
+    ) -> None:
+        # pool_size is accepted for get_routing_backend; calls are in-process.
+        self.simulator = simulator or RoutingSimulator()
+
+    def get_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]:
+        return self.get_duration_matrix([origin], [destination], departure_time, mode)[0][0]
+
+    def get_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]:
+        latency, error = self.simulator.admit(len(origins) * len(destinations))
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return self.simulator.durations(origins, destinations, mode)
+
+    async def aget_transit_duration_seconds(
+        self,
+        origin,
+        destination: TargetPoint,
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> Optional[int]:
+        matrix = await self.aget_duration_matrix([origin], [destination], departure_time, mode)
+        return matrix[0][0]
+
+    async def aget_duration_matrix(
+        self,
+        origins: Sequence,
+        destinations: Sequence[TargetPoint],
+        departure_time: Optional[dt.datetime] = None,
+        mode: str = "transit",
+    ) -> List[List[Optional[int]]]:
+        latency, error = self.simulator.admit(len(origins) * len(destinations))
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return self.simulator.durations(origins, destinations, mode)
@@ -0,0 +1,521 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from heatmaps.models import CellResult, ComputationResult, GridResult, Scenario
+from heatmaps.services import Cell, GridGenerator, aggregate_duration_matrix, target_key
+
+STORAGE_ROWS = "rows"
+STORAGE_ARRAY = "array"
+
+# Sampling modes whose cells are exactly the GridGenerator lattice (array
+# storage packs square lattices only).
+LATTICE_SAMPLING_MODES = (Scenario.SAMPLING_UNIFORM, Scenario.SAMPLING_BUDGETED)
+
+# SQLite caps the number of bound parameters per statement.
+DB_BATCH_SIZE = 500
+
+# Stored cells only match a lattice cell at the same place (~1 cm): cell IDs
+# are lattice indices, which a polygon-anchored lattice reuses for other
+# places once its anchor moves.
+CELL_MATCH_TOLERANCE_DEG = 1e-7
+
+
+def save_results(scenario: Scenario, results: List[dict]) -> None:
+    grid_result = None
+    if uses_array_storage(scenario):
+        grid_result = _grid_result_from_results(scenario, results)
+    with transaction.atomic():
+        CellResult.objects.filter(scenario=scenario).delete()
+        GridResult.objects.filter(scenario=scenario).delete()
+        if grid_result is not None:
+            grid_result.save()
+            return
+        CellResult.objects.bulk_create(_cell_rows(scenario, results))
+
+
+def uses_array_storage(scenario: Scenario) -> bool:
+    return (
+        getattr(settings, "HEATMAPS_RESULT_STORAGE", STORAGE_ROWS) == STORAGE_ARRAY
+        and scenario.sampling_mode in LATTICE_SAMPLING_MODES
+        and scenario.grid_shape == Scenario.GRID_SQUARE
+    )
+
+
+def clear_results(scenario: Scenario) -> None:
+    with transaction.atomic():
+        CellResult.objects.filter(scenario=scenario).delete()
+        GridResult.objects.filter(scenario=scenario).delete()
+
+
+def append_results(
+    scenario: Scenario,
+    results: List[dict],
+    replace: bool = False,
+    computation: Optional[ComputationResult] = None,
+) -> None:
+    # One transaction per batch: readers polling with a ``since`` cursor see
+    # whole batches, and a failed run keeps everything written before it,
+    # with the ``cells_saved`` checkpoint in step. ``replace`` overwrites the
+    # rows already stored for the same cells (resumed runs) by deleting and
+    # inserting them again: the new rows get new ids, past any ``since``
+    # cursor handed out for the old ones.
+    with transaction.atomic():
+        rows = _cell_rows(scenario, results)
+        if replace:
+            cell_ids = [row.cell_id for row in rows]
+            for start in range(0, len(cell_ids), DB_BATCH_SIZE):
+                CellResult.objects.filter(
+                    scenario=scenario, cell_id__in=cell_ids[start : start + DB_BATCH_SIZE]
+                ).delete()
+        CellResult.objects.bulk_create(rows)
+        if computation is not None:
+            computation.cells_saved += len(rows)
+            computation.save(update_fields=["cells_saved"])
+
+
+def prepare_incremental_results(scenario: Scenario, resume: bool = False) -> None:
+    if resume:
+        # The rows of the interrupted run stay until overwritten.
+        GridResult.objects.filter(scenario=scenario).delete()
+    else:
+        clear_results(scenario)
+
+
+def load_stored_durations(
+    scenario: Scenario, targets: Iterable, cells: List[Cell], cell_ids: np.ndarray
+) -> List[Optional[List[Optional[int]]]]:
+    # Durations saved for the scenario so far (rows of a finished, running or
+    # interrupted run, or a packed grid), realigned on ``cells`` (None for
+    # cells without stored durations) and on ``targets``: targets without a
+    # stored duration (or pruned ones) get None.
+    if get_grid_result(scenario) is not None:
+        rows = [
+            (None, lat, lng, raw)
+            for lat, lng, _, _, raw, _ in iter_result_rows(scenario, include_raw=True)
+        ]
+        stored_ids = scenario_cell_ids(
+            scenario,
+            np.array([row[1] for row in rows], dtype=float),
+            np.array([row[2] for row in rows], dtype=float),
+        )
+    else:
+        rows = list(scenario.cell_results.values_list("cell_id", "lat", "lng", "raw"))
+        stored_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    matched = _match_stored_cells(cells, cell_ids, stored_ids, rows)
+    matrix = duration_matrix([row[3] for row in rows], list(targets))
+    known: List[Optional[List[Optional[int]]]] = [None] * len(cells)
+    for row, index, values in zip(rows, matched, matrix.tolist()):
+        if index >= 0 and not (row[3] or {}).get("interpolated"):
+            known[index] = [int(value) if np.isfinite(value) else None for value in values]
+    return known
+
+
+def duration_matrix(raws: List[Optional[dict]], targets: List) -> np.ndarray:
+    # Cells x targets seconds (NaN = no duration, +inf = pruned) from stored
+    # ``raw`` dicts, with columns matched to ``targets`` through the stored
+    # target keys.
+    keys = [target_key(target) for target in targets]
+    column = {key: index for index, key in enumerate(keys)}
+    matrix = np.full((len(raws), len(keys)), np.nan)
+    for row, raw in enumerate(raws):
+        raw = raw or {}
+        durations = raw.get("durations") or []
+        stored_keys = raw.get("targets")
+        if stored_keys is None:
+            # Saved before durations were keyed by target; those runs could
+            # not change targets, so the columns follow the current ones.
+            if len(durations) != len(keys):
+                continue
+            stored_keys = keys
+        for key, value in zip(stored_keys, durations):
+            if value is not None and key in column:
+                matrix[row, column[key]] = value
+        for key in raw.get("pruned") or []:
+            if key in column:
+                matrix[row, column[key]] = np.inf
+    return matrix
+
+
+def _grid_duration_matrix(grid_result: GridResult, targets: List) -> np.ndarray:
+    stored = grid_result.cell_durations().astype(float)
+    keys = [target_key(target) for target in targets]
+    stored_keys = grid_result.target_keys
+    if not stored_keys and stored.shape[1] == len(keys):
+        stored_keys = keys
+    matrix = np.full((len(stored), len(keys)), np.nan)
+    for index, key in enumerate(stored_keys):
+        if key in keys:
+            matrix[:, keys.index(key)] = stored[:, index]
+    return matrix
+
+
+def reaggregate_results(scenario: Scenario) -> int:
+    # Recompute every stored time_minutes from the stored durations with the
+    # scenario's current metric, percentile and target weights; no routing.
+    targets = list(scenario.targets.all())
+    weights = [target.weight for target in targets]
+    grid_result = get_grid_result(scenario)
+    if grid_result is not None:
+        times = aggregate_duration_matrix(
+            _grid_duration_matrix(grid_result, targets),
+            scenario.metric,
+            weights,
+            scenario.metric_percentile,
+        )
+        grid_result.time_minutes = times.astype("<f4").tobytes()
+        grid_result.save(update_fields=["time_minutes"])
+        return len(times)
+
+    rows = list(scenario.cell_results.order_by("pk").values_list("pk", "raw"))
+    times = aggregate_duration_matrix(
+        duration_matrix([raw for _, raw in rows], targets),
+        scenario.metric,
+        weights,
+        scenario.metric_percentile,
+    )
+    # One prepared UPDATE run for every row; building model instances for
+    # bulk_update costs far more than the aggregation itself.
+    table = connection.ops.quote_name(CellResult._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(
+            f"UPDATE {table} SET time_minutes = %s WHERE id = %s",
+            [
+                (None if np.isnan(value) else value, pk)
+                for (pk, _), value in zip(rows, times.tolist())
+            ],
+        )
+    return len(rows)
+
+
+def has_pruned_durations(scenario: Scenario) -> bool:
+    grid_result = get_grid_result(scenario)
+    if grid_result is not None:
+        return bool(np.isinf(grid_result.cell_durations()).any())
+    return scenario.cell_results.filter(raw__has_key="pruned").exists()
+
+
+def clear_result_times(scenario: Scenario) -> None:
+    # Drops the aggregated times but keeps the durations they came from.
+    grid_result = get_grid_result(scenario)
+    if grid_result is not None:
+        grid_result.time_minutes = np.full(
+            grid_result.num_cells, np.nan, dtype="<f4"
+        ).tobytes()
+        grid_result.save(update_fields=["time_minutes"])
+    CellResult.objects.filter(scenario=scenario).update(time_minutes=None)
+
+
+def mark_results_stale(scenario: Scenario) -> None:
+    # The stored results no longer answer the scenario: the computation is
+    # pending again until rerun. The stored durations stay, so the (resumed)
+    # run only fetches the pairs they are missing.
+    ComputationResult.objects.filter(
+        scenario=scenario, status=ComputationResult.STATUS_DONE
+    ).update(status=ComputationResult.STATUS_PENDING)
+
+
+def delete_stale_cells(scenario: Scenario, cells: List[Cell], cell_ids: np.ndarray) -> int:
+    # Rows of cells that are no longer part of the scenario grid (polygon,
+    # resolution or alignment changed).
+    rows = list(scenario.cell_results.values_list("cell_id", "lat", "lng", "pk"))
+    matched = _match_stored_cells(
+        cells, cell_ids, np.array([row[0] for row in rows], dtype=np.int64), rows
+    )
+    stale = [row[3] for row, index in zip(rows, matched) if index < 0]
+    for start in range(0, len(stale), DB_BATCH_SIZE):
+        CellResult.objects.filter(pk__in=stale[start : start + DB_BATCH_SIZE]).delete()
+    return len(stale)
+
+
+def scenario_cell_ids(
+    scenario: Scenario,
+    lats: np.ndarray,
+    lngs: np.ndarray,
+    sizes: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    generator, origin = lattice_frame(scenario)
+    return generator.cell_ids(lats, lngs, origin, scenario.grid_resolution_m, sizes)
+
+
+def lattice_frame(scenario: Scenario) -> Tuple[GridGenerator, Tuple[float, float]]:
+    generator = GridGenerator.for_scenario(scenario)
+    return generator, generator.lattice_origin(
+        generator.project_polygon(scenario.polygon_geojson)
+    )
+
+
+def _match_stored_cells(
+    cells: List[Cell], cell_ids: np.ndarray, stored_ids: np.ndarray, rows: List[tuple]
+) -> List[int]:
+    # Index in ``cells`` of every stored (cell_id, lat, lng, ...) row, -1 when
+    # the cell is no longer part of the grid.
+    position = {cell_id: index for index, cell_id in enumerate(cell_ids.tolist())}
+    matched = []
+    for cell_id, row in zip(stored_ids.tolist(), rows):
+        index = position.get(cell_id, -1)
+        if index >= 0 and (
+            abs(cells[index].lat - row[1]) > CELL_MATCH_TOLERANCE_DEG
+            or abs(cells[index].lng - row[2]) > CELL_MATCH_TOLERANCE_DEG
+        ):
+            index = -1
+        matched.append(index)
+    return matched
+
+
+def _cell_rows(scenario: Scenario, results: List[dict]) -> List[CellResult]:
+    cell_size = GridGenerator.for_scenario(scenario).cell_size(scenario.grid_resolution_m)
+    sizes = np.array([result.get("cell_size_m", cell_size) for result in results], dtype=float)
+    cell_ids = scenario_cell_ids(
+        scenario,
+        np.array([result["lat"] for result in results], dtype=float),
+        np.array([result["lng"] for result in results], dtype=float),
+        sizes,
+    )
+    return [
+        CellResult(
+            scenario=scenario,
+            cell_id=cell_id,
+            lat=result["lat"],
+            lng=result["lng"],
+            time_minutes=result["time_minutes"],
+            cell_size_m=size,
+            raw=result["raw"],
+        )
+        for result, cell_id, size in zip(results, cell_ids.tolist(), sizes.tolist())
+    ]
+
+
+def _grid_result_from_results(scenario: Scenario, results: List[dict]) -> Optional[GridResult]:
+    xs, ys, mask = _scenario_lattice(scenario)
+    if int(mask.sum()) != len(results):
+        return None
+    return _build_grid_result(scenario, xs, ys, mask, results)
+
+
+def pack_cell_rows(scenario: Scenario, delete_rows: bool = False) -> Optional[GridResult]:
+    # Migration path from CellResult rows: snap the stored points back onto the
+    # scenario lattice and refuse when they do not fit it (e.g. adaptive runs).
+    if scenario.grid_shape != Scenario.GRID_SQUARE:
+        return None
+    rows = list(scenario.cell_results.values_list("lat", "lng", "time_minutes", "raw"))
+    xs, ys, mask = _scenario_lattice(scenario)
+    if not rows or int(mask.sum()) != len(rows):
+        return None
+    generator = GridGenerator()
+    mx, my = generator._to_mercator.transform(
+        np.array([row[1] for row in rows], dtype=float),
+        np.array([row[0] for row in rows], dtype=float),
+    )
+    resolution = float(scenario.grid_resolution_m)
+    ix = np.rint((np.asarray(mx) - xs[0]) / resolution).astype(np.int64)
+    iy = np.rint((np.asarray(my) - ys[0]) / resolution).astype(np.int64)
+    in_range = (ix >= 0) & (iy >= 0) & (ix < mask.shape[0]) & (iy < mask.shape[1])
+    if not in_range.all() or not mask[ix, iy].all():
+        return None
+    order = np.lexsort((iy, ix))
+    results = [
+        {"time_minutes": rows[i][2], "raw": rows[i][3] or {"durations": []}} for i in order
+    ]
+    grid_result = _build_grid_result(scenario, xs, ys, mask, results)
+    with transaction.atomic():
+        GridResult.objects.filter(scenario=scenario).delete()
+        grid_result.save()
+        if delete_rows:
+            CellResult.objects.filter(scenario=scenario).delete()
+    return grid_result
+
+
+def _scenario_lattice(scenario: Scenario) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    generator = GridGenerator.for_scenario(scenario)
+    return generator.generate_lattice(
+        generator.project_polygon(scenario.polygon_geojson), scenario.grid_resolution_m
+    )
+
+
+def _build_grid_result(
+    scenario: Scenario,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    mask: np.ndarray,
+    results: List[dict],
+) -> GridResult:
+    duration_lists = [result["raw"].get("durations") or [] for result in results]
+    num_targets = max((len(values) for values in duration_lists), default=0)
+    target_keys = next(
+        (
+            r["raw"]["targets"]
+            for r in results
+            if len(r["raw"].get("targets") or []) == num_targets
+        ),
+        [],
+    )
+    column = {key: index for index, key in enumerate(target_keys)}
+    # Pruned pairs are kept as +inf so the grid still tells them apart from
+    # pairs without a route.
+    durations = np.full((len(results), num_targets), np.nan, dtype=np.float32)
+    for index, (result, values) in enumerate(zip(results, duration_lists)):
+        durations[index, : len(values)] = [np.nan if v is None else v for v in values]
+        for key in result["raw"].get("pruned") or []:
+            if key in column:
+                durations[index, column[key]] = np.inf
+    return GridResult.from_arrays(
+        scenario,
+        origin_x=float(xs[0]),
+        origin_y=float(ys[0]),
+        resolution_m=float(scenario.grid_resolution_m),
+        mask=mask,
+        time_minutes=np.array(
+            [np.nan if r["time_minutes"] is None else r["time_minutes"] for r in results],
+            dtype=np.float32,
+        ),
+        durations=durations,
+        interpolated=np.array(
+            [bool(r["raw"].get("interpolated")) for r in results], dtype=bool
+        ),
+        target_keys=target_keys,
+    )
+
+
+def get_grid_result(scenario: Scenario) -> Optional[GridResult]:
+    return GridResult.objects.filter(scenario=scenario).first()
+
+
+def load_result_columns(
+    scenario: Scenario,
+    include_durations: bool = False,
+    bounds: Optional[Tuple[float, float, float, float]] = None,
+    since: Optional[int] = None,
+    aggregation: Optional[Tuple[str, List, float]] = None,
+) -> Dict[str, np.ndarray]:
+    # Column arrays (id, lat, lng, time_minutes, cell_size_m and optionally the
+    # cells x targets durations) from whichever storage holds the scenario.
+    # ``bounds`` is (min_lng, min_lat, max_lng, max_lat). ``since`` only keeps
+    # rows written after the row with that id; packed grids have no row ids
+    # (id is 0) and are always returned whole. ``aggregation`` is a
+    # (metric, targets, percentile) triple: time_minutes is then recomputed
+    # from the stored durations instead of read.
+    grid_result = get_grid_result(scenario)
+    if grid_result is not None:
+        lats, lngs = grid_result.cell_coordinates()
+        columns = {
+            "id": np.zeros(len(lats), dtype=np.int64),
+            "lat": lats,
+            "lng": lngs,
+            "time_minutes": grid_result.cell_times().astype(float),
+            "cell_size_m": np.full(len(lats), grid_result.resolution_m),
+        }
+        if include_durations:
+            durations = grid_result.cell_durations().astype(float)
+            columns["durations"] = np.where(np.isinf(durations), np.nan, durations)
+        if aggregation is not None:
+            metric, targets, percentile = aggregation
+            columns["time_minutes"] = aggregate_duration_matrix(
+                _grid_duration_matrix(grid_result, targets),
+                metric,
+                [target.weight for target in targets],
+                percentile,
+            )
+        if bounds is not None:
+            keep = (
+                (lngs >= bounds[0])
+                & (lats >= bounds[1])
+                & (lngs <= bounds[2])
+                & (lats <= bounds[3])
+            )
+            columns = {key: value[keep] for key, value in columns.items()}
+        return columns
+
+    queryset = scenario.cell_results.order_by("pk")
+    if since is not None:
+        queryset = queryset.filter(pk__gt=since)
+    if bounds is not None:
+        queryset = queryset.filter(
+            lng__gte=bounds[0], lat__gte=bounds[1], lng__lte=bounds[2], lat__lte=bounds[3]
+        )
+    rows = list(queryset.values_list("pk", "lat", "lng", "time_minutes", "cell_size_m"))
+    values = np.array(rows, dtype=float).reshape(len(rows), 5)
+    columns = {
+        "id": np.array([row[0] for row in rows], dtype=np.int64),
+        "lat": values[:, 1],
+        "lng": values[:, 2],
+        "time_minutes": values[:, 3],
+        "cell_size_m": np.where(
+            np.isnan(values[:, 4]), float(scenario.grid_resolution_m), values[:, 4]
+        ),
+    }
+    if include_durations or aggregation is not None:
+        # Rows may be appended by a running computation between the two
+        # queries; stop at the last id read above so the columns line up.
+        last_id = int(columns["id"][-1]) if len(rows) else 0
+        raws = list(queryset.filter(pk__lte=last_id).values_list("raw", flat=True))
+    if aggregation is not None:
+        metric, targets, percentile = aggregation
+        columns["time_minutes"] = aggregate_duration_matrix(
+            duration_matrix(raws, targets),
+            metric,
+            [target.weight for target in targets],
+            percentile,
+        )
+    if include_durations:
+        lists = [(raw or {}).get("durations") or [] for raw in raws]
+        num_targets = max((len(values) for values in lists), default=0)
+        durations = np.full((len(lists), num_targets), np.nan)
+        for index, values in enumerate(lists):
+            durations[index, : len(values)] = [np.nan if v is None else v for v in values]
+        columns["durations"] = durations
+    return columns
+
+
+def iter_result_rows(
+    scenario: Scenario,
+    include_raw: bool = True,
+    chunk_size: int = 2000,
+    since: Optional[int] = None,
+) -> Iterator[tuple]:
+    # (lat, lng, time_minutes, cell_size_m, raw, id) tuples, ``raw`` being None
+    # when not requested and ``id`` None for packed grids (see
+    # load_result_columns for ``since``).
+    grid_result = get_grid_result(scenario)
+    if grid_result is None:
+        fields = ["lat", "lng", "time_minutes", "cell_size_m"]
+        if include_raw:
+            fields.append("raw")
+        queryset = scenario.cell_results.order_by("pk")
+        if since is not None:
+            queryset = queryset.filter(pk__gt=since)
+        for row in queryset.values_list(*fields, "pk").iterator(chunk_size=chunk_size):
+            yield row if include_raw else (*row[:4], None, row[4])
+        return
+
+    lats, lngs = grid_result.cell_coordinates()
+    times = grid_result.cell_times()
+    durations = grid_result.cell_durations()
+    interpolated = grid_result.cell_interpolated()
+    for index in range(len(lats)):
+        raw = None
+        if include_raw:
+            values = durations[index].tolist()
+            raw = {
+                "durations": [int(value) if np.isfinite(value) else None for value in values]
+            }
+            if grid_result.target_keys:
+                raw["targets"] = grid_result.target_keys
+                pruned = [
+                    key for key, value in zip(grid_result.target_keys, values) if np.isinf(value)
+                ]
+                if pruned:
+                    raw["pruned"] = pruned
+            if interpolated[index]:
+                raw["interpolated"] = True
+        time_minutes = float(times[index])
+        yield (
+            float(lats[index]),
+            float(lngs[index]),
+            None if np.isnan(time_minutes) else time_minutes,
+            grid_result.resolution_m,
+            raw,
+            None,
+        )
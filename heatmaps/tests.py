@@ -1,3 +1,1196 @@
-from django.test import TestCase
+import datetime as dt
+import gzip
+import json
+import tempfile
+import time
+from importlib import import_module
+from pathlib import Path
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from pyproj import Transformer
+from rest_framework.test import APIClient
+from shapely.geometry import Point, shape
+from shapely.ops import transform
+
+from heatmaps.cache import TravelTimeCache
+from heatmaps.gtfs import GtfsTransitRouter
+from heatmaps.instrumentation import RunMetrics
+from heatmaps.jobs import (
+    ChunkLease,
+    LeaseLost,
+    claim_next_chunk,
+    claim_next_computation,
+    enqueue_computation,
+    plan_computation,
+    run_chunk,
+)
+from heatmaps.models import (
+    CellResult,
+    ComputationChunk,
+    ComputationResult,
+    IsochroneSet,
+    RoutingRateLimit,
+    Scenario,
+    TargetPoint,
+    TravelTimeCacheEntry,
+)
+from heatmaps.renderers import BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, HeatmapBinaryRenderer
+from heatmaps.resilience import (
+    CallBudget,
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilientBackend,
+    RoutingBudgetExceeded,
+    TokenBucket,
+    get_circuit_breaker,
+)
+from heatmaps.routing import RoutingBackendError, RoutingQuotaError
+from heatmaps.sampling import compute_adaptive_times, compute_budgeted_times
+from heatmaps.services import (
+    GridGenerator,
+    aggregate_durations,
+    compute_times,
+    decode_cell_ids,
+    encode_cell_ids,
+    iter_compute_times,
+    parent_cell_ids,
+)
+from heatmaps.simulation import SimulatedRoutingBackend
+from heatmaps.storage import append_results, iter_result_rows
+from heatmaps.tiles import tile_cache_dir
+
+# About 8.5 x 7.8 km of Madrid.
+POLYGON = {
+    "type": "Polygon",
+    "coordinates": [
+        [[-3.75, 40.38], [-3.65, 40.38], [-3.65, 40.45], [-3.75, 40.45], [-3.75, 40.38]]
+    ],
+}
+ORIGIN = TargetPoint(lat=40.4168, lng=-3.7038)
+TARGETS = [
+    {"name": "Sol", "lat": 40.4168, "lng": -3.7038, "weight": 3},
+    {"name": "Atocha", "lat": 40.4066, "lng": -3.6892, "weight": 1},
+    {"name": "Chamartin", "lat": 40.4722, "lng": -3.6825, "weight": 2},
+]
+
+# Instant, deterministic routing: the simulated backend with no latency,
+# errors or quota, and no cache in between.
+simulated_routing = override_settings(
+    HEATMAPS_ROUTING_BACKEND="simulated",
+    HEATMAPS_ROUTING_MODE_BACKENDS={},
+    HEATMAPS_SIMULATED_LATENCY_MS=0,
+    HEATMAPS_SIMULATED_LATENCY_JITTER_MS=0,
+    HEATMAPS_SIMULATED_ELEMENT_LATENCY_MS=0,
+    HEATMAPS_SIMULATED_ERROR_RATE=0,
+    HEATMAPS_SIMULATED_QUOTA_ELEMENTS_PER_MINUTE=0,
+    HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND=0,
+    HEATMAPS_ROUTING_USE_MATRIX=False,
+    HEATMAPS_ROUTING_PRUNE_MIN=False,
+    HEATMAPS_CACHE_ENABLED=False,
+    HEATMAPS_RUN_ASYNC=False,
+    HEATMAPS_RESULT_STORAGE="rows",
+    HEATMAPS_TILE_CACHE_DIR=Path(tempfile.gettempdir()) / "heatmaps-test-tiles",
+)
+
+
+def scalar_grid(polygon_geojson: dict, resolution_m: float) -> list:
+    # The original cell walk, one point at a time.
+    to_mercator = Transformer.from_crs(4326, 3857, always_xy=True)
+    to_wgs = Transformer.from_crs(3857, 4326, always_xy=True)
+    projected = transform(to_mercator.transform, shape(polygon_geojson))
+    minx, miny, maxx, maxy = projected.bounds
+    cells = []
+    x = minx
+    while x <= maxx:
+        y = miny
+        while y <= maxy:
+            if projected.contains(Point(x, y)):
+                lng, lat = to_wgs.transform(x, y)
+                cells.append((lat, lng))
+            y += resolution_m
+        x += resolution_m
+    return cells
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def create_scenario(self, **fields) -> Scenario:
+        data = {
+            "name": "Test",
+            "polygon_geojson": POLYGON,
+            "targets": TARGETS,
+            "grid_resolution_m": 1000,
+            "metric": Scenario.METRIC_MIN,
+            **fields,
+        }
+        response = self.client.post(reverse("scenario-create"), data, format="json")
+        self.assertEqual(response.status_code, 201, response.content)
+        return Scenario.objects.get(pk=response.json()["id"])
+
+    def run_scenario(self, scenario: Scenario, **data) -> ComputationResult:
+        response = self.client.post(
+            reverse("scenario-run", args=[scenario.pk]), data, format="json"
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return ComputationResult.objects.get(scenario=scenario)
+
+    def patch_scenario(self, scenario: Scenario, **data) -> dict:
+        response = self.client.patch(
+            reverse("scenario-detail", args=[scenario.pk]), data, format="json"
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def result_features(self, scenario: Scenario, **params) -> list:
+        response = self.client.get(reverse("scenario-results", args=[scenario.pk]), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()["features"]
+
+
+class GridGeneratorTests(TestCase):
+    def test_square_grid_matches_scalar_walk(self):
+        generator = GridGenerator()
+        for resolution in (333, 1000, 2500):
+            with self.subTest(resolution=resolution):
+                cells = generator.generate_grid(POLYGON, resolution)
+                self.assertEqual(
+                    [(cell.lat, cell.lng) for cell in cells], scalar_grid(POLYGON, resolution)
+                )
+
+    def test_holes_and_multipolygon_parts_are_kept(self):
+        hole = [[-3.72, 40.40], [-3.68, 40.40], [-3.68, 40.43], [-3.72, 40.43], [-3.72, 40.40]]
+        island = [[-3.60, 40.38], [-3.55, 40.38], [-3.55, 40.42], [-3.60, 40.42], [-3.60, 40.38]]
+        with_hole = {"type": "Polygon", "coordinates": [POLYGON["coordinates"][0], hole]}
+        multipolygon = {
+            "type": "MultiPolygon",
+            "coordinates": [with_hole["coordinates"], [island]],
+        }
+        generator = GridGenerator()
+        for polygon in (with_hole, multipolygon):
+            with self.subTest(polygon=polygon["type"]):
+                cells = generator.generate_grid(polygon, 500)
+                self.assertEqual(
+                    [(cell.lat, cell.lng) for cell in cells], scalar_grid(polygon, 500)
+                )
+                hole_shape = shape({"type": "Polygon", "coordinates": [hole]})
+                self.assertFalse(
+                    any(hole_shape.contains(Point(cell.lng, cell.lat)) for cell in cells)
+                )
+        island_shape = shape({"type": "Polygon", "coordinates": [island]})
+        cells = generator.generate_grid(multipolygon, 500)
+        self.assertTrue(any(island_shape.contains(Point(cell.lng, cell.lat)) for cell in cells))
+
+
+class HexGridTests(TestCase):
+    def setUp(self):
+        self.generator = GridGenerator(shape=Scenario.GRID_HEX)
+        self.projected = self.generator.project_polygon(POLYGON)
+        self.xs, self.ys = self.generator.generate_projected_grid(self.projected, 500)
+        self.origin = self.generator.lattice_origin(self.projected)
+        self.size = self.generator.cell_size(500)
+
+    def random_points(self, count: int, margin: float = 0):
+        minx, miny, maxx, maxy = self.projected.buffer(-margin).bounds
+        rng = np.random.default_rng(19)
+        return rng.uniform(minx, maxx, count), rng.uniform(miny, maxy, count)
+
+    def nearest_centres(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        distances = np.hypot(xs[:, None] - self.xs[None, :], ys[:, None] - self.ys[None, :])
+        return distances.argmin(axis=1), distances.min(axis=1)
+
+    def test_hexagons_cover_like_squares_with_fewer_cells(self):
+        squares = len(GridGenerator().generate_grid(POLYGON, 500))
+        # A hexagon covers 1.5 * sqrt(3) / 2 ~ 1.3 times the area of a square.
+        self.assertAlmostEqual(len(self.xs) / squares, 1 / (1.5 * np.sqrt(3) / 2), delta=0.03)
+        # Same covering radius as the squares: resolution / sqrt(2).
+        _, distances = self.nearest_centres(*self.random_points(2000, margin=500))
+        self.assertLessEqual(distances.max(), 500 / np.sqrt(2) + 1e-6)
+
+    def test_points_locate_the_nearest_centre(self):
+        lngs, lats = self.generator.to_wgs(self.xs, self.ys)
+        cell_ids = self.generator.cell_ids(lats, lngs, self.origin, 500)
+        self.assertEqual(len(set(cell_ids.tolist())), len(cell_ids))
+        xs, ys = self.random_points(2000, margin=500)
+        nearest, _ = self.nearest_centres(xs, ys)
+        found = self.generator.cell_index(cell_ids, xs, ys, self.origin, 500)
+        np.testing.assert_array_equal(found, nearest)
+
+    def test_interior_cells_have_six_neighbours_one_cell_apart(self):
+        neighbours = self.generator.neighbours(self.xs, self.ys, self.size)
+        self.assertEqual(neighbours.shape, (len(self.xs), 6))
+        interior = (neighbours >= 0).all(axis=1)
+        self.assertTrue(interior.any())
+        rows = np.flatnonzero(interior)
+        for column in range(6):
+            gaps = np.hypot(
+                self.xs[rows] - self.xs[neighbours[rows, column]],
+                self.ys[rows] - self.ys[neighbours[rows, column]],
+            )
+            np.testing.assert_allclose(gaps, self.size)
+
+    def test_children_have_exactly_one_parent(self):
+        lngs, lats = self.generator.to_wgs(self.xs, self.ys)
+        parents = self.generator.cell_ids(lats, lngs, self.origin, 500)
+        child_x, child_y = self.generator.child_points(self.xs, self.ys, self.size)
+        child_lngs, child_lats = self.generator.to_wgs(child_x.ravel(), child_y.ravel())
+        children = self.generator.cell_ids(
+            child_lats, child_lngs, self.origin, 500, np.full(child_x.size, self.size / 2)
+        )
+        self.assertEqual(len(set(children.tolist())), child_x.size)
+        np.testing.assert_array_equal(
+            parent_cell_ids(children, Scenario.GRID_HEX), np.tile(parents, 4)
+        )
+
+
+@simulated_routing
+class PruningTests(TestCase):
+    # A bound that still never exceeds the simulated speeds, but is close
+    # enough to them to prune.
+    @override_settings(HEATMAPS_ROUTING_MAX_SPEED_KMH={"transit": 20})
+    def test_min_pruning_is_exact(self):
+        cells = GridGenerator().generate_grid(POLYGON, 700)
+        rng = np.random.default_rng(7)
+        targets = [
+            TargetPoint(lat=float(lat), lng=float(lng))
+            for lat, lng in zip(rng.uniform(40.36, 40.47, 12), rng.uniform(-3.78, -3.62, 12))
+        ]
+        for use_matrix in (False, True):
+            with self.subTest(use_matrix=use_matrix):
+                runs = {}
+                for prune in (False, True):
+                    metrics = RunMetrics()
+                    results = compute_times(
+                        cells,
+                        targets,
+                        None,
+                        Scenario.METRIC_MIN,
+                        client=SimulatedRoutingBackend(),
+                        use_matrix=use_matrix,
+                        use_cache=False,
+                        prune=prune,
+                        metrics=metrics,
+                    )
+                    runs[prune] = (results, metrics.counters["api_elements"])
+                (full, full_elements), (pruned, pruned_elements) = runs[False], runs[True]
+                self.assertEqual(
+                    [result["time_minutes"] for result in pruned],
+                    [result["time_minutes"] for result in full],
+                )
+                self.assertLess(pruned_elements, full_elements)
+                self.assertTrue(any(result["raw"].get("pruned") for result in pruned))
+
+
+    def test_loose_bound_stops_pruning_matrix_runs(self):
+        # At the default transit bound nothing is pruned: after the first batch
+        # the run fetches whole rows again, and no element is requested twice.
+        cells = GridGenerator().generate_grid(POLYGON, 700)
+        targets = [TargetPoint(lat=target["lat"], lng=target["lng"]) for target in TARGETS]
+        runs = {}
+        for prune in (False, True):
+            metrics = RunMetrics()
+            results = list(
+                iter_compute_times(
+                    cells,
+                    targets,
+                    None,
+                    Scenario.METRIC_MIN,
+                    client=SimulatedRoutingBackend(),
+                    use_matrix=True,
+                    use_cache=False,
+                    batch_size=50,
+                    prune=prune,
+                    metrics=metrics,
+                )
+            )
+            self.assertFalse(any(result["raw"].get("pruned") for result in results))
+            runs[prune] = (metrics.counters["api_calls"], metrics.counters["api_elements"])
+        (full_calls, full_elements), (pruned_calls, pruned_elements) = runs[False], runs[True]
+        self.assertEqual(pruned_elements, full_elements)
+        # Only the first batch pays: one call per nearest target, then its
+        # rows split by the targets they have left.
+        self.assertLessEqual(pruned_calls - full_calls, 2 * len(targets))
+
+
+@simulated_routing
+class TravelTimeCacheTests(TestCase):
+    def test_keys_snap_positions_and_departure_times(self):
+        cache = TravelTimeCache(snap_decimals=4, bucket_minutes=15)
+        departure = dt.datetime(2026, 3, 2, 8, 1, tzinfo=dt.timezone.utc)
+        key = cache.make_key(ORIGIN, TargetPoint(lat=40.4066, lng=-3.6892), departure, "transit")
+        nearby = TargetPoint(lat=ORIGIN.lat + 0.00001, lng=ORIGIN.lng - 0.00001)
+        same_bucket = departure + dt.timedelta(minutes=13)
+        self.assertEqual(
+            cache.make_key(nearby, TargetPoint(lat=40.4066, lng=-3.6892), same_bucket, "TRANSIT"),
+            key,
+        )
+        next_bucket = departure + dt.timedelta(minutes=15)
+        self.assertNotEqual(
+            cache.make_key(ORIGIN, TargetPoint(lat=40.4066, lng=-3.6892), next_bucket, "transit"),
+            key,
+        )
+        self.assertTrue(cache.make_key(ORIGIN, ORIGIN, None, "drive").startswith("drive|any|"))
+
+    def test_database_tier_is_shared_and_refills_memory(self):
+        writer = TravelTimeCache(max_memory_entries=2)
+        writer.set_many({"a": 60, "b": None, "c": 180})
+        # "a" fell out of the writer's memory but is still in the database.
+        self.assertEqual(writer.get_many(["a", "b", "c", "d"]), {"a": 60, "b": None, "c": 180})
+        self.assertEqual(
+            writer.stats(), {"memory_hits": 2, "db_hits": 1, "misses": 1, "memory_entries": 2}
+        )
+        # Another worker process only has the database.
+        reader = TravelTimeCache()
+        self.assertEqual(reader.get_many(["a", "b"]), {"a": 60, "b": None})
+        self.assertEqual(reader.get_many(["a", "b"]), {"a": 60, "b": None})
+        self.assertEqual(reader.stats()["db_hits"], 2)
+        self.assertEqual(reader.stats()["memory_hits"], 2)
+
+    def test_expired_and_overflowing_entries_are_pruned(self):
+        cache = TravelTimeCache(max_db_entries=2, ttl_seconds=3600)
+        for key in ("old", "a", "b", "c"):
+            cache.set_many({key: 60})
+        TravelTimeCacheEntry.objects.filter(key="old").update(
+            created_at=timezone.now() - dt.timedelta(hours=2)
+        )
+        self.assertEqual(TravelTimeCache(ttl_seconds=3600).get_many(["old"]), {})
+        self.assertEqual(cache.prune(), 2)
+        self.assertEqual(
+            sorted(TravelTimeCacheEntry.objects.values_list("key", flat=True)), ["b", "c"]
+        )
+
+    def test_second_run_is_served_from_the_cache(self):
+        cells = GridGenerator().generate_grid(POLYGON, 1000)
+        targets = [TargetPoint(lat=target["lat"], lng=target["lng"]) for target in TARGETS]
+        runs = []
+        for _ in range(2):
+            metrics = RunMetrics()
+            results = compute_times(
+                cells,
+                targets,
+                None,
+                Scenario.METRIC_AVG,
+                mode="drive",
+                client=SimulatedRoutingBackend(),
+                use_cache=True,
+                cache=TravelTimeCache(),
+                metrics=metrics,
+            )
+            runs.append((results, metrics.counters))
+        (first, first_counters), (second, second_counters) = runs
+        self.assertEqual(second, first)
+        self.assertEqual(first_counters["cache_misses"], len(cells) * len(targets))
+        self.assertEqual(second_counters["cache_hits"], len(cells) * len(targets))
+        self.assertEqual(second_counters["api_calls"], 0)
+
+
+@simulated_routing
+class MatrixBatchingTests(TestCase):
+    def test_matrix_calls_skip_known_pairs(self):
+        cells = GridGenerator().generate_grid(POLYGON, 1000)
+        targets = [TargetPoint(lat=target["lat"], lng=target["lng"]) for target in TARGETS]
+        full = compute_times(
+            cells,
+            targets,
+            None,
+            Scenario.METRIC_AVG,
+            client=SimulatedRoutingBackend(),
+            use_matrix=True,
+            use_cache=False,
+        )
+        durations = [result["raw"]["durations"] for result in full]
+        # Every fifth cell lost the first two targets, every third the last.
+        known = [
+            [None, None, row[2]]
+            if index % 5 == 0
+            else row[:2] + [None]
+            if index % 3 == 0
+            else list(row)
+            for index, row in enumerate(durations)
+        ]
+        missing = sum(row.count(None) for row in known)
+        metrics = RunMetrics()
+        results = compute_times(
+            cells,
+            targets,
+            None,
+            Scenario.METRIC_AVG,
+            client=SimulatedRoutingBackend(),
+            use_matrix=True,
+            use_cache=False,
+            known_durations=known,
+            metrics=metrics,
+        )
+        self.assertEqual([result["raw"]["durations"] for result in results], durations)
+        self.assertEqual(metrics.counters["api_elements"], missing)
+
+
+@simulated_routing
+class AdaptiveSamplingTests(TestCase):
+    def adaptive_times(self, threshold_minutes: float, progress=None) -> list:
+        return compute_adaptive_times(
+            POLYGON,
+            1000,
+            250,
+            threshold_minutes,
+            [TargetPoint(lat=target["lat"], lng=target["lng"]) for target in TARGETS],
+            None,
+            Scenario.METRIC_MIN,
+            progress_callback=progress,
+            client=SimulatedRoutingBackend(),
+            use_cache=False,
+        )
+
+    def test_flat_times_keep_the_coarse_grid(self):
+        results = self.adaptive_times(10_000)
+        self.assertEqual(len(results), len(GridGenerator().generate_grid(POLYGON, 1000)))
+        self.assertEqual({result["cell_size_m"] for result in results}, {1000})
+
+    def test_refinement_stops_at_the_minimum_cell_size(self):
+        results = self.adaptive_times(0.1)
+        self.assertEqual(min(result["cell_size_m"] for result in results), 250)
+
+    def test_refinement_splits_only_cells_at_time_steps(self):
+        coarse = len(GridGenerator().generate_grid(POLYGON, 1000))
+        progress = []
+        results = self.adaptive_times(2.5, lambda done, total: progress.append((done, total)))
+        sizes = {result["cell_size_m"] for result in results}
+        self.assertEqual(sizes, {1000, 500})
+        # Children replace their parent: the covered area stays the grid's.
+        area = sum(result["cell_size_m"] ** 2 for result in results)
+        self.assertAlmostEqual(area / (coarse * 1000**2), 1, delta=0.05)
+        # Progress runs across the levels without going back.
+        done = [value for value, _ in progress]
+        self.assertEqual(done, sorted(done))
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self.assertGreater(progress[-1][1], coarse)
+
+
+@simulated_routing
+class BudgetedSamplingTests(TestCase):
+    def budgeted_times(self, call_budget: int, use_matrix: bool, metrics: RunMetrics) -> list:
+        return compute_budgeted_times(
+            POLYGON,
+            500,
+            call_budget,
+            [TargetPoint(lat=target["lat"], lng=target["lng"]) for target in TARGETS],
+            None,
+            Scenario.METRIC_AVG,
+            client=SimulatedRoutingBackend(),
+            use_matrix=use_matrix,
+            use_cache=False,
+            metrics=metrics,
+        )
+
+    def test_budget_counts_routing_calls(self):
+        num_cells = len(GridGenerator().generate_grid(POLYGON, 500))
+        for use_matrix, call_budget, sampled in ((False, 60, 20), (True, 4, 100)):
+            with self.subTest(use_matrix=use_matrix), self.settings(
+                HEATMAPS_ROUTING_MATRIX_BATCH_SIZE=25
+            ):
+                metrics = RunMetrics()
+                results = self.budgeted_times(call_budget, use_matrix, metrics)
+                self.assertEqual(len(results), num_cells)
+                self.assertEqual(metrics.counters["api_calls"], call_budget)
+                routed = [result for result in results if not result["raw"].get("interpolated")]
+                self.assertEqual(len(routed), sampled)
+                self.assertTrue(all(result["time_minutes"] is not None for result in results))
+
+    def test_interpolation_stays_close_to_the_routed_times(self):
+        metrics = RunMetrics()
+        sampled = self.budgeted_times(4, True, metrics)
+        full = self.budgeted_times(10_000, True, RunMetrics())
+        self.assertFalse(any(result["raw"].get("interpolated") for result in full))
+        errors = np.array(
+            [a["time_minutes"] - b["time_minutes"] for a, b in zip(sampled, full)]
+        )
+        self.assertLess(np.abs(errors).mean(), 1)
+
+
+# Stops ~22 km apart, far beyond walking: line 1 runs A -> B, line 2
+# runs B2 -> C, with B2 a 100 m walk (80 s) from B. All times in UTC.
+GTFS_FEED = {
+    "agency.txt": "agency_id,agency_name,agency_url,agency_timezone\n"
+    "M,Metro,https://example.com,UTC\n",
+    "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n"
+    "A,A,0.0,0.0\n"
+    "B,B,0.0,0.2\n"
+    "B2,B2,0.0009,0.2\n"
+    "C,C,0.0,0.4\n",
+    "routes.txt": "route_id,agency_id,route_short_name,route_type\n1,M,1,1\n2,M,2,1\n",
+    "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,"
+    "start_date,end_date\n"
+    "WEEK,1,1,1,1,1,0,0,20260101,20261231\n",
+    # No weekday service on Wednesday 4 March, a special trip instead.
+    "calendar_dates.txt": "service_id,date,exception_type\n"
+    "WEEK,20260304,2\n"
+    "SPECIAL,20260304,1\n",
+    "trips.txt": "route_id,service_id,trip_id\n"
+    "1,WEEK,morning\n"
+    "1,WEEK,night\n"
+    "1,SPECIAL,special\n"
+    "2,WEEK,early_connection\n"
+    "2,WEEK,connection\n",
+    "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+    "morning,08:00:00,08:00:00,A,1\n"
+    "morning,08:10:00,08:10:00,B,2\n"
+    "night,24:30:00,24:30:00,A,1\n"
+    "night,24:45:00,24:45:00,B,2\n"
+    "special,08:30:00,08:30:00,A,1\n"
+    "special,08:45:00,08:45:00,B,2\n"
+    "early_connection,08:11:00,08:11:00,B2,1\n"
+    "early_connection,08:19:00,08:19:00,C,2\n"
+    "connection,08:12:00,08:12:00,B2,1\n"
+    "connection,08:20:00,08:20:00,C,2\n",
+}
+GTFS_STOPS = {
+    "A": TargetPoint(lat=0.0, lng=0.0),
+    "B": TargetPoint(lat=0.0, lng=0.2),
+    "B2": TargetPoint(lat=0.0009, lng=0.2),
+    "C": TargetPoint(lat=0.0, lng=0.4),
+}
+
+
+class GtfsRouterTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        for name, content in GTFS_FEED.items():
+            (Path(directory.name) / name).write_text(content)
+        cls.feed_path = directory.name
+
+    def duration(self, origin: str, destination: str, when: str, **options) -> int:
+        router = GtfsTransitRouter(
+            self.feed_path, walk_speed_mps=1.25, max_transfer_walk_m=400, **options
+        )
+        return router.get_transit_duration_seconds(
+            GTFS_STOPS[origin], GTFS_STOPS[destination], dt.datetime.fromisoformat(when)
+        )
+
+    def test_transfer_waits_for_the_walk(self):
+        # Off at B 08:10, at B2 08:11:20: the 08:11 connection is gone, the
+        # 08:12 one arrives at C at 08:20.
+        self.assertEqual(self.duration("A", "C", "2026-03-03T08:00:00+00:00"), 20 * 60)
+        self.assertEqual(self.duration("A", "B", "2026-03-03T07:55:00+00:00"), 15 * 60)
+
+    def test_matrix_routes_each_origin(self):
+        router = GtfsTransitRouter(self.feed_path, walk_speed_mps=1.25, max_transfer_walk_m=400)
+        matrix = router.get_duration_matrix(
+            [GTFS_STOPS["A"], GTFS_STOPS["B2"]],
+            [GTFS_STOPS["B"], GTFS_STOPS["C"]],
+            dt.datetime(2026, 3, 3, 8, tzinfo=dt.timezone.utc),
+        )
+        # B2 -> B is an 80 s walk; B2 catches the 08:11 connection.
+        self.assertEqual(matrix, [[600, 1200], [80, 1140]])
+
+    def test_trip_past_midnight_runs_on_the_next_day(self):
+        # Monday's 24:30 trip leaves A at 00:30 on Tuesday.
+        self.assertEqual(self.duration("A", "B", "2026-03-03T00:20:00+00:00"), 25 * 60)
+
+    def test_calendar_date_exceptions(self):
+        # Wednesday 4 March: the weekday trip is removed, the special one added.
+        self.assertEqual(self.duration("A", "B", "2026-03-04T08:00:00+00:00"), 45 * 60)
+        # Nor does Wednesday's 24:30 trip run after midnight on Thursday.
+        self.assertIsNone(self.duration("A", "B", "2026-03-05T00:20:00+00:00"))
+        # Saturdays have no service at all.
+        self.assertIsNone(self.duration("A", "B", "2026-03-07T08:00:00+00:00"))
+
+    def test_search_horizon(self):
+        # The 08:20 arrival at C is 170 minutes after 05:30, and 200 after 05:00.
+        self.assertEqual(self.duration("A", "C", "2026-03-03T05:30:00+00:00"), 170 * 60)
+        self.assertIsNone(self.duration("A", "C", "2026-03-03T05:00:00+00:00"))
+        self.assertIsNone(
+            self.duration("A", "C", "2026-03-03T07:00:00+00:00", max_duration_minutes=60)
+        )
+
+
+@simulated_routing
+class ResumeTests(ApiTestCase):
+    def test_resume_fetches_only_missing_cells(self):
+        scenario = self.create_scenario()
+        computation = self.run_scenario(scenario)
+        self.assertEqual(computation.status, ComputationResult.STATUS_DONE)
+        self.assertEqual(computation.api_calls, computation.num_cells * len(TARGETS))
+        expected = sorted(scenario.cell_results.values_list("cell_id", "time_minutes"))
+
+        # An interrupted run: the last cells were never saved.
+        lost = list(scenario.cell_results.order_by("-pk").values_list("pk", flat=True)[:7])
+        CellResult.objects.filter(pk__in=lost).delete()
+        computation = self.run_scenario(scenario)
+        self.assertEqual(computation.status, ComputationResult.STATUS_DONE)
+        self.assertEqual(computation.cells_reused, computation.num_cells - 7)
+        self.assertEqual(computation.api_calls, 7 * len(TARGETS))
+        self.assertEqual(
+            sorted(scenario.cell_results.values_list("cell_id", "time_minutes")), expected
+        )
+
+    def test_added_target_only_fetches_its_pairs(self):
+        scenario = self.create_scenario(metric=Scenario.METRIC_AVG)
+        num_cells = self.run_scenario(scenario).num_cells
+        targets = TARGETS + [{"name": "Retiro", "lat": 40.4153, "lng": -3.6845}]
+        detail = self.patch_scenario(scenario, targets=targets)
+        self.assertEqual(detail["computation"]["status"], ComputationResult.STATUS_PENDING)
+        self.assertFalse(scenario.cell_results.filter(time_minutes__isnull=False).exists())
+
+        computation = self.run_scenario(scenario)
+        self.assertEqual(computation.status, ComputationResult.STATUS_DONE)
+        self.assertEqual(computation.api_calls, num_cells)
+        diffed = sorted(scenario.cell_results.values_list("cell_id", "time_minutes"))
+        computation = self.run_scenario(scenario, refresh=True)
+        self.assertEqual(computation.api_calls, num_cells * len(targets))
+        self.assertEqual(
+            sorted(scenario.cell_results.values_list("cell_id", "time_minutes")), diffed
+        )
+
+    def test_replaced_rows_pass_the_since_cursor(self):
+        scenario = self.create_scenario()
+        self.run_scenario(scenario)
+        response = self.client.get(reverse("scenario-results", args=[scenario.pk]))
+        cursor = response["X-Results-Cursor"]
+        rows = list(iter_result_rows(scenario, include_raw=True))[:3]
+        append_results(
+            scenario,
+            [
+                {"lat": lat, "lng": lng, "time_minutes": 1.0, "cell_size_m": size, "raw": raw}
+                for lat, lng, _, size, raw, _ in rows
+            ],
+            replace=True,
+        )
+        features = self.result_features(scenario, since=cursor)
+        self.assertEqual([feature["properties"]["time_minutes"] for feature in features], [1.0] * 3)
+
+
+@simulated_routing
+class ReaggregationTests(ApiTestCase):
+    def test_reaggregation_matches_aggregate_durations(self):
+        for storage in ("rows", "array"):
+            with self.subTest(storage=storage), self.settings(HEATMAPS_RESULT_STORAGE=storage):
+                scenario = self.create_scenario()
+                self.run_scenario(scenario)
+                for metric, percentile in (
+                    (Scenario.METRIC_AVG, 50),
+                    (Scenario.METRIC_WEIGHTED, 50),
+                    (Scenario.METRIC_MAX, 50),
+                    (Scenario.METRIC_PERCENTILE, 75),
+                ):
+                    detail = self.patch_scenario(
+                        scenario, metric=metric, metric_percentile=percentile
+                    )
+                    self.assertEqual(
+                        detail["computation"]["status"], ComputationResult.STATUS_DONE
+                    )
+                    targets = list(scenario.targets.all())
+                    rows = list(iter_result_rows(scenario, include_raw=True))
+                    self.assertTrue(rows)
+                    for _, _, time_minutes, _, raw, _ in rows:
+                        expected = aggregate_durations(
+                            raw["durations"], targets, metric, percentile
+                        )
+                        self.assertAlmostEqual(time_minutes, expected, places=3)
+
+    def test_weight_change_keeps_the_run(self):
+        scenario = self.create_scenario(metric=Scenario.METRIC_WEIGHTED)
+        self.run_scenario(scenario)
+        before = dict(scenario.cell_results.values_list("cell_id", "time_minutes"))
+        targets = [dict(target, weight=1) for target in TARGETS]
+        detail = self.patch_scenario(scenario, targets=targets)
+        self.assertEqual(detail["computation"]["status"], ComputationResult.STATUS_DONE)
+        after = dict(scenario.cell_results.values_list("cell_id", "time_minutes"))
+        self.assertEqual(before.keys(), after.keys())
+        self.assertNotEqual(before, after)
+
+
+@simulated_routing
+class CellIdTests(ApiTestCase):
+    def stored_ids(self, scenario: Scenario) -> dict:
+        return {
+            (round(lat, 7), round(lng, 7)): cell_id
+            for cell_id, lat, lng in scenario.cell_results.values_list("cell_id", "lat", "lng")
+        }
+
+    def test_encoding_is_frozen(self):
+        ids = encode_cell_ids(np.array([0, -3, 5]), np.array([0, 7, -2]), np.array([0, 0, 2]))
+        # Stored in the database: changing the layout orphans every row.
+        self.assertEqual(ids.tolist(), [2251799847239680, 2251799645913095, 11258999437524990])
+        self.assertTrue((ids[:2] < 2**53).all())
+        self.assertEqual(
+            [axis.tolist() for axis in decode_cell_ids(ids)],
+            [[0, -3, 5], [0, 7, -2], [0, 0, 2]],
+        )
+        with self.assertRaises(ValueError):
+            encode_cell_ids(np.array([1 << 25]), np.array([0]), np.array([0]))
+
+    def test_backfill_matches_the_live_ids(self):
+        backfill = import_module("heatmaps.migrations.0011_cell_ids")
+        scenario = self.create_scenario(
+            sampling_mode=Scenario.SAMPLING_ADAPTIVE, refine_threshold_minutes=2.5
+        )
+        self.run_scenario(scenario)
+        rows = list(scenario.cell_results.values_list("lat", "lng", "cell_size_m", "cell_id"))
+        self.assertGreater(len({row[2] for row in rows}), 1)
+        lats, lngs, sizes, cell_ids = (np.array(column) for column in zip(*rows))
+        frozen = backfill.square_cell_ids(
+            lats.astype(float),
+            lngs.astype(float),
+            scenario.polygon_geojson,
+            float(scenario.grid_resolution_m),
+            sizes.astype(float),
+        )
+        np.testing.assert_array_equal(frozen, cell_ids)
+
+    def test_ids_survive_a_full_rerun(self):
+        scenario = self.create_scenario()
+        self.run_scenario(scenario)
+        before = self.stored_ids(scenario)
+        self.run_scenario(scenario, refresh=True)
+        self.assertEqual(self.stored_ids(scenario), before)
+
+    def test_global_alignment_shares_cells_across_scenarios(self):
+        shifted = {
+            "type": "Polygon",
+            "coordinates": [
+                [[-3.70, 40.40], [-3.60, 40.40], [-3.60, 40.47], [-3.70, 40.47], [-3.70, 40.40]]
+            ],
+        }
+        first = self.create_scenario(grid_alignment=Scenario.GRID_GLOBAL)
+        second = self.create_scenario(
+            grid_alignment=Scenario.GRID_GLOBAL, polygon_geojson=shifted
+        )
+        self.run_scenario(first)
+        self.run_scenario(second)
+        first_ids, second_ids = self.stored_ids(first), self.stored_ids(second)
+        shared = first_ids.keys() & second_ids.keys()
+        self.assertGreater(len(shared), 10)
+        self.assertEqual(
+            {key: first_ids[key] for key in shared}, {key: second_ids[key] for key in shared}
+        )
+        # Cells at different places never share an ID.
+        self.assertEqual(len(set(first_ids.values()) & set(second_ids.values())), len(shared))
+
+
+@simulated_routing
+class ScenarioUpdateTests(ApiTestCase):
+    def run_and_cache(self, **fields) -> Scenario:
+        scenario = self.create_scenario(**fields)
+        self.run_scenario(scenario)
+        self.client.get(reverse("scenario-tile", args=[scenario.pk, 0, 0, 0]))
+        self.client.get(reverse("scenario-isochrones", args=[scenario.pk]))
+        self.assertTrue((tile_cache_dir() / str(scenario.pk)).exists())
+        self.assertTrue(IsochroneSet.objects.filter(scenario=scenario).exists())
+        return scenario
+
+    def assert_invalidated(self, scenario: Scenario, detail: dict) -> None:
+        self.assertEqual(detail["computation"]["status"], ComputationResult.STATUS_PENDING)
+        self.assertFalse(scenario.cell_results.exclude(time_minutes=None).exists())
+        self.assertFalse((tile_cache_dir() / str(scenario.pk)).exists())
+        self.assertFalse(IsochroneSet.objects.filter(scenario=scenario).exists())
+
+    def test_routing_change_clears_the_results(self):
+        for field, value in (
+            ("mode", "driving"),
+            ("departure_time", "2026-03-02T08:00:00Z"),
+        ):
+            with self.subTest(field=field):
+                scenario = self.run_and_cache()
+                self.assert_invalidated(scenario, self.patch_scenario(scenario, **{field: value}))
+                self.assertFalse(scenario.cell_results.exists())
+
+    def test_grid_change_keeps_the_durations_for_the_rerun(self):
+        smaller = {
+            "type": "Polygon",
+            "coordinates": [
+                [[-3.74, 40.39], [-3.66, 40.39], [-3.66, 40.44], [-3.74, 40.44], [-3.74, 40.39]]
+            ],
+        }
+        for field, value in (
+            ("polygon_geojson", smaller),
+            ("grid_resolution_m", 800),
+            ("grid_alignment", Scenario.GRID_GLOBAL),
+            ("grid_shape", Scenario.GRID_HEX),
+            ("sampling_mode", Scenario.SAMPLING_ADAPTIVE),
+            ("min_cell_size_m", 250),
+        ):
+            with self.subTest(field=field):
+                scenario = self.run_and_cache()
+                self.assert_invalidated(scenario, self.patch_scenario(scenario, **{field: value}))
+                self.assertTrue(scenario.cell_results.exists())
+                self.run_scenario(scenario)
+                self.assertFalse(scenario.cell_results.filter(time_minutes=None).exists())
+
+    def test_moved_target_marks_the_results_stale(self):
+        scenario = self.run_and_cache()
+        targets = [dict(TARGETS[0], lat=40.42), *TARGETS[1:]]
+        self.assert_invalidated(scenario, self.patch_scenario(scenario, targets=targets))
+
+    def test_name_change_keeps_everything(self):
+        scenario = self.run_and_cache()
+        detail = self.patch_scenario(scenario, name="Renamed")
+        self.assertEqual(detail["computation"]["status"], ComputationResult.STATUS_DONE)
+        self.assertTrue((tile_cache_dir() / str(scenario.pk)).exists())
+        self.assertTrue(IsochroneSet.objects.filter(scenario=scenario).exists())
+
+
+@simulated_routing
+class ChunkLeaseTests(ApiTestCase):
+    def test_expired_lease_is_reclaimed(self):
+        scenario = self.create_scenario()
+        enqueue_computation(scenario)
+        computation = claim_next_computation()
+        self.assertEqual(computation.scenario_id, scenario.pk)
+        self.assertTrue(plan_computation(computation))
+        abandoned = claim_next_chunk("dead-worker")
+        self.assertIsNone(claim_next_chunk("live-worker"))
+
+        # The first worker died mid-chunk: once its lease runs out the chunk
+        # goes to the next worker, which completes the run on its own.
+        ComputationChunk.objects.filter(pk=abandoned.pk).update(
+            lease_expires_at=timezone.now() - dt.timedelta(seconds=1)
+        )
+        chunk = claim_next_chunk("live-worker")
+        self.assertEqual(chunk.pk, abandoned.pk)
+        self.assertEqual(chunk.attempts, 2)
+        with self.assertRaises(LeaseLost):
+            ChunkLease(abandoned, "dead-worker", RunMetrics()).renew()
+        run_chunk(chunk, "live-worker")
+
+        computation.refresh_from_db()
+        self.assertEqual(computation.status, ComputationResult.STATUS_DONE)
+        self.assertEqual(scenario.cell_results.count(), computation.num_cells)
+        self.assertFalse(ComputationChunk.objects.filter(computation=computation).exists())
+
+
+@simulated_routing
+class ResultsFormatTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scenario = self.create_scenario(metric=Scenario.METRIC_AVG)
+        self.run_scenario(self.scenario)
+        self.features = self.result_features(self.scenario)
+
+    def test_binary_results(self):
+        response = self.client.get(
+            reverse("scenario-results", args=[self.scenario.pk]),
+            {"raw": 1},
+            HTTP_ACCEPT=HeatmapBinaryRenderer.media_type,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], HeatmapBinaryRenderer.media_type)
+        magic, version, _, count, num_targets = BINARY_HEADER.unpack_from(response.content)
+        self.assertEqual((magic, version), (BINARY_MAGIC, BINARY_VERSION))
+        self.assertEqual((count, num_targets), (len(self.features), len(TARGETS)))
+        body = np.frombuffer(response.content[BINARY_HEADER.size :], dtype="<f4")
+        self.assertEqual(len(body), count * (4 + num_targets))
+        lats, lngs, times = body[:count], body[count : 2 * count], body[2 * count : 3 * count]
+        durations = body[4 * count :].reshape(count, num_targets)
+        for index, feature in enumerate(self.features):
+            lng, lat = feature["geometry"]["coordinates"]
+            self.assertAlmostEqual(float(lats[index]), lat, places=4)
+            self.assertAlmostEqual(float(lngs[index]), lng, places=4)
+            self.assertAlmostEqual(
+                float(times[index]), feature["properties"]["time_minutes"], places=3
+            )
+            self.assertEqual(
+                durations[index].tolist(), feature["properties"]["raw"]["durations"]
+            )
+
+    def test_binary_errors_are_json(self):
+        response = self.client.get(
+            reverse("scenario-results", args=[self.scenario.pk]),
+            {"metric": "FASTEST"},
+            HTTP_ACCEPT=HeatmapBinaryRenderer.media_type,
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("detail", json.loads(response.content))
+
+    def test_gzip_stream(self):
+        url = reverse("scenario-results-stream", args=[self.scenario.pk])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        compressed = b"".join(response.streaming_content)
+        collection = json.loads(gzip.decompress(compressed))
+        self.assertEqual(collection["type"], "FeatureCollection")
+        self.assertEqual(collection["features"], self.features)
+
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertEqual(json.loads(b"".join(plain.streaming_content)), collection)
+
+    def test_gzip_negotiation(self):
+        url = reverse("scenario-results-stream", args=[self.scenario.pk])
+        for accept_encoding, compressed in (
+            ("gzip, deflate, br", True),
+            ("br;q=1.0, gzip;q=0.8", True),
+            ("*", True),
+            ("gzip;q=0", False),
+            ("GZIP; q=0.0, *;q=1", False),
+            ("*;q=0", False),
+            ("x-gzip-foo", False),
+            ("identity", False),
+        ):
+            with self.subTest(accept_encoding=accept_encoding):
+                response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+                self.assertEqual(response.has_header("Content-Encoding"), compressed)
+                self.assertIn("Accept-Encoding", response["Vary"])
+                b"".join(response.streaming_content)
+
+
+@simulated_routing
+class TileTests(ApiTestCase):
+    # Zoom 12 tile over the west half of POLYGON.
+    TILE = (12, 2005, 1544)
+
+    def get_tile(self, scenario: Scenario, **headers):
+        url = reverse("scenario-tile", args=[scenario.pk, *self.TILE])
+        return self.client.get(url, **headers)
+
+    def test_tiles_are_cached_and_revalidated(self):
+        scenario = self.create_scenario()
+        self.run_scenario(scenario)
+        response = self.get_tile(scenario)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        paths = list((tile_cache_dir() / str(scenario.pk)).rglob("*.png"))
+        self.assertEqual([path.parts[-3:] for path in paths], [("12", "2005", "1544.png")])
+
+        revalidated = self.get_tile(scenario, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated["ETag"], response["ETag"])
+
+        # A metric switch repaints the tile under the same URL: the old ETag
+        # no longer matches.
+        self.patch_scenario(scenario, metric=Scenario.METRIC_MAX)
+        changed = self.get_tile(scenario, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], response["ETag"])
+        self.assertNotEqual(changed.content, response.content)
+
+    def test_tiles_out_of_range(self):
+        scenario = self.create_scenario()
+        for z, x, y in ((2, 4, 0), (2, 0, 4), (30, 0, 0)):
+            with self.subTest(z=z, x=x, y=y):
+                response = self.client.get(reverse("scenario-tile", args=[scenario.pk, z, x, y]))
+                self.assertEqual(response.status_code, 404)
+
+
+@simulated_routing
+class IsochroneTests(ApiTestCase):
+    def isochrones(self, scenario: Scenario, **params):
+        return self.client.get(reverse("scenario-isochrones", args=[scenario.pk]), params)
+
+    def test_contours_separate_faster_and_slower_cells(self):
+        for grid_shape in (Scenario.GRID_SQUARE, Scenario.GRID_HEX):
+            with self.subTest(grid_shape=grid_shape):
+                scenario = self.create_scenario(targets=TARGETS[:1], grid_shape=grid_shape)
+                self.run_scenario(scenario)
+                response = self.isochrones(scenario, minutes="20,10,15")
+                self.assertEqual(response.status_code, 200)
+                features = response.json()["features"]
+                self.assertEqual(
+                    [feature["properties"]["max_minutes"] for feature in features], [10, 15, 20]
+                )
+                areas = [shape(feature["geometry"]) for feature in features]
+                for inner, outer in zip(areas, areas[1:]):
+                    self.assertTrue(outer.buffer(1e-6).contains(inner))
+                cells = [
+                    (Point(feature["geometry"]["coordinates"]), feature["properties"])
+                    for feature in self.result_features(scenario)
+                ]
+                for feature, area in zip(features, areas):
+                    limit = feature["properties"]["max_minutes"]
+                    for point, properties in cells:
+                        if abs(properties["time_minutes"] - limit) > 0.5:
+                            self.assertEqual(
+                                area.contains(point), properties["time_minutes"] < limit
+                            )
+
+    def test_isochrones_are_stored_per_run(self):
+        scenario = self.create_scenario()
+        self.run_scenario(scenario)
+        first = self.isochrones(scenario).json()
+        self.assertEqual(
+            [feature["properties"]["max_minutes"] for feature in first["features"]],
+            [15, 30, 45, 60],
+        )
+        self.assertEqual(self.isochrones(scenario).json(), first)
+        self.assertEqual(IsochroneSet.objects.filter(scenario=scenario).count(), 1)
+        self.isochrones(scenario, minutes="12")
+        self.assertEqual(IsochroneSet.objects.filter(scenario=scenario).count(), 2)
+
+    def test_invalid_thresholds(self):
+        scenario = self.create_scenario()
+        for minutes in ("abc", "0", "-5", ",", ",".join(["5"] * 50)):
+            with self.subTest(minutes=minutes):
+                self.assertEqual(self.isochrones(scenario, minutes=minutes).status_code, 400)
+
+
+async def collect_stream(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+@simulated_routing
+@override_settings(HEATMAPS_EVENTS_POLL_INTERVAL_SECONDS=0.01)
+class EventStreamTests(ApiTestCase):
+    def events(self, scenario_id: int, **headers) -> list:
+        response = self.client.get(reverse("scenario-events", args=[scenario_id]), **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = []
+        # An async view: the stream is an async iterator.
+        body = async_to_sync(collect_stream)(response.streaming_content)
+        for block in body.decode().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if line)
+            if "event" in fields:
+                events.append((fields["event"], fields.get("id"), json.loads(fields["data"])))
+        return events
+
+    def test_finished_run_streams_its_cells_then_done(self):
+        scenario = self.create_scenario()
+        computation = self.run_scenario(scenario)
+        events = self.events(scenario.pk)
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(events[-1][2]["status"], ComputationResult.STATUS_DONE)
+        cells = [event for event in events if event[0] == "cells"]
+        self.assertEqual(
+            sum(len(data["features"]) for _, _, data in cells), computation.num_cells
+        )
+        for _, event_id, data in cells:
+            self.assertEqual(int(event_id), data["cursor"])
+        self.assertEqual(events[-1][2]["cursor"], cells[-1][2]["cursor"])
+        progress = [data for event, _, data in events if event == "progress"]
+        self.assertEqual(progress[-1]["cells_done"], computation.cells_total)
+
+    def test_reconnect_resumes_after_the_last_event_id(self):
+        scenario = self.create_scenario()
+        self.run_scenario(scenario)
+        pks = list(scenario.cell_results.order_by("pk").values_list("pk", flat=True))
+        events = self.events(scenario.pk, HTTP_LAST_EVENT_ID=str(pks[49]))
+        cells = [data for event, _, data in events if event == "cells"]
+        self.assertEqual(sum(len(data["features"]) for data in cells), len(pks) - 50)
+
+    def test_failed_run_ends_with_its_status(self):
+        scenario = self.create_scenario()
+        ComputationResult.objects.filter(scenario=scenario).update(
+            status=ComputationResult.STATUS_ERROR, error_message="Quota exceeded."
+        )
+        events = self.events(scenario.pk)
+        self.assertEqual([event for event, _, _ in events], ["progress", "done"])
+        self.assertEqual(events[0][2]["error_message"], "Quota exceeded.")
+        self.assertEqual(events[1][2], {"status": ComputationResult.STATUS_ERROR, "cursor": 0})
+
+    def test_bad_requests(self):
+        scenario = self.create_scenario()
+        url = reverse("scenario-events", args=[scenario.pk])
+        self.assertEqual(self.client.get(url, {"since": "-1"}).status_code, 400)
+        self.assertEqual(
+            self.client.get(reverse("scenario-events", args=[scenario.pk + 1])).status_code, 404
+        )
+
+
+class FlakyBackend:
+    # Raises the queued errors one call at a time, then answers.
+    def __init__(self, *errors: Exception) -> None:
+        self.errors = list(errors)
+        self.calls = 0
+
+    def get_duration_matrix(self, origins, destinations, departure_time=None, mode="transit"):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return [[60] * len(destinations) for _ in origins]
+
+
+@override_settings(
+    HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND=0,
+    HEATMAPS_ROUTING_BREAKER_THRESHOLD=1,
+    HEATMAPS_ROUTING_BREAKER_COOLDOWN_SECONDS=0.01,
+)
+class ResilienceTests(TestCase):
+    def resilient(self, backend, name: str, **kwargs) -> ResilientBackend:
+        # Breakers are shared per backend name: one name per test.
+        return ResilientBackend(
+            backend, backend_name=name, max_attempts=3, base_delay=0.001, **kwargs
+        )
+
+    def open_breaker(self, name: str) -> CircuitBreaker:
+        breaker = get_circuit_breaker(name)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.02)
+        return breaker
+
+    def test_breaker_opens_and_probes_after_cooldown(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call(timeout=0)
+        time.sleep(0.06)
+        breaker.before_call(timeout=0)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one probe at a time.
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call(timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_quota_error_on_the_probe_closes_the_breaker(self):
+        breaker = self.open_breaker("probe-quota")
+        backend = FlakyBackend(RoutingQuotaError("Quota exceeded.", status_code=429))
+        result = self.resilient(backend, "probe-quota").get_duration_matrix([ORIGIN], [ORIGIN])
+        self.assertEqual(result, [[60]])
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(backend.calls, 2)
+
+    def test_client_error_on_the_probe_closes_the_breaker(self):
+        breaker = self.open_breaker("probe-client-error")
+        backend = FlakyBackend(RoutingBackendError("Bad request.", status_code=400))
+        with self.assertRaises(RoutingBackendError):
+            self.resilient(backend, "probe-client-error").get_duration_matrix([ORIGIN], [ORIGIN])
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(backend.calls, 1)
+
+    def test_probe_that_never_reaches_the_backend_is_released(self):
+        breaker = self.open_breaker("probe-budget")
+        backend = FlakyBackend()
+        with self.assertRaises(RoutingBudgetExceeded):
+            self.resilient(backend, "probe-budget", budget=CallBudget(0)).get_duration_matrix(
+                [ORIGIN], [ORIGIN]
+            )
+        self.assertEqual(backend.calls, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.resilient(backend, "probe-budget").get_duration_matrix(
+            [ORIGIN], [ORIGIN]
+        ), [[60]])
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retries_count_against_the_budget(self):
+        budget = CallBudget(2)
+        backend = FlakyBackend(*[RoutingBackendError("Unavailable.", status_code=503)] * 3)
+        with override_settings(HEATMAPS_ROUTING_BREAKER_THRESHOLD=10):
+            with self.assertRaises(RoutingBudgetExceeded):
+                self.resilient(backend, "budget", budget=budget).get_duration_matrix(
+                    [ORIGIN], [ORIGIN]
+                )
+        self.assertEqual((backend.calls, budget.used), (2, 2))
+
+    def test_token_bucket_is_shared_through_the_database(self):
+        first = TokenBucket("shared-bucket", rate_per_second=50, burst=5)
+        second = TokenBucket("shared-bucket", rate_per_second=50, burst=5)
+        self.assertEqual(first.acquire(5), 0)
+        # The other instance (another worker process) finds the bucket empty.
+        self.assertGreater(second.acquire(1), 0)
+        second.on_throttle()
+        self.assertEqual(RoutingRateLimit.objects.get(backend="shared-bucket").rate, 25)
+        first.on_success()
+        self.assertGreater(RoutingRateLimit.objects.get(backend="shared-bucket").rate, 25)
@@ -0,0 +1,185 @@
+import os
+import shutil
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from pyproj import Transformer
+
+from heatmaps.models import Scenario
+from heatmaps.storage import lattice_frame, load_result_columns
+
+TILE_SIZE = 256
+MERCATOR_EXTENT = 20037508.342789244
+
+# Same buckets and colours as the legend in index.html.
+COLOR_BREAKS_MINUTES = [15, 30, 45, 60]
+COLOR_PALETTE = np.array(
+    [
+        [0x0B, 0x4B, 0xFF, 150],
+        [0x5A, 0x7D, 0xFF, 150],
+        [0xF2, 0xB5, 0x00, 150],
+        [0xF2, 0x6B, 0x00, 150],
+        [0xD7, 0x26, 0x3D, 150],
+    ],
+    dtype=np.uint8,
+)
+NO_DATA_COLOR = np.array([0x9A, 0xA0, 0xA6, 70], dtype=np.uint8)
+
+_to_mercator = Transformer.from_crs(4326, 3857, always_xy=True)
+_to_wgs = Transformer.from_crs(3857, 4326, always_xy=True)
+
+
+def tile_cache_dir() -> Path:
+    return Path(getattr(settings, "HEATMAPS_TILE_CACHE_DIR", "tile_cache"))
+
+
+def get_tile(scenario: Scenario, z: int, x: int, y: int) -> bytes:
+    computation = getattr(scenario, "computation", None)
+    finished_at = computation.finished_at if computation else None
+    version = str(int(finished_at.timestamp())) if finished_at else "0"
+    path = tile_cache_dir() / str(scenario.pk) / version / str(z) / str(x) / f"{y}.png"
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        pass
+    data = render_tile(scenario, z, x, y)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename so concurrent readers never see a partial file.
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+    return data
+
+
+def invalidate_tile_cache(scenario_id: int) -> None:
+    shutil.rmtree(tile_cache_dir() / str(scenario_id), ignore_errors=True)
+
+
+def render_tile(scenario: Scenario, z: int, x: int, y: int) -> bytes:
+    tile_span = 2 * MERCATOR_EXTENT / (2**z)
+    minx = -MERCATOR_EXTENT + x * tile_span
+    maxy = MERCATOR_EXTENT - y * tile_span
+    maxx = minx + tile_span
+    miny = maxy - tile_span
+
+    # Cells are never larger than the scenario resolution, so a margin of one
+    # resolution catches every cell whose square overlaps the tile.
+    margin = float(scenario.grid_resolution_m)
+    lngs, lats = _to_wgs.transform(
+        [minx - margin, maxx + margin], [miny - margin, maxy + margin]
+    )
+    columns = load_result_columns(scenario, bounds=(lngs[0], lats[0], lngs[1], lats[1]))
+    image = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    if len(columns["lat"]) and scenario.grid_shape == Scenario.GRID_HEX:
+        _paint_hex_cells(image, scenario, columns, minx, maxy, TILE_SIZE / tile_span)
+    elif len(columns["lat"]):
+        mx, my = _to_mercator.transform(columns["lng"], columns["lat"])
+        _paint_cells(
+            image,
+            np.asarray(mx),
+            np.asarray(my),
+            columns["cell_size_m"],
+            columns["time_minutes"],
+            minx,
+            maxy,
+            TILE_SIZE / tile_span,
+        )
+    return encode_png(image)
+
+
+def _paint_cells(
+    image: np.ndarray,
+    mx: np.ndarray,
+    my: np.ndarray,
+    sizes: np.ndarray,
+    minutes: np.ndarray,
+    minx: float,
+    maxy: float,
+    scale: float,
+) -> None:
+    # Larger cells first so that finer (refined) cells are painted on top.
+    order = np.argsort(-sizes, kind="stable")
+    mx, my, sizes, minutes = mx[order], my[order], sizes[order], minutes[order]
+    half = sizes / 2
+    px0 = np.floor((mx - half - minx) * scale).astype(np.int64)
+    px1 = np.maximum(np.ceil((mx + half - minx) * scale).astype(np.int64), px0 + 1)
+    py0 = np.floor((maxy - my - half) * scale).astype(np.int64)
+    py1 = np.maximum(np.ceil((maxy - my + half) * scale).astype(np.int64), py0 + 1)
+    px0, px1 = np.clip(px0, 0, TILE_SIZE), np.clip(px1, 0, TILE_SIZE)
+    py0, py1 = np.clip(py0, 0, TILE_SIZE), np.clip(py1, 0, TILE_SIZE)
+    widths = px1 - px0
+    heights = py1 - py0
+    counts = np.where((widths > 0) & (heights > 0), widths * heights, 0)
+    if not counts.sum():
+        return
+
+    colors = _cell_colors(minutes)
+
+    # Expand every cell into the pixels of its rectangle without a Python
+    # loop; later assignments win, which preserves the painting order.
+    cell = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    px = px0[cell] + within % widths[cell]
+    py = py0[cell] + within // widths[cell]
+    image[py, px] = colors[cell]
+
+
+def _paint_hex_cells(
+    image: np.ndarray,
+    scenario: Scenario,
+    columns: dict,
+    minx: float,
+    maxy: float,
+    scale: float,
+) -> None:
+    # Hexagons do not fill pixel rectangles: find the cell under every pixel
+    # centre instead.
+    generator, origin = lattice_frame(scenario)
+    cell_ids = generator.cell_ids(
+        columns["lat"],
+        columns["lng"],
+        origin,
+        scenario.grid_resolution_m,
+        columns["cell_size_m"],
+    )
+    centres = (np.arange(TILE_SIZE) + 0.5) / scale
+    pixel_x, pixel_y = np.meshgrid(minx + centres, maxy - centres)
+    index = generator.cell_index(
+        cell_ids, pixel_x, pixel_y, origin, scenario.grid_resolution_m
+    )
+    covered = index >= 0
+    image[covered] = _cell_colors(columns["time_minutes"])[index[covered]]
+
+
+def _cell_colors(minutes: np.ndarray) -> np.ndarray:
+    colors = COLOR_PALETTE[np.digitize(np.nan_to_num(minutes), COLOR_BREAKS_MINUTES, right=True)]
+    colors[np.isnan(minutes)] = NO_DATA_COLOR
+    return colors
+
+
+def encode_png(rgba: np.ndarray, compression: int = 6) -> bytes:
+    height, width, _ = rgba.shape
+    # Every scanline is prefixed with filter type 0 (None).
+    scanlines = np.concatenate(
+        [np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1
+    )
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compression)),
+            chunk(b"IEND", b""),
+        ]
+    )
@@ -4,6 +4,7 @@ from heatmaps import views
 
 urlpatterns = [
     path("", views.index, name="index"),
+    path("metrics", views.metrics, name="metrics"),
     path("api/scenarios/", views.ScenarioListCreateView.as_view(), name="scenario-create"),
     path(
         "api/scenarios/<int:scenario_id>/",
@@ -20,4 +21,24 @@ urlpatterns = [
         views.ScenarioResultsView.as_view(),
         name="scenario-results",
     ),
+    path(
+        "api/scenarios/<int:scenario_id>/results/stream/",
+        views.ScenarioResultsStreamView.as_view(),
+        name="scenario-results-stream",
+    ),
+    path(
+        "api/scenarios/<int:scenario_id>/events/",
+        views.scenario_events,
+        name="scenario-events",
+    ),
+    path(
+        "api/scenarios/<int:scenario_id>/tiles/<int:z>/<int:x>/<int:y>.png",
+        views.ScenarioTileView.as_view(),
+        name="scenario-tile",
+    ),
+    path(
+        "api/scenarios/<int:scenario_id>/isochrones/",
+        views.ScenarioIsochronesView.as_view(),
+        name="scenario-isochrones",
+    ),
 ]
@@ -1,18 +1,49 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
+import zlib
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
-from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from heatmaps.models import CellResult, ComputationResult, Scenario
+from heatmaps.contours import DEFAULT_THRESHOLDS_MINUTES, get_isochrones
+from heatmaps.instrumentation import PROMETHEUS_CONTENT_TYPE, render_metrics
+from heatmaps.jobs import enqueue_computation, run_computation
+from heatmaps.models import ComputationResult, Scenario, TargetPoint
+from heatmaps.renderers import HeatmapBinaryRenderer, pack_result_columns
 from heatmaps.serializers import (
-    CellResultSerializer,
+    ComputationResultSerializer,
     ScenarioDetailSerializer,
     ScenarioSerializer,
 )
-from heatmaps.services import GridGenerator, compute_times
+from heatmaps.services import aggregate_duration_matrix
+from heatmaps.storage import (
+    duration_matrix,
+    has_pruned_durations,
+    iter_result_rows,
+    load_result_columns,
+)
+from heatmaps.tiles import get_tile
+
+# Rows fetched per database round trip (and features per written chunk) when
+# streaming results.
+RESULTS_STREAM_CHUNK_SIZE = 2000
+MAX_TILE_ZOOM = 22
+MAX_ISOCHRONE_THRESHOLDS = 10
+# Comment line sent on idle event streams so proxies keep the connection open.
+EVENTS_KEEPALIVE_SECONDS = 15
 
 
 def index(request):
@@ -20,6 +51,12 @@ def index(request):
     return render(request, "heatmaps/index.html", context)
 
 
+def metrics(request):
+    # Prometheus scrape endpoint. Runs executed by `run_heatmap_worker` are
+    # counted in the worker process: scrape its --metrics-port as well.
+    return HttpResponse(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
 class ScenarioListCreateView(APIView):
     def post(self, request):
         serializer = ScenarioSerializer(data=request.data)
@@ -33,87 +70,360 @@ class ScenarioDetailView(APIView):
         scenario = get_object_or_404(Scenario, pk=scenario_id)
         return Response(ScenarioDetailSerializer(scenario).data)
 
+    def patch(self, request, scenario_id):
+        scenario = get_object_or_404(Scenario, pk=scenario_id)
+        if scenario.computation.status in (
+            ComputationResult.STATUS_QUEUED,
+            ComputationResult.STATUS_RUNNING,
+        ):
+            return Response(
+                {"detail": "Computation in progress."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        serializer = ScenarioSerializer(scenario, data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        scenario = serializer.save()
+        return Response(ScenarioDetailSerializer(scenario).data)
+
 
 class ScenarioRunView(APIView):
     def post(self, request, scenario_id):
         scenario = get_object_or_404(Scenario, pk=scenario_id)
-        print(f"Starting heatmap computation for scenario {scenario.id}")
-        computation = scenario.computation
-        computation.status = ComputationResult.STATUS_RUNNING
-        computation.started_at = timezone.now()
-        computation.error_message = ""
-        computation.save(update_fields=["status", "started_at", "error_message"])
+        if scenario.computation.status in (
+            ComputationResult.STATUS_QUEUED,
+            ComputationResult.STATUS_RUNNING,
+        ):
+            return Response(
+                {"detail": "Computation already in progress."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        # Runs reuse the durations stored for the scenario (cells saved by a
+        # failed run, targets and cells that did not change) and only fetch
+        # what is missing; ``refresh`` recomputes every pair.
+        refresh = str(
+            request.data.get("refresh", request.query_params.get("refresh", ""))
+        ).lower() in ("1", "true")
+        computation = enqueue_computation(scenario, resume=not refresh)
+
+        if not getattr(settings, "HEATMAPS_RUN_ASYNC", True):
+            try:
+                run_computation(computation)
+            except Exception as exc:  # noqa: BLE001
+                return Response(
+                    {"detail": "Error while computing heatmap.", "error": str(exc)},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+            return Response({"detail": "Computation finished."})
+
+        return Response(
+            {
+                "detail": "Computation queued.",
+                "computation": ComputationResultSerializer(computation).data,
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
 
+
+class ScenarioResultsView(APIView):
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, HeatmapBinaryRenderer]
+
+    def get(self, request, scenario_id):
+        scenario = get_object_or_404(Scenario, pk=scenario_id)
         try:
-            grid = GridGenerator().generate_grid(
-                scenario.polygon_geojson, scenario.grid_resolution_m
-            )
-            print(
-                f"Generated {len(grid)} grid cells for scenario {scenario.id} "
-                f"with resolution {scenario.grid_resolution_m}m"
+            since = _parse_since(request.query_params.get("since"))
+        except ValueError:
+            return Response(
+                {"detail": "since must be a non-negative integer."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            results = compute_times(
-                grid,
-                scenario.targets.all(),
-                scenario.departure_time,
-                scenario.metric,
-                scenario.mode,
+        try:
+            aggregation = _parse_aggregation(request.query_params, scenario)
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if request.accepted_renderer.format == HeatmapBinaryRenderer.format:
+            include_durations = request.query_params.get("raw", "0") != "0"
+            columns = load_result_columns(
+                scenario,
+                include_durations=include_durations,
+                since=since,
+                aggregation=aggregation,
             )
-            print(f"Computed {len(results)} results for scenario {scenario.id}")
-            CellResult.objects.filter(scenario=scenario).delete()
-            CellResult.objects.bulk_create(
-                [
-                    CellResult(
-                        scenario=scenario,
-                        lat=result["lat"],
-                        lng=result["lng"],
-                        time_minutes=result["time_minutes"],
-                        raw=result["raw"],
-                    )
-                    for result in results
+            cursor = max(int(columns["id"].max(initial=0)), since or 0)
+            response = Response(pack_result_columns(columns))
+        else:
+            rows = list(iter_result_rows(scenario, since=since))
+            if aggregation is not None:
+                metric, targets, percentile = aggregation
+                times = aggregate_duration_matrix(
+                    duration_matrix([row[4] for row in rows], targets),
+                    metric,
+                    [target.weight for target in targets],
+                    percentile,
+                )
+                rows = [
+                    (row[0], row[1], None if np.isnan(value) else value, *row[3:])
+                    for row, value in zip(rows, times.tolist())
                 ]
+            features = []
+            cursor = since or 0
+            for row in rows:
+                features.append(_feature(row, include_raw=True))
+                cursor = max(cursor, row[5] or 0)
+            response = Response(
+                {"type": "FeatureCollection", "features": features, "cursor": cursor}
             )
-            computation.status = ComputationResult.STATUS_DONE
-            computation.finished_at = timezone.now()
-            computation.num_cells = len(results)
-            computation.save(
-                update_fields=["status", "finished_at", "num_cells"]
-            )
-        except Exception as exc:  # noqa: BLE001
-            computation.status = ComputationResult.STATUS_ERROR
-            computation.finished_at = timezone.now()
-            computation.error_message = str(exc)
-            computation.save(
-                update_fields=["status", "finished_at", "error_message"]
-            )
+        # Pass back as ``since`` to only get the cells saved after this response.
+        response["X-Results-Cursor"] = str(cursor)
+        if (
+            aggregation is not None
+            and aggregation[0] != Scenario.METRIC_MIN
+            and has_pruned_durations(scenario)
+        ):
+            # Cells that depend on a pruned pair have no time until a rerun.
+            response["X-Results-Needs-Rerun"] = "1"
+        return response
+
+
+class ScenarioResultsStreamView(APIView):
+    def get(self, request, scenario_id):
+        scenario = get_object_or_404(Scenario, pk=scenario_id)
+        include_raw = request.query_params.get("raw", "1") != "0"
+        use_gzip = _accepts_gzip(request.headers.get("Accept-Encoding", ""))
+        if request.query_params.get("gzip") is not None:
+            use_gzip = request.query_params["gzip"] != "0"
+        try:
+            since = _parse_since(request.query_params.get("since"))
+        except ValueError:
             return Response(
-                {"detail": "Error while computing heatmap.", "error": str(exc)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"detail": "since must be a non-negative integer."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
+        chunks = _stream_feature_collection(scenario, include_raw, since)
+        if use_gzip:
+            chunks = _gzip_chunks(chunks)
+        response = StreamingHttpResponse(chunks, content_type="application/geo+json")
+        if use_gzip:
+            response["Content-Encoding"] = "gzip"
+        response["Vary"] = "Accept-Encoding"
+        return response
+
 
-        return Response({"detail": "Computation finished."})
+class ScenarioTileView(APIView):
+    def get(self, request, scenario_id, z, x, y):
+        scenario = get_object_or_404(Scenario, pk=scenario_id)
+        if z > MAX_TILE_ZOOM or x >= 2**z or y >= 2**z:
+            raise Http404("Tile out of range.")
+        data = get_tile(scenario, z, x, y)
+        # Tiles change whenever the results do (runs, metric switches), which
+        # the URL does not show: caches revalidate every time and get a 304
+        # while the tile is unchanged.
+        etag = f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+        response = HttpResponse(data, content_type="image/png")
+        response["ETag"] = etag
+        response["Cache-Control"] = "no-cache"
+        return get_conditional_response(request, etag=etag, response=response)
 
 
-class ScenarioResultsView(APIView):
+class ScenarioIsochronesView(APIView):
     def get(self, request, scenario_id):
         scenario = get_object_or_404(Scenario, pk=scenario_id)
-        results = scenario.cell_results.all()
-        serializer = CellResultSerializer(results, many=True)
-        feature_collection = {
-            "type": "FeatureCollection",
-            "features": [
-                {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [item["lng"], item["lat"]],
+        minutes = request.query_params.get("minutes")
+        if minutes:
+            try:
+                thresholds = [float(value) for value in minutes.split(",") if value.strip()]
+            except ValueError:
+                thresholds = []
+            if not thresholds or len(thresholds) > MAX_ISOCHRONE_THRESHOLDS or any(
+                value <= 0 for value in thresholds
+            ):
+                return Response(
+                    {
+                        "detail": "minutes must be a comma-separated list of up to "
+                        f"{MAX_ISOCHRONE_THRESHOLDS} positive numbers."
                     },
-                    "properties": {
-                        "time_minutes": item["time_minutes"],
-                        "raw": item.get("raw"),
-                    },
-                }
-                for item in serializer.data
-            ],
-        }
-        return Response(feature_collection)
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+        else:
+            thresholds = list(DEFAULT_THRESHOLDS_MINUTES)
+        return Response(get_isochrones(scenario, thresholds))
+
+
+async def scenario_events(request, scenario_id):
+    # Server-sent events for a scenario: "cells" events carry the cells saved
+    # since the last one (the event id is the results cursor, so reconnecting
+    # clients resume through Last-Event-ID), "progress" events mirror the
+    # computation counters and a final "done" event carries its status. Meant
+    # to be served through new_life_planner.asgi, where an open stream does not
+    # hold a worker thread.
+    scenario = await Scenario.objects.select_related("computation").filter(pk=scenario_id).afirst()
+    if scenario is None:
+        raise Http404("Scenario not found.")
+    try:
+        since = _parse_since(
+            request.GET.get("since") or request.headers.get("Last-Event-ID")
+        )
+    except ValueError:
+        return JsonResponse({"detail": "since must be a non-negative integer."}, status=400)
+    response = StreamingHttpResponse(
+        _scenario_event_stream(scenario, since or 0), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def _scenario_event_stream(scenario: Scenario, cursor: int) -> AsyncIterator[bytes]:
+    poll_interval = getattr(settings, "HEATMAPS_EVENTS_POLL_INTERVAL_SECONDS", 1.0)
+    last_progress = None
+    last_sent = time.monotonic()
+    while True:
+        # Read the status before the rows: once a finished status has been
+        # seen, an empty read means every row of the run has been sent.
+        computation = await ComputationResult.objects.aget(scenario=scenario)
+        finished = computation.status in (
+            ComputationResult.STATUS_DONE,
+            ComputationResult.STATUS_ERROR,
+        )
+        rows = await sync_to_async(_rows_after)(scenario, cursor)
+        if rows:
+            cursor = rows[-1][5]
+            yield _sse_event(
+                "cells",
+                {"cursor": cursor, "features": [_feature(row, include_raw=False) for row in rows]},
+                event_id=cursor,
+            )
+        progress = (computation.status, computation.cells_done, computation.cells_total)
+        if progress != last_progress:
+            last_progress = progress
+            yield _sse_event("progress", ComputationResultSerializer(computation).data)
+        if rows:
+            last_sent = time.monotonic()
+            continue
+        if finished:
+            yield _sse_event("done", {"status": computation.status, "cursor": cursor})
+            return
+        if time.monotonic() - last_sent >= EVENTS_KEEPALIVE_SECONDS:
+            last_sent = time.monotonic()
+            yield b": keepalive\n\n"
+        await asyncio.sleep(poll_interval)
+
+
+def _rows_after(scenario: Scenario, cursor: int) -> List[tuple]:
+    # Only CellResult rows are incremental; a packed grid has no cursor.
+    return list(
+        scenario.cell_results.filter(pk__gt=cursor)
+        .order_by("pk")
+        .values_list("lat", "lng", "time_minutes", "cell_size_m", "raw", "pk")[
+            :RESULTS_STREAM_CHUNK_SIZE
+        ]
+    )
+
+
+def _sse_event(event: str, data, event_id: Optional[int] = None) -> bytes:
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+def _parse_aggregation(params, scenario: Scenario) -> Optional[Tuple[str, list, float]]:
+    # Preview another metric, percentile or set of target weights (comma
+    # separated, in target order) without saving it; see load_result_columns.
+    if not any(params.get(name) for name in ("metric", "percentile", "weights")):
+        return None
+    metric = params.get("metric") or scenario.metric
+    if metric not in dict(Scenario.METRIC_CHOICES):
+        raise ValueError(f"Unknown metric {metric!r}.")
+    try:
+        percentile = float(params.get("percentile") or scenario.metric_percentile)
+    except ValueError:
+        percentile = -1.0
+    if not 0 <= percentile <= 100:
+        raise ValueError("percentile must be a number between 0 and 100.")
+    targets = list(scenario.targets.all())
+    if params.get("weights"):
+        try:
+            weights = [float(value) for value in params["weights"].split(",")]
+        except ValueError:
+            weights = []
+        if len(weights) != len(targets):
+            raise ValueError(
+                f"weights must be a comma-separated list of {len(targets)} numbers."
+            )
+        targets = [
+            TargetPoint(lat=target.lat, lng=target.lng, weight=weight)
+            for target, weight in zip(targets, weights)
+        ]
+    return metric, targets, percentile
+
+
+def _parse_since(value: Optional[str]) -> Optional[int]:
+    if value in (None, ""):
+        return None
+    since = int(value)
+    if since < 0:
+        raise ValueError(value)
+    return since
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # RFC 9110 content coding negotiation: an explicit gzip (or x-gzip) entry
+    # wins over "*", and a q-value of 0 refuses the coding.
+    qualities = {}
+    for entry in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+def _feature(row: tuple, include_raw: bool) -> dict:
+    properties = {"time_minutes": row[2], "cell_size_m": row[3]}
+    if include_raw:
+        properties["raw"] = row[4]
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [row[1], row[0]]},
+        "properties": properties,
+    }
+
+
+def _stream_feature_collection(
+    scenario: Scenario, include_raw: bool, since: Optional[int] = None
+) -> Iterator[bytes]:
+    rows = iter_result_rows(
+        scenario, include_raw, chunk_size=RESULTS_STREAM_CHUNK_SIZE, since=since
+    )
+    yield b'{"type": "FeatureCollection", "features": ['
+    separator = ""
+    buffer = []
+    for row in rows:
+        buffer.append(separator + json.dumps(_feature(row, include_raw)))
+        separator = ", "
+        if len(buffer) >= RESULTS_STREAM_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+    if buffer:
+        yield "".join(buffer).encode()
+    yield b"]}"
+
+
+def _gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -14,6 +14,7 @@ from dotenv import load_dotenv
 
 load_dotenv() 
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -73,6 +74,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "new_life_planner.wsgi.application"
+ASGI_APPLICATION = "new_life_planner.asgi.application"
 
 
 # Database
@@ -121,3 +123,175 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = "static/"
+
+
+# Heatmaps
+# Number of concurrent routing requests issued by compute_times.
+
+HEATMAPS_ROUTING_MAX_WORKERS = int(os.getenv("HEATMAPS_ROUTING_MAX_WORKERS", "8"))
+
+# Batch cell x target pairs through the route matrix endpoint instead of one
+# computeRoutes call per pair, with this many origins per batch.
+
+HEATMAPS_ROUTING_USE_MATRIX = os.getenv("HEATMAPS_ROUTING_USE_MATRIX", "1") == "1"
+HEATMAPS_ROUTING_MATRIX_BATCH_SIZE = int(os.getenv("HEATMAPS_ROUTING_MATRIX_BATCH_SIZE", "25"))
+
+# MIN scenarios query the targets of each cell nearest first and skip those
+# that cannot beat the best duration found so far, bounding every duration
+# from below by the great-circle distance at the mode's top speed (km/h).
+# Modes missing from the table are never pruned. Off by default: pruned pairs
+# have no stored duration, so switching such a scenario to another metric
+# needs a rerun (which only fetches the pruned pairs). With matrix routing
+# pruning trades calls for elements: a round of calls for the nearest targets,
+# then rows split by the targets they have left. It is a net loss unless the
+# bound is tight; the default transit bound prunes almost nothing in a city,
+# and runs stop pruning after a batch where it ruled nothing out.
+
+HEATMAPS_ROUTING_PRUNE_MIN = os.getenv("HEATMAPS_ROUTING_PRUNE_MIN", "0") == "1"
+HEATMAPS_ROUTING_MAX_SPEED_KMH = {
+    "transit": float(os.getenv("HEATMAPS_ROUTING_MAX_SPEED_KMH_TRANSIT", "320")),
+    "drive": float(os.getenv("HEATMAPS_ROUTING_MAX_SPEED_KMH_DRIVE", "200")),
+    "two_wheeler": float(os.getenv("HEATMAPS_ROUTING_MAX_SPEED_KMH_TWO_WHEELER", "200")),
+    "bicycle": float(os.getenv("HEATMAPS_ROUTING_MAX_SPEED_KMH_BICYCLE", "50")),
+    "walk": float(os.getenv("HEATMAPS_ROUTING_MAX_SPEED_KMH_WALK", "10")),
+}
+
+# Route transit offline on a GTFS feed (directory or .zip) instead of the
+# Google API when set. Riders walk up to HEATMAPS_GTFS_MAX_WALK_M to and from
+# stops and HEATMAPS_GTFS_MAX_TRANSFER_WALK_M between stops, take at most
+# HEATMAPS_GTFS_MAX_ROUNDS vehicles, and trips longer than
+# HEATMAPS_GTFS_MAX_DURATION_MINUTES count as unreachable.
+
+HEATMAPS_GTFS_FEED_PATH = os.getenv("HEATMAPS_GTFS_FEED_PATH", "")
+HEATMAPS_GTFS_MAX_WALK_M = float(os.getenv("HEATMAPS_GTFS_MAX_WALK_M", "800"))
+HEATMAPS_GTFS_MAX_TRANSFER_WALK_M = float(os.getenv("HEATMAPS_GTFS_MAX_TRANSFER_WALK_M", "400"))
+HEATMAPS_GTFS_WALK_SPEED_MPS = float(os.getenv("HEATMAPS_GTFS_WALK_SPEED_MPS", "1.25"))
+HEATMAPS_GTFS_MAX_ROUNDS = int(os.getenv("HEATMAPS_GTFS_MAX_ROUNDS", "6"))
+HEATMAPS_GTFS_MAX_DURATION_MINUTES = float(os.getenv("HEATMAPS_GTFS_MAX_DURATION_MINUTES", "180"))
+HEATMAPS_GTFS_ORIGIN_BATCH_SIZE = int(os.getenv("HEATMAPS_GTFS_ORIGIN_BATCH_SIZE", "512"))
+
+# Routing backends by name (dotted paths to RoutingBackend classes). Runs use
+# HEATMAPS_ROUTING_BACKEND unless HEATMAPS_ROUTING_MODE_BACKENDS names one for
+# their mode; transit defaults to the GTFS router when a feed is configured.
+
+HEATMAPS_ROUTING_BACKENDS = {
+    "google": "heatmaps.services.GoogleDirectionsClient",
+    "gtfs": "heatmaps.gtfs.GtfsTransitRouter",
+    "simulated": "heatmaps.simulation.SimulatedRoutingBackend",
+}
+HEATMAPS_ROUTING_BACKEND = os.getenv("HEATMAPS_ROUTING_BACKEND", "google")
+HEATMAPS_ROUTING_MODE_BACKENDS = {
+    "transit": os.getenv(
+        "HEATMAPS_ROUTING_BACKEND_TRANSIT", "gtfs" if HEATMAPS_GTFS_FEED_PATH else ""
+    ),
+}
+
+# Remote routing calls share one client-side token bucket per backend, kept
+# in the database so that every worker process draws from it:
+# HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND matrix elements per second
+# (0 = unlimited), bursting up to HEATMAPS_ROUTING_RATE_LIMIT_BURST. The rate
+# halves on every 429 and recovers while calls succeed. Failed calls (429,
+# 5xx, timeouts) are retried up to HEATMAPS_ROUTING_RETRY_ATTEMPTS times with
+# jittered exponential backoff, honouring Retry-After. After
+# HEATMAPS_ROUTING_BREAKER_THRESHOLD consecutive failures the backend is left
+# alone for HEATMAPS_ROUTING_BREAKER_COOLDOWN_SECONDS.
+
+HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND = float(
+    os.getenv("HEATMAPS_ROUTING_RATE_LIMIT_PER_SECOND", "0")
+)
+HEATMAPS_ROUTING_RATE_LIMIT_BURST = (
+    float(os.getenv("HEATMAPS_ROUTING_RATE_LIMIT_BURST", "0")) or None
+)
+HEATMAPS_ROUTING_RETRY_ATTEMPTS = int(os.getenv("HEATMAPS_ROUTING_RETRY_ATTEMPTS", "5"))
+HEATMAPS_ROUTING_RETRY_BASE_DELAY_SECONDS = float(
+    os.getenv("HEATMAPS_ROUTING_RETRY_BASE_DELAY_SECONDS", "0.5")
+)
+HEATMAPS_ROUTING_RETRY_MAX_DELAY_SECONDS = float(
+    os.getenv("HEATMAPS_ROUTING_RETRY_MAX_DELAY_SECONDS", "60")
+)
+HEATMAPS_ROUTING_BREAKER_THRESHOLD = int(os.getenv("HEATMAPS_ROUTING_BREAKER_THRESHOLD", "5"))
+HEATMAPS_ROUTING_BREAKER_COOLDOWN_SECONDS = float(
+    os.getenv("HEATMAPS_ROUTING_BREAKER_COOLDOWN_SECONDS", "30")
+)
+
+# Behaviour of the "simulated" backend and of `manage.py run_routing_simulator`
+# (a local stand-in for the Routes API): latency per request plus per matrix
+# element, the fraction of requests failing with a 503, and an elements per
+# minute quota answered with 429 (0 = unlimited).
+
+HEATMAPS_SIMULATED_LATENCY_MS = float(os.getenv("HEATMAPS_SIMULATED_LATENCY_MS", "150"))
+HEATMAPS_SIMULATED_LATENCY_JITTER_MS = float(
+    os.getenv("HEATMAPS_SIMULATED_LATENCY_JITTER_MS", "50")
+)
+HEATMAPS_SIMULATED_ELEMENT_LATENCY_MS = float(
+    os.getenv("HEATMAPS_SIMULATED_ELEMENT_LATENCY_MS", "2")
+)
+HEATMAPS_SIMULATED_ERROR_RATE = float(os.getenv("HEATMAPS_SIMULATED_ERROR_RATE", "0"))
+HEATMAPS_SIMULATED_QUOTA_ELEMENTS_PER_MINUTE = int(
+    os.getenv("HEATMAPS_SIMULATED_QUOTA_ELEMENTS_PER_MINUTE", "0")
+)
+
+# Pipeline logs go to the console: run progress at INFO, per-stage timings
+# ("stage=routing duration_ms=...") at DEBUG. Counters and latency histograms
+# are served in the Prometheus text format at /metrics.
+
+HEATMAPS_LOG_LEVEL = os.getenv("HEATMAPS_LOG_LEVEL", "INFO")
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "plain": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "plain"},
+    },
+    "loggers": {
+        "heatmaps": {"handlers": ["console"], "level": HEATMAPS_LOG_LEVEL},
+    },
+}
+
+# Travel-time cache in front of the routing client: an in-process LRU tier
+# backed by the TravelTimeCacheEntry table. Coordinates are snapped to
+# HEATMAPS_CACHE_SNAP_DECIMALS and departure times to HEATMAPS_CACHE_BUCKET_MINUTES.
+
+HEATMAPS_CACHE_ENABLED = os.getenv("HEATMAPS_CACHE_ENABLED", "1") == "1"
+HEATMAPS_CACHE_MAX_MEMORY_ENTRIES = int(os.getenv("HEATMAPS_CACHE_MAX_MEMORY_ENTRIES", "100000"))
+HEATMAPS_CACHE_MAX_DB_ENTRIES = int(os.getenv("HEATMAPS_CACHE_MAX_DB_ENTRIES", "5000000"))
+HEATMAPS_CACHE_TTL_SECONDS = int(os.getenv("HEATMAPS_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+HEATMAPS_CACHE_SNAP_DECIMALS = int(os.getenv("HEATMAPS_CACHE_SNAP_DECIMALS", "4"))
+HEATMAPS_CACHE_BUCKET_MINUTES = int(os.getenv("HEATMAPS_CACHE_BUCKET_MINUTES", "15"))
+
+# Queue scenario runs for `manage.py run_heatmap_worker` instead of computing
+# them inside the request.
+
+HEATMAPS_RUN_ASYNC = os.getenv("HEATMAPS_RUN_ASYNC", "1") == "1"
+
+# Uniform runs are split into chunks of HEATMAPS_RUN_CHUNK_SIZE cells (0 = one
+# chunk) that every worker process, on any machine sharing the database, can
+# lease. Workers renew their leases while they work; a chunk whose lease is
+# HEATMAPS_CHUNK_LEASE_SECONDS old is leased again, and a run fails once a
+# chunk has been abandoned HEATMAPS_CHUNK_MAX_ATTEMPTS times.
+
+HEATMAPS_RUN_CHUNK_SIZE = int(os.getenv("HEATMAPS_RUN_CHUNK_SIZE", "1000"))
+HEATMAPS_CHUNK_LEASE_SECONDS = float(os.getenv("HEATMAPS_CHUNK_LEASE_SECONDS", "60"))
+HEATMAPS_CHUNK_MAX_ATTEMPTS = int(os.getenv("HEATMAPS_CHUNK_MAX_ATTEMPTS", "3"))
+
+# On-disk cache for rendered heatmap tiles, cleared whenever a run finishes.
+
+HEATMAPS_TILE_CACHE_DIR = Path(os.getenv("HEATMAPS_TILE_CACHE_DIR", BASE_DIR / "tile_cache"))
+
+# Where run results are stored: "rows" (one CellResult per cell) or "array"
+# (a single GridResult per scenario with packed arrays, used for lattice runs).
+
+HEATMAPS_RESULT_STORAGE = os.getenv("HEATMAPS_RESULT_STORAGE", "rows")
+
+# Cells are saved in transactions of HEATMAPS_RESULTS_BATCH_SIZE while a run is
+# in flight, so results (`?since=` cursor) and the server-sent events endpoint
+# can show partial heatmaps. The events endpoint polls the database every
+# HEATMAPS_EVENTS_POLL_INTERVAL_SECONDS; serve it with an ASGI server
+# (e.g. `uvicorn new_life_planner.asgi:application`).
+
+HEATMAPS_RESULTS_BATCH_SIZE = int(os.getenv("HEATMAPS_RESULTS_BATCH_SIZE", "500"))
+HEATMAPS_EVENTS_POLL_INTERVAL_SECONDS = float(
+    os.getenv("HEATMAPS_EVENTS_POLL_INTERVAL_SECONDS", "1")
+)